@@ -0,0 +1,228 @@
+"""
+End-to-end benchmarks for the CSV → KoboToolbox uploader.
+
+Generates synthetic clicker CSVs, runs each pipeline stage against a local
+stub server (see stub_server.py) and reports rows/s, p50/p99 per-row
+latency and peak RSS per stage. Every stage runs in a fresh process so its
+peak RSS is its own.
+
+    python run_benchmarks.py --rows 1000 10000 --latency 0.02 --save-baseline baseline.json
+    python run_benchmarks.py --rows 1000 10000 --latency 0.02 --baseline baseline.json
+
+With --baseline the exit status is 1 when any stage regresses by more than
+--tolerance (rows/s down, p99 or peak RSS up).
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))  # csv_to_kobo/, for uploadInstances
+sys.path.insert(0, HERE)
+
+from stub_server import StubKoboServer  # noqa: E402
+from synthetic_csv import write_clicker_csv  # noqa: E402
+
+FORM_ID = "benchForm"
+SURVEY_LINK = f"https://kf.kobotoolbox.org/#/forms/{FORM_ID}"
+MAPPING = {f"button{i}": f"button{i}" for i in range(1, 6)}
+
+STAGES = ("read_csv", "read_csv_parallel", "parse_time", "build_xml", "submit", "end_to_end")
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = min(len(ordered) - 1, max(0, int(round(q / 100.0 * (len(ordered) - 1)))))
+    return ordered[k]
+
+
+class _Timed:
+    """
+    Wraps a generator and records, per item, the time spent inside next()
+    (which includes every upstream stage).
+    """
+
+    def __init__(self, gen):
+        self.gen = gen
+        self.times = array("d")
+
+    def __iter__(self):
+        clock = time.perf_counter
+        it = iter(self.gen)
+        while True:
+            t0 = clock()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            self.times.append(clock() - t0)
+            yield item
+
+
+def _stage_latencies(stage, csv_path):
+    """
+    Per-row seconds spent in `stage` alone (its next() time minus its upstream's).
+    """
+    import uploadInstances as U
+
+    plan = U.RowPlan(U.read_csv_header(csv_path), MAPPING)
+    rows = _Timed(U.iter_csv_rows(csv_path))
+    parsed = _Timed(U.iter_parsed_rows(rows, time_index=plan.time_index))
+    jobs = _Timed(U.iter_instance_jobs(parsed, FORM_ID, plan, U.NullInstanceWriter()))
+    last = {"read_csv": rows, "parse_time": parsed, "build_xml": jobs}[stage]
+    for _ in last:
+        pass
+    if stage == "read_csv":
+        return rows.times
+    if stage == "parse_time":
+        return array("d", (p - r for p, r in zip(parsed.times, rows.times)))
+    return array("d", (j - p for j, p in zip(jobs.times, parsed.times)))
+
+
+def run_stage(stage, csv_path, base_url, max_in_flight):
+    """
+    Runs in a child process. Returns the stage's measurements.
+    """
+    import uploadInstances as U
+
+    started = time.perf_counter()
+    if stage in ("read_csv", "parse_time", "build_xml"):
+        latencies = _stage_latencies(stage, csv_path)
+        elapsed = sum(latencies)
+        rows = len(latencies)
+    elif stage == "read_csv_parallel":
+        timed = _Timed(U.iter_csv_rows_parallel(csv_path))
+        for _ in timed:
+            pass
+        elapsed = time.perf_counter() - started
+        latencies = timed.times  # per row: waiting on the worker processes included
+        rows = len(latencies)
+    elif stage == "submit":
+        session = U.make_session("bench", "bench", pool_size=max_in_flight)
+        plan = U.RowPlan(U.read_csv_header(csv_path), MAPPING)
+        parsed = U.iter_parsed_rows(U.iter_csv_rows(csv_path), time_index=plan.time_index)
+        jobs = U.iter_instance_jobs(parsed, FORM_ID, plan, U.NullInstanceWriter())
+        latencies = array("d")
+        for _, outcome in U.submit_ordered(session, f"{base_url}/submission", jobs, max_in_flight=max_in_flight):
+            if outcome is not None:
+                latencies.append(outcome.elapsed)
+        elapsed = time.perf_counter() - started
+        rows = len(latencies)
+    else:
+        out = tempfile.mkdtemp(prefix="bench-out-")
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            # Form definition first, as the CLI and GUI do (no disk cache: every run hits /api/v2/assets/)
+            fields = U.kf_get_custom_fields(base_url, FORM_ID, "bench", "bench")
+            missing = [f for f in MAPPING if f not in {fld["name"] for fld in fields}]
+            if missing:
+                raise RuntimeError(f"stub form lacks mapped fields: {missing}")
+            latencies = array("d")
+
+            def on_record(record):
+                if record["attempts"]:  # sent rows: submission time, retries included
+                    latencies.append(record["elapsed"])
+
+            U.run_upload_dynamic("bench", "bench", SURVEY_LINK, csv_path, out, MAPPING,
+                                 max_in_flight=max_in_flight, on_result=lambda msg: None, on_record=on_record,
+                                 resume=False, output_format="none", kc_base=base_url)
+        elapsed = time.perf_counter() - started
+        rows = U.count_csv_rows(csv_path)
+
+    return {
+        "rows": rows,
+        "seconds": round(elapsed, 4),
+        "rows_per_s": round(rows / elapsed, 1) if elapsed > 0 else None,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 4) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99) * 1000, 4) if latencies else None,
+        "peak_rss_mb": round(peak_rss_mb(), 1) if peak_rss_mb() is not None else None,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns a list of human-readable regressions versus the baseline.
+    """
+    problems = []
+    for key, cur in results.items():
+        base = baseline.get(key)
+        if not base:
+            continue
+        if base.get("rows_per_s") and cur.get("rows_per_s") is not None:
+            if cur["rows_per_s"] < base["rows_per_s"] * (1 - tolerance):
+                problems.append(f"{key}: rows/s {cur['rows_per_s']} < baseline {base['rows_per_s']}")
+        for metric in ("p99_ms", "peak_rss_mb"):
+            if base.get(metric) and cur.get(metric) is not None:
+                if cur[metric] > base[metric] * (1 + tolerance):
+                    problems.append(f"{key}: {metric} {cur[metric]} > baseline {base[metric]}")
+    return problems
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Benchmark the uploader pipeline against a local stub server.")
+    ap.add_argument("--rows", type=int, nargs="+", default=[1000, 10000],
+                    help="CSV sizes to generate (e.g. 1000 10000 100000 1000000)")
+    ap.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES))
+    ap.add_argument("--latency", type=float, default=0.0, help="stub server latency per request (s)")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="fraction of submissions answered 503")
+    ap.add_argument("--max-in-flight", type=int, default=8)
+    ap.add_argument("--json", help="write results to this file")
+    ap.add_argument("--baseline", help="compare against a saved results file")
+    ap.add_argument("--save-baseline", help="write results as the new baseline")
+    ap.add_argument("--tolerance", type=float, default=0.2, help="allowed regression (fraction, default 0.2)")
+    args = ap.parse_args(argv)
+
+    results = {}
+    ctx = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory(prefix="bench-") as tmp, \
+            StubKoboServer(latency=args.latency, error_rate=args.error_rate) as stub:
+        for n in args.rows:
+            csv_path = write_clicker_csv(os.path.join(tmp, f"clicks-{n}.csv"), n)
+            for stage in args.stages:
+                with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+                    res = pool.submit(run_stage, stage, csv_path, stub.base_url, args.max_in_flight).result()
+                key = f"{stage}@{n}"
+                results[key] = res
+                print(f"{key:<28} {res['rows_per_s'] or 0:>12,.1f} rows/s"
+                      f"  p50 {res['p50_ms'] if res['p50_ms'] is not None else '-':>9} ms"
+                      f"  p99 {res['p99_ms'] if res['p99_ms'] is not None else '-':>9} ms"
+                      f"  peak RSS {res['peak_rss_mb'] if res['peak_rss_mb'] is not None else '-'} MB")
+
+    for path in (args.json, args.save_baseline):
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        problems = compare(results, baseline, args.tolerance)
+        if problems:
+            print("\nREGRESSIONS:")
+            for p in problems:
+                print("  " + p)
+            return 1
+        print("\nNo regressions versus baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
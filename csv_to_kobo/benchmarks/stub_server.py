@@ -0,0 +1,209 @@
+"""
+Local stand-in for the KoboToolbox endpoints the uploader talks to:
+
+- POST /submission                  (KoboCAT OpenRosa submission)
+- GET  /api/v2/assets/<uid>/        (KPI form definition)
+- GET  /api/v2/assets/<uid>/data/   (KPI submitted data, paged)
+
+Latency and error rate are configurable so benchmarks can model slow or
+flaky field connections. Run directly to serve until Ctrl+C.
+"""
+import json
+import random
+import re
+import threading
+import time
+import xml.etree.ElementTree as ET
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+OPENROSA_OK = (
+    b'<OpenRosaResponse xmlns="http://openrosa.org/http/response">'
+    b'<message nature="submit_success">Successful submission.</message></OpenRosaResponse>'
+)
+
+DEFAULT_FIELDS = [
+    {"type": "integer", "name": f"button{i}", "label": [f"Button {i}"]} for i in range(1, 6)
+]
+
+_ASSET_RE = re.compile(r"^/api/v2/assets/([^/]+)/(data/)?$")
+_INSTANCE_ID_RE = re.compile(rb"<instanceID>([^<]*)</instanceID>")
+_XML_RE = re.compile(rb"<\?xml.*</[^>]+>", re.S)
+
+
+def _record_from_submission(body):
+    """
+    The /data/ record KPI would list for a submitted instance (top-level fields only).
+    """
+    m = _XML_RE.search(body)
+    if not m:
+        return None
+    root = ET.fromstring(m.group(0))
+    record = {}
+    for child in root:
+        if len(child):
+            for sub in child:
+                record[f"{child.tag}/{sub.tag}"] = sub.text or ""
+        else:
+            record[child.tag] = child.text or ""
+    return record
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real servers
+    disable_nagle_algorithm = True  # headers and body go out in separate writes
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body=b"", content_type="text/xml; charset=utf-8", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _delay(self):
+        stub = self.server.stub
+        if stub.latency:
+            time.sleep(stub.latency + random.uniform(0, stub.latency_jitter))
+
+    def do_POST(self):
+        stub = self.server.stub
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if urlparse(self.path).path.rstrip("/") != "/submission":
+            self._send(404)
+            return
+        self._delay()
+        if stub.error_rate and random.random() < stub.error_rate:
+            stub._count("errors")
+            self._send(503, b"Service Unavailable", "text/plain")
+            return
+        m = _INSTANCE_ID_RE.search(body)
+        instance_id = m.group(1).decode("utf-8") if m else None
+        with stub.lock:
+            duplicate = instance_id is not None and instance_id in stub.instance_ids
+            if instance_id is not None:
+                stub.instance_ids.add(instance_id)
+            stub.counts["submissions"] += 1
+            if stub.keep_bodies:
+                stub.bodies.append(body)
+            if stub.record_data and not duplicate:
+                record = _record_from_submission(body)
+                if record is not None:
+                    stub.data.append(record)
+        self._send(202 if duplicate else 201, OPENROSA_OK)
+
+    def do_GET(self):
+        stub = self.server.stub
+        url = urlparse(self.path)
+        m = _ASSET_RE.match(url.path)
+        if not m:
+            self._send(404)
+            return
+        self._delay()
+        stub._count("gets")
+        if m.group(2):
+            self._send_data_page(parse_qs(url.query))
+            return
+        etag = '"stub-form-v1"'
+        if self.headers.get("If-None-Match") == etag:
+            self._send(304)
+            return
+        asset = {
+            "uid": m.group(1),
+            "date_modified": "2025-10-15T23:34:36Z",
+            "content": {"survey": [{"type": "start", "name": "start"}, {"type": "end", "name": "end"}]
+                        + stub.fields},
+        }
+        self._send(200, json.dumps(asset).encode(), "application/json", {"ETag": etag})
+
+    def _send_data_page(self, query):
+        stub = self.server.stub
+        limit = int((query.get("limit") or ["100"])[0])
+        start = int((query.get("start") or ["0"])[0])
+        with stub.lock:
+            records = stub.data[start:start + limit]
+            total = len(stub.data)
+        fields = json.loads((query.get("fields") or ["null"])[0])
+        if fields:
+            records = [{k: r[k] for k in fields if k in r} for r in records]
+        nxt = None
+        if start + limit < total:
+            # like KPI, "next" keeps the rest of the query (fields, format)
+            rest = {k: v[0] for k, v in query.items()}
+            rest.update(start=start + limit, limit=limit)
+            nxt = f"http://{self.headers.get('Host')}{urlparse(self.path).path}?{urlencode(rest)}"
+        page = {"count": total, "next": nxt, "previous": None, "results": records}
+        self._send(200, json.dumps(page).encode(), "application/json")
+
+
+class StubKoboServer:
+    """
+    Threaded stub server on 127.0.0.1; use as a context manager.
+    latency: seconds added to every request (plus up to latency_jitter)
+    error_rate: fraction of submissions answered with 503
+    data: records served by the /data/ endpoint
+    record_data: also add each accepted submission to data, as KPI would list it
+    """
+
+    def __init__(self, latency=0.0, latency_jitter=0.0, error_rate=0.0, fields=None,
+                 data=None, keep_bodies=False, record_data=False, port=0):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.fields = fields if fields is not None else DEFAULT_FIELDS
+        self.data = list(data or [])
+        self.keep_bodies = keep_bodies
+        self.record_data = record_data
+        self.bodies = []
+        self.instance_ids = set()
+        self.counts = {"submissions": 0, "errors": 0, "gets": 0}
+        self.lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", port), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.stub = self
+        self._thread = None
+
+    def _count(self, key):
+        with self.lock:
+            self.counts[key] += 1
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    ap = argparse.ArgumentParser(description="Serve the stub KoboToolbox endpoints.")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--latency", type=float, default=0.0)
+    ap.add_argument("--error-rate", type=float, default=0.0)
+    a = ap.parse_args()
+    srv = StubKoboServer(latency=a.latency, error_rate=a.error_rate, port=a.port).start()
+    print(f"Stub KoboToolbox server on {srv.base_url} (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        srv.stop()
@@ -0,0 +1,42 @@
+"""
+Synthetic clicker exports in the uploader's time,button1..button5 layout.
+"""
+import random
+from datetime import datetime, timedelta
+
+HEADER = "time,button1,button2,button3,button4,button5"
+
+
+def write_clicker_csv(path, rows, start=datetime(2025, 10, 22, 8, 0, 0), step_seconds=3,
+                      bad_rate=0.0, seed=0):
+    """
+    Write `rows` data rows one click interval apart.
+    bad_rate: fraction of rows with an unparseable time (exercises the [SKIP] path).
+    """
+    rng = random.Random(seed)
+    t = start
+    step = timedelta(seconds=step_seconds)
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        f.write(HEADER + "\n")
+        buf = []
+        for _ in range(rows):
+            stamp = "not a time" if bad_rate and rng.random() < bad_rate else t.strftime("%m/%d/%Y %H:%M:%S")
+            counts = ",".join(str(rng.randint(0, 9)) for _ in range(5))
+            buf.append(f"{stamp},{counts}\n")
+            t += step
+            if len(buf) >= 10000:
+                f.writelines(buf)
+                buf.clear()
+        f.writelines(buf)
+    return path
+
+
+if __name__ == "__main__":
+    import argparse
+
+    ap = argparse.ArgumentParser(description="Generate a synthetic clicker CSV.")
+    ap.add_argument("path")
+    ap.add_argument("--rows", type=int, default=1000)
+    ap.add_argument("--bad-rate", type=float, default=0.0)
+    a = ap.parse_args()
+    write_clicker_csv(a.path, a.rows, bad_rate=a.bad_rate)
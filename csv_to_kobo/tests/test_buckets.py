@@ -0,0 +1,84 @@
+"""
+iter_time_buckets: consecutive rows in the same window become one
+submission, with each field summed ("sum") or its last non-blank value kept
+("last"); a row going back to an earlier window starts a new bucket.
+
+    python -m pytest csv_to_kobo/tests
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import uploadInstances as U  # noqa: E402
+
+PLAN = U.RowPlan(["time", "button1", "button2"], {"button1": "button1", "button2": "button2"})
+
+
+def _rows(*rows):
+    # (time of day, button1, button2) -> parsed rows as iter_parsed_rows yields them
+    parser = U.get_time_parser()
+    return [(i + 1, [t, b1, b2], parser.parse(f"10/22/2025 {t}"), None) for i, (t, b1, b2) in enumerate(rows)]
+
+
+def _buckets(rows, how, window=60):
+    return [(idx, start[11:19], end[11:19], values)
+            for idx, start, end, values, _ in U.iter_time_buckets(iter(rows), PLAN, window, how)]
+
+
+def test_sum_per_window():
+    rows = _rows(("08:00:01", "1", ""), ("08:00:30", "2", "1"), ("08:00:59", "", "1"),
+                 ("08:01:00", "5", "0"), ("08:03:10", "1.5", "2"))
+    assert _buckets(rows, "sum") == [
+        (1, "08:00:01", "08:00:59", ("3", "2")),
+        (4, "08:01:00", "08:01:00", ("5", "0")),
+        (5, "08:03:10", "08:03:10", ("1.5", "2")),
+    ]
+
+
+def test_last_per_window():
+    rows = _rows(("08:00:01", "1", "a"), ("08:00:30", "2", ""), ("08:00:59", "", "c"),
+                 ("08:01:00", "", ""))
+    assert _buckets(rows, "last") == [
+        (1, "08:00:01", "08:00:59", ("2", "c")),
+        (4, "08:01:00", "08:01:00", ("", "")),
+    ]
+
+
+@pytest.mark.parametrize("how", U.BUCKET_MODES)
+def test_time_going_back_starts_a_new_bucket(how):
+    rows = _rows(("08:05:10", "1", "1"), ("08:05:20", "1", "1"), ("08:01:00", "1", "1"),
+                 ("08:05:30", "1", "1"))
+    assert [(idx, start, end) for idx, start, end, _ in _buckets(rows, how)] == [
+        (1, "08:05:10", "08:05:20"),
+        (3, "08:01:00", "08:01:00"),
+        (4, "08:05:30", "08:05:30"),  # same window as the first bucket, but not adjacent to it
+    ]
+
+
+def test_bad_value_is_skipped_in_sum_mode():
+    rows = _rows(("08:00:01", "1", "1"), ("08:00:02", "x", "1"), ("08:00:03", "2", "1"))
+    out = list(U.iter_time_buckets(iter(rows), PLAN, 60, "sum"))
+    assert out[0][0] == 2 and "bad value 'x' for button1" in out[0][4]
+    assert out[1][3] == ("3", "2")
+
+
+def test_skips_pass_through():
+    rows = _rows(("08:00:01", "1", "1"))
+    rows.insert(0, (9, ["bad"], None, "[SKIP] Row 9: bad time"))
+    out = list(U.iter_time_buckets(iter(rows), PLAN, 60, "sum"))
+    assert out[0] == (9, None, None, None, "[SKIP] Row 9: bad time")
+    assert out[1][3] == ("1", "1")
+
+
+@pytest.mark.parametrize("text,seconds", [("90", 90), ("30s", 30), ("5m", 300), ("1h", 3600), ("1d", 86400)])
+def test_parse_window(text, seconds):
+    assert U.parse_window(text) == seconds
+
+
+@pytest.mark.parametrize("text", ["0", "-5m", "x", "", "infm", "nan"])
+def test_parse_window_rejects(text):
+    with pytest.raises(ValueError):
+        U.parse_window(text)
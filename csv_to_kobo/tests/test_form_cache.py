@@ -0,0 +1,60 @@
+"""
+FormDefinitionCache with kf_get_custom_fields against the stub server: a
+fresh entry needs no request, a stale one is revalidated with its ETag, and
+entries are kept per account.
+
+    python -m pytest csv_to_kobo/tests
+"""
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), "benchmarks"))
+
+import uploadInstances as U  # noqa: E402
+from stub_server import StubKoboServer  # noqa: E402
+
+FORM_ID = "aTestForm1234567890abc"
+
+
+def _fields(server, cache, username="u", **kw):
+    return U.kf_get_custom_fields(server.base_url, FORM_ID, username, "p", cache=cache, **kw)
+
+
+def test_fresh_entry_needs_no_request(tmp_path):
+    cache = U.FormDefinitionCache(str(tmp_path))
+    with StubKoboServer() as server:
+        first = _fields(server, cache)
+        assert [f["name"] for f in first] == [f"button{i}" for i in range(1, 6)]
+        assert _fields(server, cache) == first
+        assert server.counts["gets"] == 1
+    entry = cache.load(server.base_url, FORM_ID, "u")
+    assert entry["etag"] == '"stub-form-v1"'
+    assert set(entry) == {"fields", "etag", "last_modified", "fetched_at"}
+
+
+def test_stale_entry_is_revalidated(tmp_path):
+    with StubKoboServer() as server:
+        first = _fields(server, U.FormDefinitionCache(str(tmp_path)))
+        stale = U.FormDefinitionCache(str(tmp_path), max_age=0)
+        server.fields = []  # a full fetch would now return no fields
+        assert _fields(server, stale) == first  # 304: the cached fields are kept
+        assert server.counts["gets"] == 2
+
+
+def test_offline_uses_cache_only(tmp_path):
+    cache = U.FormDefinitionCache(str(tmp_path))
+    with StubKoboServer() as server:
+        first = _fields(server, cache)
+        base = server.base_url
+    assert U.kf_get_custom_fields(base, FORM_ID, "u", "p", cache=cache, offline=True) == first
+
+
+def test_entries_are_per_account(tmp_path):
+    cache = U.FormDefinitionCache(str(tmp_path))
+    with StubKoboServer() as server:
+        _fields(server, cache, "alice")
+        _fields(server, cache, "bob")
+        assert server.counts["gets"] == 2
+    assert cache.load(server.base_url, FORM_ID, "carol") is None
@@ -0,0 +1,61 @@
+"""
+The XIAO logger's data.csv has no clock of its own: it needs the time it was
+switched on, one per power-on, and never guesses one from the file.
+
+    python -m pytest csv_to_kobo/tests
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import uploadInstances as U  # noqa: E402
+
+TZ = "America/New_York"
+
+
+def _xiao(tmp_path):
+    path = str(tmp_path / "data.csv")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("t_ms,b1,b2,b3,b4\n1000,1,0,0,0\n2500,0,1,0,0\n500,0,0,1,0\n400,0,0,0,1\n")
+    return path
+
+
+def _times(fmt):
+    clock = fmt.time_parser()
+    out = []
+    for ms in ("1000", "2500", "500", "400"):
+        try:
+            out.append(clock.parse(ms))
+        except ValueError:
+            out.append(None)
+    return out
+
+
+def test_xiao_needs_session_start(tmp_path):
+    with pytest.raises(ValueError, match="session start"):
+        U.detect_input_format(_xiao(tmp_path), tz_name=TZ)
+
+
+def test_xiao_one_start_per_power_on(tmp_path):
+    starts = U.parse_session_starts("10/22/2025 08:00:00; 10/22/2025 13:30:00", TZ)
+    fmt = U.detect_input_format(_xiao(tmp_path), tz_name=TZ, session_start=starts)
+    assert isinstance(fmt, U.FirmwareSdFormat)
+    assert _times(fmt) == ["2025-10-22T08:00:01.000-04:00", "2025-10-22T08:00:02.500-04:00",
+                           "2025-10-22T13:30:00.500-04:00", None]  # third power-on: no start given
+
+
+def test_single_start_dates_first_power_on_only(tmp_path):
+    start = U.parse_session_start("10/22/2025 08:00:00", TZ)
+    fmt = U.detect_input_format(_xiao(tmp_path), tz_name=TZ, session_start=start)
+    assert _times(fmt)[:2] == ["2025-10-22T08:00:01.000-04:00", "2025-10-22T08:00:02.500-04:00"]
+    assert _times(fmt)[2:] == [None, None]
+
+
+def test_session_starts_round_trip():
+    text = "10/22/2025 08:00:00; 10/23/2025 09:15:30"
+    assert U.format_session_starts(U.parse_session_starts(text, TZ)) == text
+    with pytest.raises(ValueError):
+        U.parse_session_starts(" ; ", TZ)
@@ -0,0 +1,81 @@
+"""
+instanceIDs are uuid5s of the row (form, time, mapped values, occurrence):
+the same CSV gives the same IDs on every run, identical rows get distinct
+IDs, and a rerun skips what the journal says was acknowledged.
+
+    python -m pytest csv_to_kobo/tests
+"""
+import os
+import sys
+import uuid
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), "benchmarks"))
+
+import uploadInstances as U  # noqa: E402
+from stub_server import StubKoboServer  # noqa: E402
+
+FORM_ID = "aTestForm1234567890abc"
+LINK = f"https://kf.kobotoolbox.org/#/forms/{FORM_ID}"
+MAPPING = {"button1": "button1", "button2": "button2"}
+ROWS = ["10/22/2025 08:00:01,1,0", "10/22/2025 08:00:01,1,0", "10/22/2025 08:00:02,0,1",
+        "10/22/2025 08:00:01,1,0"]
+
+
+def _write(path, header="Time,Button1,Button2", rows=ROWS):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(header + "\n" + "".join(r + "\n" for r in rows))
+    return path
+
+
+def _upload(csv_path, output_root, **kw):
+    records = []
+    with StubKoboServer() as server:
+        U.run_upload_dynamic("u", "p", LINK, csv_path, output_root, MAPPING, kc_base=server.base_url,
+                             output_format="none", on_record=records.append, **kw)
+        submitted = server.counts["submissions"]
+    return [r["instance_id"] for r in records], [r["status"] for r in records], submitted
+
+
+def test_ids_are_stable_and_distinct(tmp_path):
+    csv_path = _write(str(tmp_path / "clicks.csv"))
+    first, _, _ = _upload(csv_path, str(tmp_path / "a"), resume=False)
+    again, _, _ = _upload(csv_path, str(tmp_path / "b"), resume=False)
+    assert first == again
+    assert len(set(first)) == len(ROWS)  # identical rows 1, 2 and 4 differ by occurrence
+    assert all(uuid.UUID(i).version == 5 for i in first)
+
+
+def test_ids_ignore_column_order(tmp_path):
+    ids, _, _ = _upload(_write(str(tmp_path / "a.csv")), str(tmp_path / "a"), resume=False)
+    swapped = [f"{t},{b2},{b1}" for t, b1, b2 in (r.split(",") for r in ROWS)]
+    other, _, _ = _upload(_write(str(tmp_path / "b.csv"), "Time,Button2,Button1", swapped),
+                          str(tmp_path / "b"), resume=False)
+    assert ids == other
+
+
+def test_occurrences_number_identical_rows():
+    plan = U.RowPlan(["time", "button1", "button2"], MAPPING)
+    iso = "2025-10-22T08:00:01-04:00"
+    ids = [plan.instance_uuid(FORM_ID, iso, ("1", "0"), n) for n in range(3)]
+    assert len(set(ids)) == 3
+    assert ids[0] == plan.instance_uuid(FORM_ID, iso, ("1", "0"), 0)
+
+
+def test_rerun_skips_journaled_rows(tmp_path):
+    csv_path = _write(str(tmp_path / "clicks.csv"))
+    out = str(tmp_path / "out")
+    ids, statuses, submitted = _upload(csv_path, out)
+    assert submitted == len(ROWS) and set(statuses) == {"submitted"}
+    assert U.load_journal_ids(U.journal_path_for(out, FORM_ID)) == set(ids)
+
+    again, statuses, submitted = _upload(csv_path, out)
+    assert again == ids
+    assert submitted == 0 and set(statuses) == {"skipped"}
+
+    # One more identical row: only it is sent
+    _write(csv_path, rows=ROWS + ["10/22/2025 08:00:01,1,0"])
+    more, statuses, submitted = _upload(csv_path, out)
+    assert more[:len(ROWS)] == ids and submitted == 1
+    assert statuses == ["skipped"] * len(ROWS) + ["submitted"]
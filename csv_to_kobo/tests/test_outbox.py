@@ -0,0 +1,97 @@
+"""
+The outbox: rows captured offline are drained later; acknowledged rows are
+marked acked, transient failures stay pending for the next drain, rejected
+rows are kept as failed, and nothing is captured twice.
+
+    python -m pytest csv_to_kobo/tests
+"""
+import os
+import sys
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), "benchmarks"))
+
+import uploadInstances as U  # noqa: E402
+from stub_server import StubKoboServer  # noqa: E402
+
+FORM_ID = "aTestForm1234567890abc"
+LINK = f"https://kf.kobotoolbox.org/#/forms/{FORM_ID}"
+MAPPING = {"button1": "button1", "button2": "button2"}
+
+
+def _csv(path, rows=3):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("Time,Button1,Button2\n")
+        for i in range(rows):
+            f.write(f"10/22/2025 08:00:{i:02d},{i},1\n")
+    return path
+
+
+def _capture(tmp_path, server, box_path, rows=3):
+    U.run_upload_dynamic("u", "p", LINK, _csv(str(tmp_path / "clicks.csv"), rows), str(tmp_path / "out"),
+                         MAPPING, kc_base=server.base_url, output_format="none", outbox=box_path,
+                         capture_only=True)
+
+
+def _counts(box_path):
+    box = U.Outbox(box_path)
+    try:
+        return box.counts()
+    finally:
+        box.close()
+
+
+def test_capture_then_drain(tmp_path):
+    box_path = str(tmp_path / "outbox.sqlite")
+    with StubKoboServer() as server:
+        _capture(tmp_path, server, box_path)
+        assert server.counts["submissions"] == 0
+        assert _counts(box_path) == {"pending": 3, "acked": 0, "failed": 0}
+
+        # Capturing the same CSV again adds nothing
+        _capture(tmp_path, server, box_path)
+        assert _counts(box_path)["pending"] == 3
+
+        U.run_outbox_drain("u", "p", box_path)
+        assert server.counts["submissions"] == 3
+        assert _counts(box_path) == {"pending": 0, "acked": 3, "failed": 0}
+
+        # Nothing left to send
+        U.run_outbox_drain("u", "p", box_path)
+        assert server.counts["submissions"] == 3
+
+
+def test_transient_failure_stays_pending(tmp_path):
+    box_path = str(tmp_path / "outbox.sqlite")
+    with StubKoboServer() as server:
+        _capture(tmp_path, server, box_path)
+        server.error_rate = 1.0  # every submission answered 503
+        U.run_outbox_drain("u", "p", box_path, max_attempts=1)
+        assert server.counts["errors"] == 3
+        assert _counts(box_path) == {"pending": 3, "acked": 0, "failed": 0}
+
+        server.error_rate = 0.0
+        U.run_outbox_drain("u", "p", box_path)
+        assert _counts(box_path) == {"pending": 0, "acked": 3, "failed": 0}
+
+
+def test_rejected_row_is_failed(tmp_path):
+    box_path = str(tmp_path / "outbox.sqlite")
+    with StubKoboServer() as server:
+        _capture(tmp_path, server, box_path, rows=2)
+    box = U.Outbox(box_path)
+    try:
+        (job, _, _), (other, _, _) = list(box.iter_pending(box.pending_urls()[0]))
+        rejected = requests.Response()
+        rejected.status_code = 400
+        rejected._content = b"bad form"
+        box.record(job.instance_id, U.SubmitOutcome(rejected, None, 1, 0.0), retryable=False)
+        box.record(other.instance_id, U.SubmitOutcome(None, requests.ConnectionError("down"), 1, 0.0),
+                   retryable=True)
+        assert box.counts() == {"pending": 1, "acked": 0, "failed": 1}
+        assert [j.instance_id for j, _, _ in box.iter_pending(box.pending_urls()[0])] == [other.instance_id]
+    finally:
+        box.close()
@@ -0,0 +1,87 @@
+"""
+iter_csv_rows_parallel must yield exactly what iter_csv_rows does, wherever
+the file is cut: quoted line breaks (LF and CRLF), escaped quotes, blank
+lines, short rows and a missing final newline.
+
+    python -m pytest csv_to_kobo/tests
+"""
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import uploadInstances as U  # noqa: E402
+
+CHUNK_SIZES = [1, 2, 3, 5, 7, 16, 64, 333, 1024, 4096, 100_000]
+
+
+def _cell(rng):
+    kind = rng.randrange(8)
+    if kind == 0:
+        return '"multi\r\nline, ""quoted"""'
+    if kind == 1:
+        return '"a\nb\n\nc"'
+    if kind == 2:
+        return '""'
+    if kind == 3:
+        return '"comma, inside"'
+    return str(rng.randrange(1000))
+
+
+def _write_csv(path, rows, seed, newline="\n", final_newline=True):
+    rng = random.Random(seed)
+    lines = ["\ufeffTime,Button1,Button2,Note"]
+    for i in range(rows):
+        kind = rng.randrange(20)
+        if kind == 0:
+            lines.append("")  # blank line: not a row
+        elif kind == 1:
+            lines.append(f"10/22/2025 08:{i // 60 % 60:02d}:{i % 60:02d},1")  # short row
+        else:
+            cells = [_cell(rng) for _ in range(3)]
+            lines.append(f"10/22/2025 08:{i // 60 % 60:02d}:{i % 60:02d}," + ",".join(cells))
+    text = newline.join(lines) + (newline if final_newline else "")
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        f.write(text)
+    return path
+
+
+def _serial(path):
+    return [(idx, tuple(row)) for idx, row in U.iter_csv_rows(path)]
+
+
+@pytest.mark.parametrize("chunk_bytes", CHUNK_SIZES)
+@pytest.mark.parametrize("newline,final_newline", [("\n", True), ("\r\n", True), ("\n", False)])
+def test_parallel_rows_match_serial(tmp_path, chunk_bytes, newline, final_newline):
+    rows = 60 if chunk_bytes < 16 else 3000
+    path = _write_csv(str(tmp_path / "clicks.csv"), rows, seed=chunk_bytes, newline=newline,
+                      final_newline=final_newline)
+    expected = _serial(path)
+    got = list(U.iter_csv_rows_parallel(path, processes=2, chunk_bytes=chunk_bytes))
+    assert got == expected
+
+
+def test_header_only(tmp_path):
+    path = str(tmp_path / "empty.csv")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("Time,Button1\n")
+    assert list(U.iter_csv_rows_parallel(path, processes=2, chunk_bytes=1)) == []
+
+
+def test_missing_time_column(tmp_path):
+    path = str(tmp_path / "bad.csv")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("When,Button1\n1,2\n")
+    with pytest.raises(ValueError):
+        list(U.iter_csv_rows_parallel(path, processes=2))
+
+
+def test_validation_report_matches_serial(tmp_path):
+    path = _write_csv(str(tmp_path / "clicks.csv"), 3000, seed=7, newline="\r\n")
+    serial = U.validate_csv(path)
+    parallel = U.validate_csv(path, processes=2)
+    assert parallel.rows == serial.rows
+    assert parallel.problems == serial.problems
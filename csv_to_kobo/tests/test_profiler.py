@@ -0,0 +1,31 @@
+"""
+ThreadProfiler (--profile) includes the work done on threads started while
+it is enabled, not only the main thread's.
+
+    python -m pytest csv_to_kobo/tests
+"""
+import os
+import pstats
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import uploadInstances as U  # noqa: E402
+
+
+def _worker_only(n):
+    return sum(i * i for i in range(n))
+
+
+def test_worker_threads_are_profiled(tmp_path):
+    profiler = U.ThreadProfiler()
+    profiler.enable()
+    with ThreadPoolExecutor(4) as pool:
+        assert len(list(pool.map(_worker_only, [1000] * 8))) == 8
+    profiler.disable()
+    path = str(tmp_path / "upload.prof")
+    profiler.dump_stats(path)
+
+    calls = {func[2]: stat[1] for func, stat in pstats.Stats(path).stats.items()}
+    assert calls.get("_worker_only") == 8
@@ -0,0 +1,122 @@
+"""
+submit_with_retry against a scripted server: 503 and 429 are retried (after
+the server's Retry-After, capped), 400 is final on the first attempt, and
+the shared CircuitBreaker opens after consecutive failures.
+
+    python -m pytest csv_to_kobo/tests
+"""
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import uploadInstances as U  # noqa: E402
+
+
+class _Scripted(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        server = self.server
+        with server.lock:
+            status, headers = server.script.pop(0) if server.script else (201, {})
+            server.seen.append(time.monotonic())
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Scripted)
+    httpd.daemon_threads = True
+    httpd.lock = threading.Lock()
+    httpd.script = []
+    httpd.seen = []
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    httpd.url = f"http://127.0.0.1:{httpd.server_address[1]}/submission"
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _submit(server, policy, breaker=None):
+    with requests.Session() as session:
+        return U.submit_with_retry(session, server.url, b"<x/>", "text/xml", policy=policy, breaker=breaker)
+
+
+def test_retries_503_then_succeeds(server):
+    server.script = [(503, {}), (503, {})]
+    outcome = _submit(server, U.RetryPolicy(max_attempts=5, base_delay=0.01, max_delay=0.02))
+    assert outcome.response.status_code == 201
+    assert outcome.attempts == 3
+
+
+def test_429_waits_for_retry_after(server):
+    server.script = [(429, {"Retry-After": "1"})]
+    outcome = _submit(server, U.RetryPolicy(max_attempts=3, base_delay=0.01))
+    assert outcome.response.status_code == 201 and outcome.attempts == 2
+    assert server.seen[1] - server.seen[0] >= 0.9
+
+
+def test_retry_after_is_capped(server):
+    server.script = [(503, {"Retry-After": "3600"})]
+    started = time.monotonic()
+    outcome = _submit(server, U.RetryPolicy(max_attempts=2, max_retry_after=0.2))
+    assert outcome.response.status_code == 201
+    assert time.monotonic() - started < 5
+
+
+def test_400_is_not_retried(server):
+    server.script = [(400, {}), (201, {})]
+    outcome = _submit(server, U.RetryPolicy(max_attempts=5, base_delay=0.01))
+    assert outcome.response.status_code == 400
+    assert outcome.attempts == 1 and len(server.seen) == 1
+
+
+def test_gives_up_after_max_attempts(server):
+    server.script = [(503, {})] * 10
+    outcome = _submit(server, U.RetryPolicy(max_attempts=3, base_delay=0.01, max_delay=0.01))
+    assert outcome.response.status_code == 503 and outcome.attempts == 3
+
+
+def test_breaker_opens_and_pauses(server):
+    pauses = []
+    breaker = U.CircuitBreaker(failure_threshold=3, cooldown=0.5, on_open=pauses.append)
+    server.script = [(503, {})] * 3
+    outcome = _submit(server, U.RetryPolicy(max_attempts=4, base_delay=0.01, max_delay=0.01), breaker)
+    assert outcome.response.status_code == 201 and outcome.attempts == 4
+    assert pauses == [0.5]
+    # The fourth attempt waited out the cooldown
+    assert server.seen[3] - server.seen[2] >= 0.45
+
+
+def test_breaker_cooldown_doubles_and_resets():
+    pauses = []
+    breaker = U.CircuitBreaker(failure_threshold=1, cooldown=0.01, max_cooldown=0.03, on_open=pauses.append)
+    for _ in range(3):
+        breaker.record_failure()
+        breaker.wait()
+    assert pauses == [0.01, 0.02, 0.03]
+    breaker.record_success()
+    breaker.record_failure()
+    assert pauses[-1] == 0.01
+
+
+@pytest.mark.parametrize("value,expected", [("5", 5.0), ("", None), ("soon", None), ("-1", None),
+                                            ("²", None),
+                                            ("Wed, 21 Oct 2015 07:28:00 GMT", 0.0)])
+def test_parse_retry_after(value, expected):
+    assert U.parse_retry_after(value) == expected
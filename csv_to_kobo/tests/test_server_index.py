@@ -0,0 +1,77 @@
+"""
+kf_fetch_server_index / ServerIndex.claim against the stub server: every page
+of /data/ is read, rows match by instanceID or by start + values, and n
+identical rows are kept against n-1 identical submissions.
+
+    python -m pytest csv_to_kobo/tests
+"""
+import os
+import sys
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), "benchmarks"))
+
+import uploadInstances as U  # noqa: E402
+from stub_server import StubKoboServer  # noqa: E402
+
+FORM_ID = "aTestForm1234567890abc"
+LINK = f"https://kf.kobotoolbox.org/#/forms/{FORM_ID}"
+FIELDS = ("button1", "button2")
+
+
+def _record(i, start, button1="1", button2="0"):
+    return {"meta/instanceID": f"uuid:server-{i}", "start": start, "button1": button1, "button2": button2,
+            "end": start, "_id": i}
+
+
+@pytest.fixture
+def stub():
+    data = [_record(i, f"2025-10-01T08:{i // 60:02d}:{i % 60:02d}-04:00") for i in range(25)]
+    with StubKoboServer(data=data) as server:
+        yield server
+
+
+def test_reads_every_page(stub):
+    index = U.kf_fetch_server_index(stub.base_url, FORM_ID, "u", "p", FIELDS, page_size=10)
+    assert index.records == 25
+    assert stub.counts["gets"] == 3
+    assert index.instance_ids == {f"server-{i}" for i in range(25)}
+
+
+def test_claim_by_instance_id(stub):
+    index = U.kf_fetch_server_index(stub.base_url, FORM_ID, "u", "p", FIELDS, page_size=10)
+    assert index.claim("server-7", "2030-01-01T00:00:00+00:00", ("9", "9"))
+    assert not index.claim("not-there", "2030-01-01T00:00:00+00:00", ("9", "9"))
+
+
+def test_claim_by_start_and_values(stub):
+    index = U.kf_fetch_server_index(stub.base_url, FORM_ID, "u", "p", FIELDS, page_size=10)
+    # Same instant written with another offset and precision
+    assert index.claim("new-id", "2025-10-01T12:00:03.000+00:00", ("1", "0"))
+    assert not index.claim("new-id-2", "2025-10-01T12:00:04+00:00", ("1", "1"))
+
+
+def test_identical_rows_claimed_once_each():
+    start = "2025-10-22T08:00:01-04:00"
+    index = U.ServerIndex(FIELDS)
+    for i in range(2):
+        index.add(_record(i, start))
+    claims = [index.claim(f"local-{i}", start, ("1", "0")) for i in range(3)]
+    assert claims == [True, True, False]
+
+
+def test_upload_keeps_the_extra_identical_row(tmp_path):
+    csv_path = str(tmp_path / "clicks.csv")
+    with open(csv_path, "w", encoding="utf-8") as f:
+        f.write("Time,Button1,Button2\n" + "10/22/2025 08:00:01,1,0\n" * 3 + "10/22/2025 08:00:02,0,1\n")
+    data = [_record(i, "2025-10-22T08:00:01-04:00") for i in range(2)]
+    statuses = []
+    with StubKoboServer(data=data) as server:
+        U.run_upload_dynamic("u", "p", LINK, csv_path, str(tmp_path / "out"), {f: f for f in FIELDS},
+                             kc_base=server.base_url, kf_base=server.base_url, dedupe=True, resume=False,
+                             output_format="none", on_record=lambda rec: statuses.append(rec["status"]))
+        assert server.counts["submissions"] == 2
+    assert sorted(statuses) == ["skipped", "skipped", "submitted", "submitted"]
@@ -0,0 +1,90 @@
+"""
+The local upload service's JSON API: bad requests get a 400 (not a dropped
+connection or a 502), form fields come through the shared cache, and a job
+runs to the end against the stub server.
+
+    python -m pytest csv_to_kobo/tests
+"""
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer
+
+import pytest
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), "benchmarks"))
+
+import uploadInstances as U  # noqa: E402
+from stub_server import StubKoboServer  # noqa: E402
+
+FORM_ID = "aTestForm1234567890abc"
+LINK = f"https://kf.kobotoolbox.org/#/forms/{FORM_ID}"
+
+
+@pytest.fixture
+def stub():
+    with StubKoboServer() as server:
+        yield server
+
+
+@pytest.fixture
+def service(tmp_path):
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), U._ServiceHandler)
+    httpd.daemon_threads = True
+    httpd.service = U.UploadService(4, cache=U.FormDefinitionCache(str(tmp_path / "cache")))
+    httpd.service_token = "test-token"
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    client = U.ServiceClient(httpd.server_address[1], httpd.service_token)
+    yield client
+    httpd.shutdown()
+    httpd.server_close()
+    httpd.service.shutdown()
+
+
+def _raw(client, method, path, **kw):
+    return client._http.request(method, client.base + path, timeout=10, **kw)
+
+
+def test_token_required(service):
+    r = requests.get(service.base + "/health", timeout=10)
+    assert r.status_code == 401
+
+
+@pytest.mark.parametrize("payload", [{}, {"username": "u", "password": "p"},
+                                     {"username": "u", "password": "p", "link": "https://example.org/x"}])
+def test_forms_bad_request_is_400(service, payload):
+    assert _raw(service, "POST", "/forms", json=payload).status_code == 400
+
+
+def test_forms_server_error_is_502(service):
+    # Nothing listens on port 9 of localhost: the fetch itself fails
+    r = _raw(service, "POST", "/forms", json={"username": "u", "password": "p", "link": LINK,
+                                              "kf_base": "http://127.0.0.1:9"})
+    assert r.status_code == 502
+
+
+def test_form_fields_from_many_threads(service, stub):
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda _: service.form_fields("u", "p", LINK, stub.base_url), range(16)))
+    assert all(r == results[0] for r in results)
+    assert [f["name"] for f in results[0]] == [f"button{i}" for i in range(1, 6)]
+
+
+def test_job_runs_and_bad_since_is_400(service, stub, tmp_path):
+    csv_path = str(tmp_path / "clicks.csv")
+    with open(csv_path, "w", encoding="utf-8") as f:
+        f.write("Time,Button1\n10/22/2025 08:00:01,1\n10/22/2025 08:00:02,2\n")
+    job = service.submit(username="u", password="p", link=LINK, csv=csv_path, output=str(tmp_path / "out"),
+                         mapping={"button1": "button1"}, kc_base=stub.base_url, kf_base=stub.base_url,
+                         output_format="none")
+    status = service.follow(job["id"], poll_interval=0.05)
+    assert status["state"] == "done", status
+    assert stub.counts["submissions"] == 2
+
+    for since in ("abc", "-1", "1.5"):
+        assert _raw(service, "GET", f"/jobs/{job['id']}", params={"since": since}).status_code == 400
+    assert len(service.status(job["id"], since=0)["messages"]) > 0
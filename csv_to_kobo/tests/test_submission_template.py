@@ -0,0 +1,59 @@
+"""
+SubmissionTemplate.render must produce exactly the bytes
+build_instance_xml_dynamic does, for any values (empty, None, markup,
+non-ASCII) and any set of fields.
+
+    python -m pytest csv_to_kobo/tests
+"""
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import uploadInstances as U  # noqa: E402
+
+VALUES = ["", None, "0", "42", " 7 ", "a & b", "<tag>", "x > y", '"quoted"', "it's", "é ü 🙂",
+          "line\nbreak", "tab\tand\r", "]]>", "2025-10-22T08:00:05-04:00", "2025-10-22T08:00:05.123-04:00"]
+
+
+def _both(field_names, start, end, values, instance_id):
+    mapped = dict(zip(field_names, values))
+    expected = U.build_instance_xml_dynamic("formX", "formX", start, end, mapped, instance_id)
+    got = U.SubmissionTemplate("formX", "formX", field_names).render(start, end, mapped, instance_id)
+    return expected, got
+
+
+@pytest.mark.parametrize("field_names", [[], ["button1"], ["button1", "button2", "Red_Button", "notes"]])
+def test_render_matches_elementtree(field_names):
+    rng = random.Random(len(field_names))
+    for _ in range(300):
+        start, end = rng.choice(VALUES), rng.choice(VALUES)
+        values = [rng.choice(VALUES) for _ in field_names]
+        expected, got = _both(field_names, start, end, values, "0b7e7b8a-0000-5000-8000-000000000000")
+        assert got == expected
+
+
+@pytest.mark.parametrize("start,end", [("", ""), (None, None), ("", "2025-10-22T08:00:05-04:00")])
+def test_empty_start_and_end(start, end):
+    expected, got = _both(["button1"], start, end, [""], "id")
+    assert got == expected
+
+
+def test_render_values_is_render():
+    names = ["b", "a"]
+    template = U.SubmissionTemplate("f", "f", names)
+    assert (template.render_values("s", "e", ("1", "2"), "id")
+            == template.render("s", "e", {"a": "2", "b": "1"}, "id"))
+
+
+def test_multipart_wraps_xml():
+    template = U.SubmissionTemplate("f", "f", ["a"])
+    xml = template.render("s", "e", {"a": "1"}, "id")
+    body = template.multipart(xml, display_name='in"stance\r\n1.xml')
+    assert xml in body
+    assert b'filename="in%22stance%0D%0A1.xml"' in body
+    assert body.endswith(f"\r\n--{template.boundary}--\r\n".encode())
+    assert template.content_type == f"multipart/form-data; boundary={template.boundary}"
@@ -0,0 +1,71 @@
+"""
+CsvTimeParser's cached-offset path must give exactly what the plain
+strptime + zoneinfo conversion gives, on DST transition days included, and
+reject what strptime rejects.
+
+    python -m pytest csv_to_kobo/tests
+"""
+import os
+import sys
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import uploadInstances as U  # noqa: E402
+
+# Zones with DST on different dates, one with a 30-minute shift, and one without DST
+ZONES = ["America/New_York", "Europe/London", "Australia/Lord_Howe", "America/Sao_Paulo", "Asia/Kolkata", "UTC"]
+
+
+def _reference(s, tz_name):
+    return datetime.strptime(s, U.CSV_TIME_FORMAT).replace(tzinfo=ZoneInfo(tz_name)).isoformat(timespec="seconds")
+
+
+def _transition_days(tz_name, year=2025):
+    tz = ZoneInfo(tz_name)
+    day = datetime(year, 1, 1)
+    days = []
+    while day.year == year:
+        start = day.replace(tzinfo=tz).utcoffset()
+        end = day.replace(hour=23, minute=59, second=59, tzinfo=tz).utcoffset()
+        if start != end:
+            days.append(day)
+        day += timedelta(days=1)
+    return days
+
+
+@pytest.mark.parametrize("tz_name", ZONES)
+def test_transition_days_match_strptime(tz_name):
+    days = _transition_days(tz_name) or [datetime(2025, 3, 9)]
+    parser = U.get_time_parser(tz_name)
+    for day in days:
+        # Every minute of the day, and the neighbouring days (cached offsets) around it
+        for minute in range(-24 * 60, 48 * 60, 7):
+            t = day + timedelta(minutes=minute, seconds=minute % 60)
+            s = t.strftime(U.CSV_TIME_FORMAT)
+            assert parser.parse(s) == _reference(s, tz_name), s
+
+
+def test_known_transitions():
+    parser = U.get_time_parser("America/New_York")
+    # Spring forward: 02:30 does not exist; fall back: 01:30 happens twice (fold=0, EDT)
+    assert parser.parse("03/09/2025 01:59:59") == "2025-03-09T01:59:59-05:00"
+    assert parser.parse("03/09/2025 03:00:00") == "2025-03-09T03:00:00-04:00"
+    assert parser.parse("03/09/2025 02:30:00") == _reference("03/09/2025 02:30:00", "America/New_York")
+    assert parser.parse("11/02/2025 01:30:00") == "2025-11-02T01:30:00-04:00"
+    assert parser.parse("11/02/2025 02:00:00") == "2025-11-02T02:00:00-05:00"
+
+
+@pytest.mark.parametrize("s", ["3/9/2025 1:02:03", " 10/22/2025  08:00:01 ", "10/22/2025\t08:00:01"])
+def test_loose_forms_match_strptime(s):
+    assert U.get_time_parser().parse(s) == _reference(s.strip(), U.DEFAULT_TIMEZONE)
+
+
+@pytest.mark.parametrize("s", ["02/30/2025 08:00:00", "13/01/2025 08:00:00", "10/22/2025 24:00:00",
+                               "١٠/٢٢/٢٠٢٥ ٠٨:٠٠:٠١", "10/22/2025", ""])
+def test_rejects_what_strptime_rejects(s):
+    with pytest.raises(ValueError):
+        U.get_time_parser().parse(s)
@@ -0,0 +1,48 @@
+"""
+validate_csv's numeric checks agree with the coercion the upload applies:
+"²" is not a number (str.isdigit() says it is), and a column of plain ASCII
+counts needs no per-value check.
+
+    python -m pytest csv_to_kobo/tests
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import uploadInstances as U  # noqa: E402
+
+
+def _report(tmp_path, values, chunk_rows=U.VALIDATION_CHUNK_ROWS):
+    path = str(tmp_path / "clicks.csv")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("Time,Button1\n")
+        for i, v in enumerate(values):
+            f.write(f"10/22/2025 08:00:{i:02d},{v}\n")
+    return U.validate_csv(path, chunk_rows=chunk_rows)
+
+
+@pytest.mark.parametrize("chunk_rows", [1, 1000])
+def test_superscript_digit_is_not_an_integer(tmp_path, chunk_rows):
+    report = _report(tmp_path, ["1", "²", "3"], chunk_rows)
+    assert report.problems[("not_integer", "button1")] == [1, [(2, "'²'")]]
+    assert report.problems[("not_decimal", "button1")] == [1, [(2, "'²'")]]
+    with pytest.raises(ValueError):
+        U.FIELD_COERCERS["integer"]("²")
+
+
+def test_values_the_upload_accepts_pass(tmp_path):
+    values = ["0", "12", " 7 ", "", "3.0", "٣"]
+    report = _report(tmp_path, values)
+    assert not [k for k in report.problems if k[0] == "not_integer"]
+    for v in values:
+        if v.strip():
+            U.FIELD_COERCERS["integer"](v.strip())
+
+
+def test_decimal_is_not_an_integer(tmp_path):
+    report = _report(tmp_path, ["1", "2.5"])
+    assert report.problems[("not_integer", "button1")][0] == 1
+    assert ("not_decimal", "button1") not in report.problems
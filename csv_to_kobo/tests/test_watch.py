@@ -0,0 +1,69 @@
+"""
+FollowedCsv (watch mode) reads only rows that are complete: a row written
+in two pieces is read once, whole; the Android export's last row, which
+never gets a newline, is taken once the file stops growing.
+
+    python -m pytest csv_to_kobo/tests
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import uploadInstances as U  # noqa: E402
+
+
+def _append(path, text):
+    with open(path, "a", encoding="utf-8", newline="") as f:
+        f.write(text)
+
+
+def _poll(follower, fmt, width):
+    # Two polls at the same size: settle=0 lets an unterminated tail be considered
+    rows = []
+    for _ in range(2):
+        rows += follower.read_rows(width, fmt.complete_tail)[1]
+    return rows
+
+
+def test_row_written_in_two_pieces(tmp_path):
+    path = str(tmp_path / "clicks.csv")
+    _append(path, "Time,Button1,Button2,Button3\n10/22/2025 08:00:01,1,2,3\n")
+    follower = U.FollowedCsv(path, settle=0)
+    header, rows = follower.read_rows()
+    fmt = U.detect_input_format(path, header)
+    assert [r for _, r in rows] == [["10/22/2025 08:00:01", "1", "2", "3"]]
+
+    _append(path, "10/22/2025 08:00:0")
+    assert _poll(follower, fmt, len(header)) == []
+
+    _append(path, "2,5,6\n")
+    assert _poll(follower, fmt, len(header)) == [(2, ["10/22/2025 08:00:02", "5", "6", ""])]
+
+
+def test_android_export_last_row(tmp_path):
+    path = str(tmp_path / "batches_1761148800000.csv")
+    _append(path, "Timestamp,Female,Male,Elderly\n10:00:00,1,0,0\n10:00:05,0,1")
+    follower = U.FollowedCsv(path, settle=0)
+    header, rows = follower.read_rows()
+    fmt = U.detect_input_format(path, header)
+    assert [idx for idx, _ in rows] == [1]
+
+    # Cells missing: still being written
+    assert _poll(follower, fmt, len(header)) == []
+
+    _append(path, ",2")
+    assert _poll(follower, fmt, len(header)) == [(2, ["10:00:05", "0", "1", "2"])]
+
+    # The next export appends after it; the leading newline is a blank line, not a row
+    _append(path, "\n10:00:09,1,1,1\n")
+    assert _poll(follower, fmt, len(header)) == [(3, ["10:00:09", "1", "1", "1"])]
+
+
+def test_tail_waits_for_settle(tmp_path):
+    path = str(tmp_path / "batches_1761148800000.csv")
+    _append(path, "Timestamp,Female,Male,Elderly\n10:00:00,1,0,0")
+    follower = U.FollowedCsv(path, settle=3600)
+    header, _ = follower.read_rows()
+    fmt = U.detect_input_format(path, header)
+    assert _poll(follower, fmt, len(header)) == []
@@ -1,20 +1,34 @@
 import os
+import contextlib
 import csv
+import math
 import uuid
 import io
 import json
-from datetime import datetime
+import re
+import random
+import secrets
+import tempfile
+import hashlib
+import hmac
+import mmap
+import sqlite3
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal, InvalidOperation
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
 from zoneinfo import ZoneInfo
 import xml.etree.ElementTree as ET
 import requests
 import time
-from urllib.parse import urlparse
-
-# -----------------------
-# GUI (Tkinter)
-# -----------------------
-import tkinter as tk
-from tkinter import ttk, filedialog, messagebox
+import threading
+import queue
+import tarfile
+import zipfile
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
 
 # -----------------------
 # CONSTANTS
@@ -32,9 +46,44 @@ NSMAP = {
     "odk": "http://www.opendatakit.org/xforms",
 }
 
-# CSV columns (ALWAYS 6, per requirements)
+# Submission engine: how many POSTs may be outstanding at once, and the
+# optional cap on requests/second (None = no limit)
+DEFAULT_MAX_IN_FLIGHT = 4
+DEFAULT_RATE_LIMIT = None
+
+# Retries: attempts per row, exponential backoff bounds (seconds), and the
+# circuit breaker that pauses the whole run after consecutive failures
+DEFAULT_MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30.0
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_COOLDOWN = 30.0
+BREAKER_MAX_COOLDOWN = 300.0
+
+# Local timezone the clicker timestamps are recorded in
+DEFAULT_TIMEZONE = "America/New_York"
+CSV_TIME_FORMAT = "%m/%d/%Y %H:%M:%S"
+
+# Namespace for deterministic instanceIDs (uuid5 of form id + row content)
+INSTANCE_ID_NAMESPACE = uuid.UUID("6f0c1a52-58f4-4c1e-9a55-3d7f6b0e2a91")
+
+# Local cache of parsed form definitions (see FormDefinitionCache)
+DEFAULT_CACHE_DIR = os.environ.get("KOBO_UPLOADER_CACHE") or os.path.join(
+    os.path.expanduser("~"), ".cache", "kobo-uploader")
+FORM_CACHE_MAX_AGE = 24 * 3600  # seconds before a cached form is revalidated
+
+# Local copy of each instance: one folder per instance (original layout),
+# a single streaming archive, a JSONL bundle, or nothing
+OUTPUT_FORMATS = ("dirs", "zip", "tar", "jsonl", "none")
+DEFAULT_OUTPUT_FORMAT = "dirs"
+
+# Per-row results go to a JSONL log; only this many recent messages stay in memory
+RESULT_TAIL_LINES = 200
+CONSOLE_MAX_LINES = 1000  # GUI output console
+
+# CSV columns: a time column plus any number of value columns mapped to form fields
 CSV_COL_TIME = "time"  # case-insensitive after strip
-CSV_BUTTONS = ["button1", "button2", "button3", "button4", "button5"]
+CSV_BUTTONS = ["button1", "button2", "button3", "button4", "button5"]  # the original clicker layout
 
 # Kobo default/meta fields to exclude from mapping UI
 EXCLUDED_NAMES = {
@@ -61,14 +110,103 @@ EXCLUDED_NAMES = {
 def normalize_header(h):
     return (h or "").strip().lower()
 
-def parse_csv_time_to_iso8601_local(s):
+# MM/DD/YYYY HH:MM:SS with the same field widths strptime accepts for CSV_TIME_FORMAT.
+# [0-9], not \d: strptime rejects non-ASCII digits (its \s does take any whitespace)
+_CSV_TIME_RE = re.compile(r"([0-9]{1,2})/([0-9]{1,2})/([0-9]{4})\s+([0-9]{1,2}):([0-9]{1,2}):([0-9]{1,2})")
+
+def _format_utc_offset(offset: timedelta) -> str:
+    """
+    '+HH:MM' exactly as datetime.isoformat renders a whole-minute offset.
+    """
+    minutes = int(offset.total_seconds()) // 60
+    sign = "-" if minutes < 0 else "+"
+    hh, mm = divmod(abs(minutes), 60)
+    return f"{sign}{hh:02d}:{mm:02d}"
+
+class CsvTimeParser:
+    """
+    Fixed-format MM/DD/YYYY HH:MM:SS -> ISO8601 converter for one timezone.
+
+    The UTC offset is cached per calendar date. On dates where the offset
+    changes (DST transitions) each row is resolved through zoneinfo, so
+    results always match parse_csv_time_to_iso8601_local's original
+    strptime/isoformat path. Anything the fast pattern does not recognise is
+    handed to strptime, which either parses it or raises the usual ValueError.
+    """
+    def __init__(self, tz_name=DEFAULT_TIMEZONE):
+        self.tz_name = tz_name
+        self.tz = ZoneInfo(tz_name)
+        self._offsets = {}  # (y, m, d) -> offset string, or None on transition days
+
+    def _slow(self, s):
+        dt_naive = datetime.strptime(s, CSV_TIME_FORMAT)
+        return dt_naive.replace(tzinfo=self.tz).isoformat(timespec="seconds")
+
+    def _date_offset(self, y, mo, d):
+        key = (y, mo, d)
+        try:
+            return self._offsets[key]
+        except KeyError:
+            pass
+        first = datetime(y, mo, d, 0, 0, 0, tzinfo=self.tz).utcoffset()
+        last = datetime(y, mo, d, 23, 59, 59, tzinfo=self.tz).utcoffset()
+        if first == last and first.total_seconds() % 60 == 0:
+            off = _format_utc_offset(first)
+        else:
+            off = None
+        self._offsets[key] = off
+        return off
+
+    def parse(self, s):
+        s = s.strip()
+        m = _CSV_TIME_RE.fullmatch(s)
+        if m is None:
+            return self._slow(s)
+        mo, d, y, hh, mi, ss = map(int, m.groups())
+        if not (1 <= mo <= 12 and hh <= 23 and mi <= 59 and ss <= 61):
+            return self._slow(s)
+        try:
+            off = self._date_offset(y, mo, d)
+        except ValueError:
+            return self._slow(s)  # e.g. 02/30 -> strptime's own error message
+        if off is None or ss > 59:
+            return self._slow(s)
+        return f"{y:04d}-{mo:02d}-{d:02d}T{hh:02d}:{mi:02d}:{ss:02d}{off}"
+
+    def parse_many(self, values):
+        """
+        Batch API: convert a whole column.
+        Returns (isos, errors): isos[i] is the ISO string or None,
+        errors is a list of (i, exception) for the values that failed.
+        """
+        isos = []
+        errors = []
+        parse = self.parse
+        for i, v in enumerate(values):
+            try:
+                isos.append(parse(v))
+            except Exception as e:
+                isos.append(None)
+                errors.append((i, e))
+        return isos, errors
+
+@lru_cache(maxsize=None)
+def get_time_parser(tz_name=DEFAULT_TIMEZONE) -> CsvTimeParser:
+    return CsvTimeParser(tz_name)
+
+def parse_csv_time_to_iso8601_local(s, tz_name=DEFAULT_TIMEZONE):
     """
     Input like '10/22/2025 11:42:32' (MM/DD/YYYY HH:MM:SS, local).
-    Output ISO8601 with America/New_York offset, e.g. '2025-10-22T11:42:32-04:00'.
+    Output ISO8601 with the zone's offset, e.g. '2025-10-22T11:42:32-04:00'
+    for the default America/New_York.
+    """
+    return get_time_parser(tz_name).parse(s)
+
+def parse_csv_times_iso8601_local(values, tz_name=DEFAULT_TIMEZONE):
+    """
+    Column version of parse_csv_time_to_iso8601_local; see CsvTimeParser.parse_many.
     """
-    dt_naive = datetime.strptime(s.strip(), "%m/%d/%Y %H:%M:%S")
-    dt_local = dt_naive.replace(tzinfo=ZoneInfo("America/New_York"))
-    return dt_local.isoformat(timespec="seconds")
+    return get_time_parser(tz_name).parse_many(values)
 
 def derive_kc_base_from_link(link: str) -> str:
     host = ""
@@ -138,20 +276,56 @@ def get_field_label(item: dict) -> str:
     return str(label).strip()
 
 
-def kf_get_custom_fields(kf_base: str, form_uid: str, username: str, password: str):
+class FormDefinitionCache:
+    """
+    On-disk cache of parsed custom-field lists, one JSON file per (KPI base,
+    form uid, account): one account's fetch never answers another's.
+    Entries keep the validators the server sent (ETag / Last-Modified) so
+    entries older than max_age seconds are revalidated with a conditional GET;
+    without validators they are fetched again.
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_age=FORM_CACHE_MAX_AGE):
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+
+    def _path(self, kf_base, form_uid, username=None):
+        key = hashlib.sha1(f"{kf_base.rstrip('/')}|{form_uid}|{username or ''}".encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"form-{key}.json")
+
+    def load(self, kf_base, form_uid, username=None):
+        try:
+            with open(self._path(kf_base, form_uid, username), "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(entry, dict) or not isinstance(entry.get("fields"), list):
+            return None
+        return entry
+
+    def is_fresh(self, entry):
+        return (time.time() - entry.get("fetched_at", 0)) < self.max_age
+
+    def store(self, kf_base, form_uid, entry, username=None):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # A temporary file of its own: service jobs may store the same form at once
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, prefix="form-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(entry, f)
+            os.replace(tmp, self._path(kf_base, form_uid, username))
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(tmp)
+            raise
+
+def extract_custom_fields(data):
     """
-    Fetch form content and extract *custom* fields:
+    Extract *custom* fields from an asset JSON:
     - Derive field name from name → $autoname → $xpath(last segment)
     - Skip structural types (groups/repeats/notes)
     - Exclude known defaults/meta by *derived* name (case-insensitive)
     Returns: [{'name': 'Red_Button', 'label': 'Red Button', 'type': 'integer'}, ...]
     """
-    url = f"{kf_base}/api/v2/assets/{form_uid}/?format=json"
-    r = requests.get(url, auth=(username, password), timeout=60)
-    if r.status_code != 200:
-        raise RuntimeError(f"Failed to fetch form definition ({r.status_code}): {r.text}")
-
-    data = r.json()
     survey = None
     if isinstance(data, dict):
         survey = (data.get("content") or {}).get("survey")
@@ -187,12 +361,60 @@ def kf_get_custom_fields(kf_base: str, form_uid: str, username: str, password: s
 
         items.append({"name": name, "label": label_text, "type": qtype})
 
-    # hard cap: no more than 5 custom fields
-    if len(items) > 5:
-        raise RuntimeError(
-            f"Form has {len(items)} custom fields (max allowed is 5 for this uploader). "
-            "Please remove or ignore extra fields."
-        )
+    return items
+
+def kf_get_custom_fields(kf_base: str, form_uid: str, username: str, password: str,
+                         cache: FormDefinitionCache = None, offline=False, revalidate=False):
+    """
+    Fetch form content and extract its custom fields (see extract_custom_fields).
+    cache: optional FormDefinitionCache. A fresh entry is used without any
+           request; a stale one is revalidated (304 keeps it), and it is used
+           as a fallback when the server cannot be reached.
+    offline: use the cached definition only, never touch the network.
+    revalidate: revalidate even a fresh entry, with no fallback, so the
+                server checks these credentials (see UploadService.form_fields).
+    """
+    entry = cache.load(kf_base, form_uid, username) if cache else None
+
+    if offline:
+        if entry is None:
+            raise RuntimeError("Offline mode: no cached form definition for this form.")
+        items = entry["fields"]
+    elif entry is not None and cache.is_fresh(entry) and not revalidate:
+        items = entry["fields"]
+    else:
+        url = f"{kf_base}/api/v2/assets/{form_uid}/?format=json"
+        headers = {}
+        if entry is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        try:
+            r = requests.get(url, auth=(username, password), headers=headers, timeout=60)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if entry is None or revalidate:
+                raise
+            print(f"[WARN] Form fetch failed ({e}); using cached definition.")
+            r = None
+
+        if r is None:
+            items = entry["fields"]
+        elif r.status_code == 304 and entry is not None:
+            items = entry["fields"]
+            entry["fetched_at"] = time.time()
+            cache.store(kf_base, form_uid, entry, username)
+        elif r.status_code != 200:
+            raise RuntimeError(f"Failed to fetch form definition ({r.status_code}): {r.text}")
+        else:
+            items = extract_custom_fields(r.json())
+            if cache:
+                cache.store(kf_base, form_uid, {
+                    "fields": items,
+                    "etag": r.headers.get("ETag"),
+                    "last_modified": r.headers.get("Last-Modified"),
+                    "fetched_at": time.time(),
+                }, username)
 
     return items
 
@@ -255,330 +477,3887 @@ def submit_xml(session, submit_url, xml_bytes, display_name="submission.xml"):
     r = session.post(submit_url, files=files, timeout=60)
     return r
 
+def submit_body(session, submit_url, body, content_type):
+    """
+    POST an already-encoded multipart body (see SubmissionTemplate.multipart).
+    """
+    r = session.post(submit_url, data=body, headers={"Content-Type": content_type}, timeout=60)
+    return r
+
 # -----------------------
-# Core uploader
+# Precompiled submission template
 # -----------------------
-def run_upload_dynamic(username, password, survey_link, csv_path, output_root, mapping):
+_XML_SENTINEL = "\x00"
+
+def escape_xml_text(value) -> bytes:
     """
-    mapping: dict { form_field_name -> csv_button_name } (csv_button_name in CSV_BUTTONS)
+    Same escaping/encoding ElementTree applies to element text with encoding="UTF-8".
     """
-    form_id = parse_form_id_from_link(survey_link)
-    kc_base = derive_kc_base_from_link(survey_link)
-    submit_url = f"{kc_base}/submission"
+    s = "" if value is None else str(value)
+    if "&" in s:
+        s = s.replace("&", "&amp;")
+    if "<" in s:
+        s = s.replace("<", "&lt;")
+    if ">" in s:
+        s = s.replace(">", "&gt;")
+    return s.encode("utf-8", "xmlcharrefreplace")
+
+class SubmissionTemplate:
+    """
+    Everything in an instance that is identical for every row of a form, compiled once.
+    render() produces exactly the bytes build_instance_xml_dynamic would;
+    multipart() wraps them in the body requests would send for submit_xml.
 
-    ROOT_TAG = form_id
-    FORM_ID_ATTR = form_id
+    The constant parts are taken from build_instance_xml_dynamic itself (rendered
+    once with sentinel values and split), so both paths can never drift apart.
+    """
+    def __init__(self, root_tag, form_id_attr, field_names):
+        self.field_names = [n for n in field_names if n]
 
-    os.makedirs(output_root, exist_ok=True)
+        sample = build_instance_xml_dynamic(
+            root_tag=root_tag,
+            form_id_attr=form_id_attr,
+            start_iso=_XML_SENTINEL,
+            end_iso=_XML_SENTINEL,
+            mapped_values={n: _XML_SENTINEL for n in self.field_names},
+            instance_uuid_str=_XML_SENTINEL,
+        )
+        segments = sample.split(_XML_SENTINEL.encode())
+        # head ... <start> | </start><end> | </end>[<f1>] | ... | [</fn>]<__version__>...uuid: | tail
+        self._start, self._end = self._tags("start"), self._tags("end")
+        self._head = segments[0][:-len(self._start[0])]
+        self._start_to_end = segments[1][len(self._start[1]):-len(self._end[0])]
+        last_close = f"</{self.field_names[-1]}>" if self.field_names else "</end>"
+        self._before_instance = segments[-2][len(last_close):]
+        self._tail = segments[-1]
+        self._fields = [self._tags(n) for n in self.field_names]
+
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+        self._part_tail = f"\r\n--{self.boundary}--\r\n".encode()
+
+    @staticmethod
+    def _tags(name):
+        # (open, close, empty): ElementTree writes an element with no text as <name />
+        return f"<{name}>".encode(), f"</{name}>".encode(), f"<{name} />".encode()
+
+    @staticmethod
+    def _element(parts, tags, value):
+        text = escape_xml_text(value)
+        if text:
+            parts += (tags[0], text, tags[1])
+        else:
+            parts.append(tags[2])
+
+    def render(self, start_iso, end_iso, mapped_values: dict, instance_uuid_str: str) -> bytes:
+        """
+        Fields missing from mapped_values render as empty elements.
+        """
+        values = [mapped_values.get(n) for n in self.field_names]
+        return self.render_values(start_iso, end_iso, values, instance_uuid_str)
 
+    def render_values(self, start_iso, end_iso, values, instance_uuid_str: str) -> bytes:
+        """
+        Like render(), with values given positionally in field_names order.
+        """
+        parts = [self._head]
+        self._element(parts, self._start, start_iso)
+        parts.append(self._start_to_end)
+        self._element(parts, self._end, end_iso)
+        for tags, val in zip(self._fields, values):
+            self._element(parts, tags, val)
+        parts += (self._before_instance, escape_xml_text(instance_uuid_str), self._tail)
+        return b"".join(parts)
+
+    def multipart(self, xml_bytes: bytes, display_name="submission.xml") -> bytes:
+        filename = display_name.replace('"', "%22").replace("\r", "%0D").replace("\n", "%0A")
+        head = (
+            f"--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="xml_submission_file"; filename="{filename}"\r\n'
+            "Content-Type: text/xml\r\n\r\n"
+        ).encode()
+        return b"".join((head, xml_bytes, self._part_tail))
+
+# -----------------------
+# Submission engine
+# -----------------------
+class RateLimiter:
+    """
+    Thread-safe limiter: hands out evenly spaced slots, at most `rate` per second.
+    """
+    def __init__(self, rate):
+        if rate <= 0:
+            raise ValueError("Rate limit must be positive.")
+        self.interval = 1.0 / rate
+        self._lock = threading.Lock()
+        self._next_slot = time.monotonic()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
+
+def make_session(username, password, pool_size=DEFAULT_MAX_IN_FLIGHT):
+    """
+    requests.Session with a connection pool large enough for `pool_size`
+    concurrent submissions (the default pool keeps only 10 connections and
+    silently discards the extras, which forces new TLS handshakes).
+    """
     session = requests.Session()
     session.auth = (username, password)
     session.headers.update({
         "User-Agent": "kobo-bulk-uploader/2.0",
         "X-OpenRosa-Version": "1.0",
     })
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
 
-    # Read CSV
-    with open(csv_path, "r", newline="", encoding="utf-8-sig") as f:
-        reader = csv.DictReader(f)
-        if not reader.fieldnames:
-            raise ValueError("CSV has no header row.")
+class SubmissionCancelled(Exception):
+    pass
 
-        header_map = {orig: normalize_header(orig) for orig in reader.fieldnames}
-        normalized_fieldnames = list(header_map.values())
+class RetryPolicy:
+    """
+    Which failures are worth retrying, and how long to wait before the next attempt.
+    Retried: timeouts, connection errors/resets, 429 and 5xx. Other statuses
+    (e.g. 400/401/403) are final on the first attempt.
+    """
+    def __init__(self, max_attempts=DEFAULT_MAX_ATTEMPTS, base_delay=RETRY_BASE_DELAY,
+                 max_delay=RETRY_MAX_DELAY, max_retry_after=BREAKER_MAX_COOLDOWN):
+        self.max_attempts = max(1, int(max_attempts))
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
 
-        # Validate required columns exist
-        required = [CSV_COL_TIME] + CSV_BUTTONS
-        missing = [c for c in required if c not in normalized_fieldnames]
-        if missing:
-            raise ValueError(f"CSV missing required columns: {missing}")
+    def is_retryable(self, response, error):
+        if error is not None:
+            return isinstance(error, (requests.ConnectionError, requests.Timeout))
+        return response.status_code == 429 or response.status_code >= 500
 
-        rows = []
-        for raw in reader:
-            norm = {}
-            for k, v in raw.items():
-                norm[header_map[k]] = (v or "").strip()
-            rows.append(norm)
-
-    results = []
-    for idx, row in enumerate(rows, start=1):
-        time_str = row.get(CSV_COL_TIME, "")
-        if not time_str:
-            msg = f"[SKIP] Row {idx}: missing Time"
-            print(msg)
-            results.append(msg)
-            continue
+    def delay(self, attempt, response=None):
+        """
+        Seconds to wait after failed attempt number `attempt` (1-based):
+        the server's Retry-After if given (only bounded by max_retry_after, as a
+        throttling server means it), else full-jitter exponential backoff.
+        """
+        retry_after = parse_retry_after(response.headers.get("Retry-After")) if response is not None else None
+        if retry_after is not None:
+            return min(retry_after, self.max_retry_after)
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))
+
+def parse_retry_after(value):
+    """
+    Retry-After as seconds (delta-seconds or HTTP-date), None if absent/invalid.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isascii() and value.isdigit():  # isdigit alone takes "²", which float() refuses
+        return float(value)
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+class CircuitBreaker:
+    """
+    Shared by all workers of a run. After `failure_threshold` consecutive
+    retryable failures the circuit opens: every worker waits out the cooldown
+    (doubling on each re-open, up to max_cooldown) instead of burning through
+    rows while the server is down. Any success closes it again.
+    """
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, cooldown=BREAKER_COOLDOWN,
+                 max_cooldown=BREAKER_MAX_COOLDOWN, on_open=None):
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.on_open = on_open
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._cooldown = cooldown
+        self._open_until = 0.0
+
+    def wait(self, cancel_event=None):
+        while True:
+            with self._lock:
+                remaining = self._open_until - time.monotonic()
+            if remaining <= 0:
+                return
+            if cancel_event is not None:
+                if cancel_event.wait(remaining):
+                    raise SubmissionCancelled("cancelled while the circuit breaker was open")
+            else:
+                time.sleep(remaining)
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._cooldown = self.base_cooldown
 
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            now = time.monotonic()
+            if self._failures < self.failure_threshold or self._open_until > now:
+                return
+            pause = self._cooldown
+            self._open_until = now + pause
+            self._cooldown = min(self._cooldown * 2, self.max_cooldown)
+            self._failures = 0
+        if self.on_open:
+            self.on_open(pause)
+
+# Result of one row's submission, after retries
+SubmitOutcome = namedtuple("SubmitOutcome", ["response", "error", "attempts", "elapsed"])
+
+def submit_with_retry(session, submit_url, body, content_type, policy=None, breaker=None,
+                      limiter=None, cancel_event=None, gate=None):
+    """
+    POST one pre-encoded body, retrying per `policy` and honoring the shared
+    `breaker` and rate `limiter`. Returns a SubmitOutcome: the final response
+    (which may still be an error status) or the final exception.
+    gate: optional slot shared with other uploads (see FairScheduler), held
+          only while a request is on the wire.
+    """
+    policy = policy or RetryPolicy()
+    started = time.monotonic()
+    attempt = 0
+    while True:
+        attempt += 1
+        if breaker:
+            breaker.wait(cancel_event)
+        if limiter:
+            limiter.wait()
+        response = error = None
+        if gate:
+            gate.acquire()
         try:
-            iso_time = parse_csv_time_to_iso8601_local(time_str)
+            response = submit_body(session, submit_url, body, content_type)
         except Exception as e:
-            msg = f"[SKIP] Row {idx}: bad Time '{time_str}': {e}"
-            print(msg)
-            results.append(msg)
-            continue
+            error = e
+        finally:
+            if gate:
+                gate.release()
 
-        # Build values for custom fields from mapping
-        mapped_values = {}
-        for form_field, csv_button in mapping.items():
-            if not csv_button:
-                continue
-            mapped_values[form_field] = row.get(csv_button, "")
-
-        inst_uuid = str(uuid.uuid4())
-        xml_bytes = build_instance_xml_dynamic(
-            root_tag=ROOT_TAG,
-            form_id_attr=FORM_ID_ATTR,
-            start_iso=iso_time,
-            end_iso=iso_time,
-            mapped_values=mapped_values,
-            instance_uuid_str=inst_uuid,
-        )
+        if not policy.is_retryable(response, error):
+            if breaker and (error is None and response.status_code < 500):
+                breaker.record_success()
+            return SubmitOutcome(response, error, attempt, time.monotonic() - started)
 
-        folder = os.path.join(output_root, f"instance{idx}")
-        os.makedirs(folder, exist_ok=True)
-        file_path = os.path.join(folder, f"instance{idx}.xml")
-        with open(file_path, "wb") as xf:
-            xf.write(xml_bytes)
+        if breaker:
+            breaker.record_failure()
+        if attempt >= policy.max_attempts:
+            return SubmitOutcome(response, error, attempt, time.monotonic() - started)
+        delay = policy.delay(attempt, response)
+        if cancel_event is not None:
+            if cancel_event.wait(delay):
+                return SubmitOutcome(response, error, attempt, time.monotonic() - started)
+        else:
+            time.sleep(delay)
+
+def failure_reason(outcome):
+    if outcome.error is not None:
+        return type(outcome.error).__name__
+    return f"HTTP {outcome.response.status_code}"
+
+def format_failed_rows(failures, limit=50):
+    """
+    failures: { reason: [row idx, ...] } -> 'Failed rows: 3, 9 (HTTP 500); 12 (ConnectionError)'
+    """
+    if not failures:
+        return ""
+    parts = []
+    for reason, idxs in failures.items():
+        shown = ", ".join(str(i) for i in idxs[:limit])
+        if len(idxs) > limit:
+            shown += f" … and {len(idxs) - limit} more"
+        parts.append(f"{shown} ({reason})")
+    return "Failed rows: " + "; ".join(parts)
+
+def submit_ordered(session, submit_url, jobs, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                   rate_limit=DEFAULT_RATE_LIMIT, policy=None, breaker=None, cancel_event=None, gate=None):
+    """
+    Submit jobs with at most `max_in_flight` requests outstanding.
+    jobs: iterable of (key, body, content_type) with a pre-encoded multipart body;
+          body=None marks a job with nothing to send (e.g. a skipped row) that
+          must still keep its place.
+    policy/breaker/gate: retry behaviour, shared circuit breaker and shared
+                         concurrency slot (see submit_with_retry).
+    Yields (key, SubmitOutcome) strictly in job order; the outcome is None for
+    jobs with nothing to send.
+    """
+    max_in_flight = max(1, int(max_in_flight))
+    limiter = RateLimiter(rate_limit) if rate_limit else None
+    policy = policy or RetryPolicy()
 
+    def send(body, content_type):
+        return submit_with_retry(session, submit_url, body, content_type, policy=policy,
+                                 breaker=breaker, limiter=limiter, cancel_event=cancel_event, gate=gate)
+
+    def collect(entry):
+        key, fut = entry
+        if fut is None:
+            return key, None
         try:
-            r = submit_xml(session, submit_url, xml_bytes, display_name=os.path.basename(file_path))
-            msg = f"{file_path}: {r.status_code}\n{r.text.strip()}\n{'-'*60}"
-            print(msg)
-            results.append(msg)
+            return key, fut.result()
         except Exception as e:
-            msg = f"{file_path}: ERROR submitting: {e}\n{'-'*60}"
-            print(msg)
-            results.append(msg)
-
-        time.sleep(0.2)
+            return key, SubmitOutcome(None, e, 0, 0.0)
 
-    return "\n".join(results)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+        for key, body, content_type in jobs:
+            fut = None if body is None else pool.submit(send, body, content_type)
+            pending.append((key, fut))
+            # Bounded window: wait on the oldest job before queueing more
+            if len(pending) >= max_in_flight:
+                yield collect(pending.popleft())
+        while pending:
+            yield collect(pending.popleft())
 
 # -----------------------
-# Tkinter UI
+# Metrics
 # -----------------------
-def choose_csv(var):
-    path = filedialog.askopenfilename(
-        title="Select CSV file",
-        filetypes=[("CSV files", "*.csv"), ("All files", "*.*")]
-    )
-    if path:
-        var.set(path)
-
-def center_window(win, width=560, height=360):
-    win.update_idletasks()
-    x = (win.winfo_screenwidth() // 2) - (width // 2)
-    y = (win.winfo_screenheight() // 2) - (height // 2)
-    win.geometry(f"{width}x{height}+{x}+{y}")
-
-def popup_credentials(on_success):
-    # First popup
-    root = tk.Tk()
-    root.title("Upload to Kobotoolbox")
-    root.resizable(False, False)
-    center_window(root, 560, 340)
+# Upper bounds (seconds) of the latency histogram buckets; +Inf is implicit
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+METRIC_STAGES = ("read_csv", "parse_time", "build_xml", "write", "submit")
+METRIC_COUNTERS = ("submitted", "skipped", "failed", "retried")
 
-    frame = ttk.Frame(root, padding=20)
-    frame.grid(row=0, column=0, sticky="nsew")
-    root.grid_rowconfigure(0, weight=1)
-    root.grid_columnconfigure(0, weight=1)
-    for c in range(2):
-        frame.grid_columnconfigure(c, weight=1)
+class UploadMetrics:
+    """
+    Per-stage timers and latency histograms plus outcome counters for a run.
+    Thread-safe (the writer and submit workers report from their own threads).
+    Exported as a JSON summary or Prometheus text format.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.finished = None
+        self.counters = {name: 0 for name in METRIC_COUNTERS}
+        self.stage_seconds = {stage: 0.0 for stage in METRIC_STAGES}
+        self.stage_counts = {stage: 0 for stage in METRIC_STAGES}
+        self.buckets = {stage: [0] * (len(LATENCY_BUCKETS) + 1) for stage in METRIC_STAGES}
 
-    username_var = tk.StringVar()
-    password_var = tk.StringVar()
-    link_var = tk.StringVar()
-    csv_var = tk.StringVar()
-    output_var = tk.StringVar(value="instances")
+    def observe(self, stage, seconds):
+        # index of the first bucket whose bound is >= seconds (last slot = +Inf)
+        i = 0
+        for bound in LATENCY_BUCKETS:
+            if seconds <= bound:
+                break
+            i += 1
+        with self._lock:
+            if stage not in self.buckets:
+                self.stage_seconds[stage] = 0.0
+                self.stage_counts[stage] = 0
+                self.buckets[stage] = [0] * (len(LATENCY_BUCKETS) + 1)
+            self.stage_seconds[stage] += seconds
+            self.stage_counts[stage] += 1
+            self.buckets[stage][i] += 1
 
-    ttk.Label(frame, text="Username (required):").grid(row=0, column=0, sticky="e", padx=8, pady=6)
-    ttk.Entry(frame, textvariable=username_var, width=36, justify="center").grid(row=0, column=1, sticky="w", padx=8, pady=6)
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
 
-    ttk.Label(frame, text="Password (required):").grid(row=1, column=0, sticky="e", padx=8, pady=6)
-    ttk.Entry(frame, textvariable=password_var, show="*", width=36, justify="center").grid(row=1, column=1, sticky="w", padx=8, pady=6)
+    def finish(self):
+        self.finished = time.time()
 
-    ttk.Label(frame, text="Survey link (required):").grid(row=2, column=0, sticky="e", padx=8, pady=6)
-    ttk.Entry(frame, textvariable=link_var, width=36, justify="center").grid(row=2, column=1, sticky="w", padx=8, pady=6)
+    def wall_seconds(self):
+        return (self.finished or time.time()) - self.started
 
-    ttk.Label(frame, text="CSV file (required):").grid(row=3, column=0, sticky="e", padx=8, pady=6)
-    csv_row = ttk.Frame(frame)
-    csv_row.grid(row=3, column=1, sticky="w", padx=8, pady=6)
-    ttk.Entry(csv_row, textvariable=csv_var, width=27, justify="center").grid(row=0, column=0, padx=(0,6))
-    ttk.Button(csv_row, text="Browse…", command=lambda: choose_csv(csv_var)).grid(row=0, column=1)
+    def summary(self):
+        with self._lock:
+            stages = {}
+            for stage, total in self.stage_seconds.items():
+                n = self.stage_counts[stage]
+                stages[stage] = {
+                    "count": n,
+                    "seconds": round(total, 6),
+                    "mean_ms": round(total / n * 1000, 4) if n else None,
+                    "histogram": {
+                        ("+Inf" if i == len(LATENCY_BUCKETS) else str(LATENCY_BUCKETS[i])): c
+                        for i, c in enumerate(self.buckets[stage])
+                    },
+                }
+            return {
+                "started": datetime.fromtimestamp(self.started, timezone.utc).isoformat(timespec="seconds"),
+                "wall_seconds": round(self.wall_seconds(), 3),
+                "counters": dict(self.counters),
+                "stages": stages,
+            }
 
-    ttk.Label(frame, text="Output folder (required):").grid(row=4, column=0, sticky="e", padx=8, pady=6)
-    ttk.Entry(frame, textvariable=output_var, width=36, justify="center").grid(row=4, column=1, sticky="w", padx=8, pady=6)
+    def write_json(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.summary(), f, indent=2)
 
-    def submit_first():
-        username = username_var.get().strip()
-        password = password_var.get().strip()
-        link = link_var.get().strip()
-        csv_path = csv_var.get().strip()
-        output_root = output_var.get().strip()
+    def write_prometheus(self, path):
+        lines = [
+            "# HELP kobo_upload_rows_total Rows by outcome.",
+            "# TYPE kobo_upload_rows_total counter",
+        ]
+        with self._lock:
+            for name, value in self.counters.items():
+                lines.append(f'kobo_upload_rows_total{{outcome="{name}"}} {value}')
+            lines += [
+                "# HELP kobo_upload_stage_seconds Per-row time spent in each pipeline stage.",
+                "# TYPE kobo_upload_stage_seconds histogram",
+            ]
+            for stage, counts in self.buckets.items():
+                cumulative = 0
+                for i, c in enumerate(counts):
+                    cumulative += c
+                    le = "+Inf" if i == len(LATENCY_BUCKETS) else repr(LATENCY_BUCKETS[i])
+                    lines.append(f'kobo_upload_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+                lines.append(f'kobo_upload_stage_seconds_sum{{stage="{stage}"}} {self.stage_seconds[stage]:.6f}')
+                lines.append(f'kobo_upload_stage_seconds_count{{stage="{stage}"}} {self.stage_counts[stage]}')
+        lines += [
+            "# HELP kobo_upload_wall_seconds Wall-clock duration of the run.",
+            "# TYPE kobo_upload_wall_seconds gauge",
+            f"kobo_upload_wall_seconds {self.wall_seconds():.3f}",
+        ]
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
 
-        if not (username and password and link and csv_path and output_root):
-            messagebox.showerror("Missing information", "All fields are required.")
-            return
-        if not os.path.isfile(csv_path):
-            messagebox.showerror("CSV not found", "The specified CSV file does not exist.")
-            return
+class ThreadProfiler:
+    """
+    cProfile of the calling thread plus every thread started while enabled
+    (submission workers, the instance writer, parse threads); dump_stats()
+    merges them into one file. A cProfile.Profile only sees the thread that
+    enabled it, so each new thread enables its own from a threading.setprofile
+    hook. Worker processes (--processes, --parse-processes) are not included.
+    """
+    def __init__(self):
+        import cProfile
 
-        # Validate CSV columns here to fail early
-        try:
-            with open(csv_path, "r", newline="", encoding="utf-8-sig") as f:
-                reader = csv.DictReader(f)
-                if not reader.fieldnames:
-                    raise ValueError("CSV has no header row.")
-                normalized = [normalize_header(h) for h in reader.fieldnames]
-                required = [CSV_COL_TIME] + CSV_BUTTONS
-                missing = [c for c in required if c not in normalized]
-                if missing:
-                    raise ValueError(f"CSV missing required columns: {missing}")
-        except Exception as e:
-            messagebox.showerror("CSV error", str(e))
-            return
+        self._new = cProfile.Profile
+        self._main = self._new()
+        self._threads = []
+        self._lock = threading.Lock()
 
-        try:
-            form_uid = parse_form_id_from_link(link)
-        except Exception as e:
-            messagebox.showerror("Invalid survey link", f"Could not parse Form ID from link.\n\nError: {e}")
-            return
+    def _start_thread(self, *args):
+        import sys
 
-        # Fetch custom form fields
+        sys.setprofile(None)  # the hook only runs once per thread
+        profile = self._new()
         try:
-            kf_base = derive_kf_base_from_link(link)
-            fields = kf_get_custom_fields(kf_base, form_uid, username, password)
-        except Exception as e:
-            messagebox.showerror("Form fetch error", str(e))
-            return
+            profile.enable()
+        except ValueError:
+            return  # Python 3.12+: one profiler per interpreter, and it already sees every thread
+        with self._lock:
+            self._threads.append(profile)
 
-        # Enforce max 5 custom fields (already in fetch, but double-check)
-        if len(fields) > 5:
-            messagebox.showerror("Too many fields", f"Form exposes {len(fields)} custom fields (max 5).")
-            return
-
-        # Success → close this popup and open mapper
-        root.destroy()
-        on_success(username, password, link, csv_path, output_root, fields)
+    def enable(self):
+        self._main.enable()
+        threading.setprofile(self._start_thread)
 
-    btns = ttk.Frame(frame)
-    btns.grid(row=5, column=0, columnspan=2, pady=(14, 0))
-    btns.grid_columnconfigure(0, weight=1)
-    btns.grid_columnconfigure(1, weight=1)
+    def disable(self):
+        threading.setprofile(None)
+        self._main.disable()
 
-    ttk.Button(btns, text="Submit", command=submit_first).grid(row=0, column=0, padx=10)
-    ttk.Button(btns, text="Quit", command=root.destroy).grid(row=0, column=1, padx=10)
+    def dump_stats(self, path):
+        import pstats
 
-    root.mainloop()
+        stats = pstats.Stats(self._main)
+        with self._lock:
+            for profile in self._threads:
+                stats.add(profile)
+        stats.dump_stats(path)
 
-def popup_mapping(username, password, link, csv_path, output_root, custom_fields):
+# -----------------------
+# Local instance output
+# -----------------------
+class DirInstanceWriter:
     """
-    Second popup: show each custom field with a dropdown to assign button1..button5
+    Original layout: output_root/instance{idx}/instance{idx}.xml
     """
-    win = tk.Tk()
-    win.title("Map CSV columns to form fields")
-    win.resizable(False, False)
+    def __init__(self, output_root):
+        self.output_root = output_root
 
-    # Size depends on number of fields
-    height = 220 + 48 * max(1, len(custom_fields))
-    center_window(win, 680, height)
+    def location(self, idx):
+        return os.path.join(self.output_root, f"instance{idx}", f"instance{idx}.xml")
 
-    frame = ttk.Frame(win, padding=18)
-    frame.grid(row=0, column=0, sticky="nsew")
-    win.grid_rowconfigure(0, weight=1)
-    win.grid_columnconfigure(0, weight=1)
+    def write(self, idx, instance_id, xml_bytes):
+        file_path = self.location(idx)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "wb") as xf:
+            xf.write(xml_bytes)
 
-    # Header
-    ttk.Label(
-        frame,
-        text="Assign CSV columns to your custom form fields",
-        font=("TkDefaultFont", 10, "bold")
-    ).grid(row=0, column=0, columnspan=3, pady=(0, 10))
+    def close(self):
+        pass
 
-    ttk.Label(frame, text="Form Field").grid(row=1, column=0, sticky="w")
-    ttk.Label(frame, text="(name)").grid(row=1, column=1, sticky="w")
-    ttk.Label(frame, text="CSV Column").grid(row=1, column=2, sticky="w")
+class ZipInstanceWriter:
+    def __init__(self, path):
+        self.path = path
+        self._zf = zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED)
 
-    # Dropdown choices (buttons only)
-    button_choices = ["(Unused)"] + CSV_BUTTONS
+    def location(self, idx):
+        return f"{self.path}:instance{idx}.xml"
 
-    # Build one row per custom field
-    var_by_field = {}
-    start_row = 2
-    for idx, fld in enumerate(custom_fields):
-        row = start_row + idx
-        label = fld.get("label") or fld["name"]
-        name = fld["name"]
+    def write(self, idx, instance_id, xml_bytes):
+        self._zf.writestr(f"instance{idx}.xml", xml_bytes)
 
-        ttk.Label(frame, text=label).grid(row=row, column=0, sticky="w", padx=(0,10), pady=4)
-        ttk.Label(frame, text=name, foreground="#555").grid(row=row, column=1, sticky="w", padx=(0,10), pady=4)
+    def close(self):
+        self._zf.close()
 
-        v = tk.StringVar(value="(Unused)")
-        combo = ttk.Combobox(frame, textvariable=v, values=button_choices, state="readonly", width=16, justify="center")
-        combo.grid(row=row, column=2, sticky="w", pady=4)
-        var_by_field[name] = v
+class TarInstanceWriter:
+    def __init__(self, path):
+        self.path = path
+        self._tf = tarfile.open(path, "w|gz")
 
-    next_row = start_row + len(custom_fields)
+    def location(self, idx):
+        return f"{self.path}:instance{idx}.xml"
 
-    # If there are no custom fields, let the user know they can still upload (timestamps only)
-    if len(custom_fields) == 0:
-        ttk.Label(
-            frame,
-            text="No custom fields detected in this form. You can still upload; only timestamps/meta will be submitted.",
-            foreground="#555"
-        ).grid(row=next_row, column=0, columnspan=3, sticky="w", pady=(8, 0))
-        note_row = next_row + 1
-    else:
-        # Footnote about Time
-        ttk.Label(
-            frame,
-            text="Note: 'Time' column is fixed and used for start/end timestamps.",
-            foreground="#555"
-        ).grid(row=next_row, column=0, columnspan=3, sticky="w", pady=(8, 0))
-        note_row = next_row + 1
+    def write(self, idx, instance_id, xml_bytes):
+        info = tarfile.TarInfo(f"instance{idx}.xml")
+        info.size = len(xml_bytes)
+        info.mtime = int(time.time())
+        self._tf.addfile(info, io.BytesIO(xml_bytes))
 
-    # Output console
-    output_text = tk.Text(frame, height=6, width=78, wrap="word")
-    output_text.grid(row=note_row, column=0, columnspan=3, pady=(12, 6))
+    def close(self):
+        self._tf.close()
 
-    def do_upload():
-        # Build mapping and enforce uniqueness (no duplicated button selection)
-        chosen = []
-        mapping = {}
-        for field_name, var in var_by_field.items():
-            val = var.get()
-            if val and val != "(Unused)":
-                mapping[field_name] = val
-                chosen.append(val)
+class JsonlInstanceWriter:
+    """
+    One JSON object per line: {"row": idx, "instance_id": ..., "xml": ...}
+    """
+    def __init__(self, path):
+        self.path = path
+        self._fh = open(path, "w", encoding="utf-8")
 
-        if len(set(chosen)) != len(chosen):
-            messagebox.showerror("Invalid mapping", "Each CSV button can be assigned to at most one form field.")
-            return
+    def location(self, idx):
+        return f"{self.path}#row{idx}"
 
-        try:
-            output_text.delete("1.0", "end")
-            output_text.insert("end", "Starting upload…\n\n")
-            win.update_idletasks()
+    def write(self, idx, instance_id, xml_bytes):
+        rec = {"row": idx, "instance_id": instance_id, "xml": xml_bytes.decode("utf-8")}
+        self._fh.write(json.dumps(rec, ensure_ascii=False) + "\n")
 
-            results = run_upload_dynamic(username, password, link, csv_path, output_root, mapping)
-            output_text.insert("end", results + "\n")
-            messagebox.showinfo("Done", "Upload process completed. See details below.")
-        except Exception as e:
-            messagebox.showerror("Upload error", str(e))
+    def close(self):
+        self._fh.close()
+
+class NullInstanceWriter:
+    def location(self, idx):
+        return f"instance{idx}.xml"
+
+    def write(self, idx, instance_id, xml_bytes):
+        pass
+
+    def close(self):
+        pass
+
+class BackgroundWriter:
+    """
+    Runs another writer's write() calls on a dedicated thread, so disk I/O
+    overlaps with submissions. The queue is bounded (backpressure); a write
+    error is re-raised on the next write() or on close().
+    """
+    _STOP = object()
+
+    def __init__(self, writer, max_pending=1024, metrics=None):
+        self.writer = writer
+        self.metrics = metrics
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="instance-writer", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is self._STOP:
+                break
+            if self._error is None:
+                t0 = time.perf_counter()
+                try:
+                    self.writer.write(*item)
+                except Exception as e:
+                    self._error = e
+                if self.metrics is not None:
+                    self.metrics.observe("write", time.perf_counter() - t0)
+
+    def location(self, idx):
+        return self.writer.location(idx)
+
+    def write(self, idx, instance_id, xml_bytes):
+        if self._error is not None:
+            raise self._error
+        self._queue.put((idx, instance_id, xml_bytes))
+
+    def close(self):
+        self._queue.put(self._STOP)
+        self._thread.join()
+        self.writer.close()
+        if self._error is not None:
+            raise self._error
+
+def open_instance_writer(output_format, output_root, name="instances", metrics=None):
+    """
+    Writer for one run's local instance copies; see OUTPUT_FORMATS.
+    Archive/bundle files are named {name}-{timestamp} inside output_root.
+    Everything except 'none' writes on a background thread.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format '{output_format}' (choose from {', '.join(OUTPUT_FORMATS)}).")
+    if output_format == "none":
+        return NullInstanceWriter()
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    if output_format == "dirs":
+        writer = DirInstanceWriter(output_root)
+    elif output_format == "zip":
+        writer = ZipInstanceWriter(os.path.join(output_root, f"{name}-{stamp}.zip"))
+    elif output_format == "tar":
+        writer = TarInstanceWriter(os.path.join(output_root, f"{name}-{stamp}.tar.gz"))
+    else:
+        writer = JsonlInstanceWriter(os.path.join(output_root, f"{name}-{stamp}.jsonl"))
+    return BackgroundWriter(writer, metrics=metrics)
+
+# -----------------------
+# Row projection
+# -----------------------
+def _coerce_integer(value):
+    try:
+        return str(int(value))
+    except ValueError:
+        f = float(value)  # accept "3.0" from spreadsheet exports
+        if not f.is_integer():
+            raise ValueError("not a whole number") from None
+        return str(int(f))
+
+def _coerce_decimal(value):
+    if not math.isfinite(float(value)):
+        raise ValueError("not a finite number")
+    return value
+
+# Form field type -> value check/normalization applied when coercion is on
+FIELD_COERCERS = {
+    "integer": _coerce_integer,
+    "decimal": _coerce_decimal,
+    "range": _coerce_decimal,
+}
+
+def read_csv_header(csv_path):
+    """
+    Normalized header of a CSV (see normalize_header).
+    """
+    with open(csv_path, "r", newline="", encoding="utf-8-sig") as f:
+        return _read_header(csv.reader(f))
+
+def _read_header(reader):
+    header = next(reader, None)
+    if not header or not any(h.strip() for h in header):
+        raise ValueError("CSV has no header row.")
+    return [normalize_header(h) for h in header]
+
+class RowPlan:
+    """
+    How a CSV row becomes form values, compiled once from the CSV header,
+    the mapping { form_field_name -> csv_column } and optionally the form's
+    field types ({ name: type }, enables FIELD_COERCERS).
+    Rows are the lists csv.reader yields; each one is projected by column
+    index into a tuple in field_names order, with no per-row dict.
+    """
+    def __init__(self, header, mapping, field_types=None, time_column=CSV_COL_TIME):
+        self.header = list(header)
+        pairs = [(f, c) for f, c in mapping.items() if c]
+        missing = [c for c in [time_column] + [c for _, c in pairs] if c not in self.header]
+        if missing:
+            raise ValueError(f"CSV missing required columns: {missing}")
+
+        self.time_index = self.header.index(time_column)
+        self.field_names = tuple(f for f, _ in pairs)
+        self.indices = tuple(self.header.index(c) for _, c in pairs)
+        types = field_types or {}
+        self.types = tuple(types.get(f) for f in self.field_names)
+        self.coercers = tuple(FIELD_COERCERS.get(t) for t in self.types)
+        self._coerce = any(self.coercers)
+        # instanceIDs hash the fields sorted by name (see derive_instance_uuid)
+        self._id_order = sorted(range(len(self.field_names)), key=self.field_names.__getitem__)
+
+    def values(self, row):
+        """
+        Stripped (and coerced) field values of one row.
+        Raises ValueError naming the field when a value does not fit its type.
+        """
+        vals = tuple([row[i].strip() for i in self.indices])
+        if not self._coerce:
+            return vals
+        out = list(vals)
+        for k, coerce in enumerate(self.coercers):
+            if coerce is not None and out[k]:
+                try:
+                    out[k] = coerce(out[k])
+                except ValueError:
+                    raise ValueError(
+                        f"bad value '{out[k]}' for {self.field_names[k]} ({self.types[k]})") from None
+        return tuple(out)
+
+    def instance_uuid(self, form_id, iso_time, values, occurrence=0):
+        names = self.field_names
+        return _instance_uuid(form_id, iso_time, ((names[i], values[i]) for i in self._id_order), occurrence)
+
+# -----------------------
+# Input formats
+# -----------------------
+# The project's own producers write different layouts; the header picks the
+# format, whose time parser turns each row's time cell into ISO8601 inside
+# the normal pipeline (no conversion pass, no intermediate file).
+_CLOCK_TIME_RE = re.compile(r"([0-9]{1,2}):([0-9]{2}):([0-9]{2})")  # ASCII digits, as in _CSV_TIME_RE
+_ANDROID_EXPORT_RE = re.compile(r"batches_([0-9]{12,})")  # batches_<epoch ms>.csv from the app
+
+def parse_session_start(value, tz_name=DEFAULT_TIMEZONE):
+    """
+    'MM/DD/YYYY HH:MM:SS' local time (like the Time column) -> aware datetime.
+    """
+    return datetime.fromisoformat(get_time_parser(tz_name).parse(value))
+
+def parse_session_starts(value, tz_name=DEFAULT_TIMEZONE):
+    """
+    One or more session start times separated by ';' (one per power-on of
+    the XIAO logger, in file order) -> list of aware datetimes.
+    """
+    starts = [parse_session_start(v, tz_name) for v in value.split(";") if v.strip()]
+    if not starts:
+        raise ValueError("no session start given")
+    return starts
+
+def format_session_starts(starts):
+    """
+    The text parse_session_starts reads back.
+    """
+    return "; ".join(s.strftime(CSV_TIME_FORMAT) for s in starts)
+
+class ClickerCsvFormat:
+    """
+    The uploader's own layout: a Time column in CSV_TIME_FORMAT, local time.
+    Formats are chosen by detect_input_format; time_parser() returns a fresh
+    object with parse(s) -> ISO string (ValueError for a bad cell) and
+    parse_many(values) (see CsvTimeParser), to be fed the rows in file order.
+    """
+    name = "clicker"
+    time_column = CSV_COL_TIME
+
+    @classmethod
+    def matches(cls, header):
+        return cls.time_column in header
+
+    def __init__(self, csv_path, header, tz_name=DEFAULT_TIMEZONE, session_start=None):
+        self.csv_path = csv_path
+        self.header = header
+        self.tz_name = tz_name
+        if isinstance(session_start, datetime):
+            session_start = [session_start]
+        self.session_starts = list(session_start or ())
+        self.session_start = self.session_starts[0] if self.session_starts else None
+
+    def describe(self):
+        return None
+
+    def time_parser(self):
+        return get_time_parser(self.tz_name)
+
+    def complete_tail(self, row):
+        """
+        Whether a last row without a newline, in a file that stopped growing,
+        is whole (see FollowedCsv.read_rows). These producers end every row
+        with a newline, so a row without one may still be being written.
+        """
+        return False
+
+class _SequentialClock:
+    def parse_many(self, values):
+        isos = []
+        errors = []
+        for i, v in enumerate(values):
+            try:
+                isos.append(self.parse(v))
+            except Exception as e:
+                isos.append(None)
+                errors.append((i, e))
+        return isos, errors
+
+class _MillisClock(_SequentialClock):
+    """
+    t_ms (millis() since the device booted) -> ISO time. A t_ms lower than the
+    previous one is a restart; the rows of device session i (0-based) are
+    dated from starts[i], those of sessions without a start are errors.
+    """
+    def __init__(self, starts, tz, hint):
+        self.starts = [s.astimezone(timezone.utc) for s in starts]
+        self.tz = tz
+        self.hint = hint
+        self._current = 0
+        self._prev = None
+
+    def parse(self, s):
+        try:
+            ms = int(s.strip())
+        except ValueError:
+            raise ValueError("not a millis() count") from None
+        if self._prev is not None and ms < self._prev:
+            self._current += 1
+        self._prev = ms
+        if self._current >= len(self.starts):
+            raise ValueError(self.hint)
+        start = self.starts[self._current]
+        return (start + timedelta(milliseconds=ms)).astimezone(self.tz).isoformat(timespec="milliseconds")
+
+class FirmwareSdFormat(ClickerCsvFormat):
+    """
+    The XIAO logger's data.csv: t_ms,b1,b2,b3,b4 where t_ms is millis() since
+    the device booted. The device has no clock (the file's modification time
+    is the SD library's fixed default), so the time it was switched on must
+    be given: times are session_start + t_ms. The file is appended across
+    restarts (t_ms starts again from 0); with a list of starts, one per
+    power-on in file order, each session's rows are dated from its own start,
+    and rows of sessions without one are skipped with a hint.
+    """
+    name = "xiao-sd"
+    time_column = "t_ms"
+
+    @classmethod
+    def matches(cls, header):
+        return header[:1] == [cls.time_column]
+
+    def __init__(self, csv_path, header, tz_name=DEFAULT_TIMEZONE, session_start=None):
+        super().__init__(csv_path, header, tz_name, session_start)
+        if not self.session_starts:
+            raise ValueError('XIAO SD log (t_ms): the device has no clock; give the time it was switched on '
+                             '(session start "MM/DD/YYYY HH:MM:SS", one per power-on separated by ";")')
+        self.hint = ("recorded after a device restart (t_ms went back); "
+                     "give one session start per power-on to upload it")
+
+    def describe(self):
+        starts = format_session_starts(self.session_starts)
+        return f"[FORMAT] XIAO SD log: t_ms counted from {starts} (one per power-on)"
+
+    def time_parser(self):
+        return _MillisClock(self.session_starts, ZoneInfo(self.tz_name), self.hint)
+
+class _TimeOfDayClock(_SequentialClock):
+    """
+    HH:MM:SS -> ISO time on `day`, moving to the next day whenever the clock
+    goes back (midnight). With `latest` (the export time) the first row is put
+    on the day before if it is later in the day than the export. Full
+    MM/DD/YYYY HH:MM:SS values are parsed as usual.
+    """
+    def __init__(self, day, tz_name, latest=None):
+        self.day = day
+        self.tz = ZoneInfo(tz_name)
+        self.latest = latest
+        self.full = get_time_parser(tz_name)
+        self._prev = None
+
+    def parse(self, s):
+        s = s.strip()
+        m = _CLOCK_TIME_RE.fullmatch(s)
+        if m is None:
+            return self.full.parse(s)
+        hh, mi, ss = map(int, m.groups())
+        if hh > 23 or mi > 59 or ss > 59:
+            raise ValueError("not a valid time of day")
+        t = (hh, mi, ss)
+        if self._prev is None:
+            if self.latest is not None and t > (self.latest.hour, self.latest.minute, self.latest.second):
+                self.day -= timedelta(days=1)
+        elif t < self._prev:
+            self.day += timedelta(days=1)
+        self._prev = t
+        return datetime(self.day.year, self.day.month, self.day.day, hh, mi, ss,
+                        tzinfo=self.tz).isoformat(timespec="seconds")
+
+class AndroidExportFormat(ClickerCsvFormat):
+    """
+    The Android app's batchesToCsv export: Timestamp,Female,Male,Elderly with
+    Timestamp as the phone's HH:mm:ss. The date is session_start's, or else
+    the export time: the batches_<epoch ms>.csv name the app gives the file,
+    or the file's modification time.
+    """
+    name = "android"
+    time_column = "timestamp"
+
+    @classmethod
+    def matches(cls, header):
+        return header[:1] == [cls.time_column]
+
+    def __init__(self, csv_path, header, tz_name=DEFAULT_TIMEZONE, session_start=None):
+        super().__init__(csv_path, header, tz_name, session_start)
+        self.exported = None
+        if session_start is None:
+            tz = ZoneInfo(tz_name)
+            m = _ANDROID_EXPORT_RE.search(os.path.basename(csv_path))
+            if m:
+                self.exported = datetime.fromtimestamp(int(m.group(1)) / 1000, tz)
+            else:
+                self.exported = datetime.fromtimestamp(os.path.getmtime(csv_path), tz)
+
+    def describe(self):
+        if self.exported is None:
+            return f"[FORMAT] Android export: times of day from {self.session_start.strftime('%m/%d/%Y')}"
+        return f"[FORMAT] Android export: times of day up to the export at {self.exported.strftime(CSV_TIME_FORMAT)}"
+
+    def complete_tail(self, row):
+        # batchesToCsv joins rows with "\n" and writes the file at once: its
+        # last row never has a newline. Take it when every cell is there.
+        time_index = self.header.index(self.time_column)
+        return (len(row) == len(self.header) and all(c.strip() for c in row)
+                and _CLOCK_TIME_RE.fullmatch(row[time_index].strip()) is not None)
+
+    def time_parser(self):
+        if self.exported is None:
+            return _TimeOfDayClock(self.session_start.date(), self.tz_name)
+        return _TimeOfDayClock(self.exported.date(), self.tz_name, latest=self.exported)
+
+# Checked in order; the first format whose header matches reads the file
+INPUT_FORMATS = (FirmwareSdFormat, AndroidExportFormat, ClickerCsvFormat)
+
+def detect_input_format(csv_path, header=None, tz_name=DEFAULT_TIMEZONE, session_start=None):
+    """
+    The input format for a CSV, chosen from its (normalized) header.
+    session_start: aware datetime, or list of them (see parse_session_starts),
+                   anchoring formats without full dates; required for the
+                   XIAO SD log.
+    """
+    if header is None:
+        header = read_csv_header(csv_path)
+    for fmt in INPUT_FORMATS:
+        if fmt.matches(header):
+            return fmt(csv_path, header, tz_name, session_start)
+    raise ValueError(f"CSV missing required columns: {[CSV_COL_TIME]} "
+                     f"(or the t_ms / Timestamp layouts of the XIAO logger and the Android app)")
+
+# -----------------------
+# Streaming pipeline
+# -----------------------
+# Each stage is a generator pulling one row at a time from the previous one,
+# so nothing is read ahead of what the submission window can absorb.
+
+def iter_csv_rows(csv_path, required=None, metrics=None):
+    """
+    Stage 1: read. Yields (idx, row) where row is the list of raw cell values,
+    padded to the header width; see RowPlan for turning it into field values.
+    Header checks run before the first row.
+    required: normalized columns that must be present (default: the time column).
+    metrics: optional UploadMetrics ("read_csv" stage).
+    """
+    if required is None:
+        required = [CSV_COL_TIME]
+
+    with open(csv_path, "r", newline="", encoding="utf-8-sig") as f:
+        reader = csv.reader(f)
+        header = _read_header(reader)
+
+        # Validate required columns exist
+        missing = [c for c in required if c not in header]
+        if missing:
+            raise ValueError(f"CSV missing required columns: {missing}")
+
+        width = len(header)
+        clock = time.perf_counter
+        t0 = clock()
+        idx = 0
+        for row in reader:
+            if not row:
+                continue  # blank lines are not rows (same numbering csv.DictReader gave)
+            idx += 1
+            if len(row) < width:
+                row += [""] * (width - len(row))
+            if metrics is not None:
+                metrics.observe("read_csv", clock() - t0)
+            yield idx, row
+            t0 = clock()
+
+PARSE_CHUNK_BYTES = 32 << 20  # bytes of CSV per worker task in iter_csv_rows_parallel
+
+def read_csv_layout(csv_path):
+    """
+    (normalized header, byte offset of the first data row, file size).
+    """
+    with open(csv_path, "rb") as f:
+        head = b""
+        while True:
+            piece = f.read(1 << 16)
+            head += piece
+            end = first_record_end(head)
+            if end or not piece:
+                break
+        size = os.fstat(f.fileno()).st_size
+    end = end or len(head)
+    header = _read_header(csv.reader(io.StringIO(head[:end].decode("utf-8-sig"), newline="")))
+    return header, end, size
+
+def _count_quotes(csv_path, start, end):
+    with open(csv_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return mm[start:end].count(b'"')
+
+def _record_start(mm, pos, quoted):
+    """
+    First record boundary after `pos`: a newline outside quotes, knowing
+    whether `pos` itself is inside a quoted value.
+    """
+    quotes = 1 if quoted else 0
+    while True:
+        nl = mm.find(b"\n", pos)
+        if nl < 0:
+            return len(mm)
+        quotes += mm[pos:nl + 1].count(b'"')
+        pos = nl + 1
+        if quotes % 2 == 0:
+            return pos
+
+def _parse_csv_chunk(csv_path, start, start_quoted, end, end_quoted, width):
+    """
+    Worker for iter_csv_rows_parallel: the rows of the records between the
+    boundaries found from `start` and `end` (None = end of file), as tuples
+    padded to `width`. start_quoted=None means `start` is itself a boundary.
+    """
+    with open(csv_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        begin = start if start_quoted is None else _record_start(mm, start, start_quoted)
+        stop = len(mm) if end is None else _record_start(mm, end, end_quoted)
+        if begin >= stop:
+            return []
+        text = mm[begin:stop].decode("utf-8")
+    pad = [""] * width
+    rows = []
+    for row in csv.reader(io.StringIO(text, newline="")):
+        if not row:
+            continue
+        if len(row) < width:
+            row += pad[len(row):]
+        rows.append(tuple(row))
+    return rows
+
+def iter_csv_rows_parallel(csv_path, required=None, metrics=None, processes=None,
+                           chunk_bytes=PARSE_CHUNK_BYTES):
+    """
+    Stage 1 on several cores, for multi-GB CSVs: yields the same (idx, row)
+    as iter_csv_rows, with each row a tuple.
+    The file is memory-mapped and cut every chunk_bytes. A first pass counts
+    the quotes of every piece, so each cut is known to be inside or outside a
+    quoted value and can be moved to the next real record boundary (quoted
+    line breaks are never split). The pieces are then parsed in a pool of
+    `processes` workers and their rows yielded in file order, with at most
+    two pieces per worker parsed ahead of the consumer.
+    metrics: optional UploadMetrics ("read_csv" stage, per-row share of the
+             time spent waiting for each piece).
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    if required is None:
+        required = [CSV_COL_TIME]
+    header, data_start, size = read_csv_layout(csv_path)
+    missing = [c for c in required if c not in header]
+    if missing:
+        raise ValueError(f"CSV missing required columns: {missing}")
+    if size <= data_start:
+        return
+
+    width = len(header)
+    starts = list(range(data_start, size, max(1, int(chunk_bytes))))
+    ends = starts[1:] + [size]
+    processes = max(1, processes or min(4, os.cpu_count() or 1))
+    clock = time.perf_counter
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        quoted, odd = [], False
+        for n in pool.map(_count_quotes, [csv_path] * len(starts), starts, ends):
+            quoted.append(odd)
+            odd ^= n % 2 == 1
+
+        def task(i):
+            last = i + 1 == len(starts)
+            return pool.submit(_parse_csv_chunk, csv_path, starts[i], quoted[i] if i else None,
+                               None if last else ends[i], None if last else quoted[i + 1], width)
+
+        queued = iter(range(len(starts)))
+        pending = deque(task(i) for _, i in zip(range(2 * processes), queued))
+        idx = 0
+        try:
+            while pending:
+                t0 = clock()
+                rows = pending.popleft().result()
+                for i in queued:
+                    pending.append(task(i))
+                    break
+                if metrics is not None and rows:
+                    share = (clock() - t0) / len(rows)
+                    for _ in rows:
+                        metrics.observe("read_csv", share)
+                for row in rows:
+                    idx += 1
+                    yield idx, row
+                del rows
+        finally:
+            for fut in pending:
+                fut.cancel()
+
+def iter_parsed_rows(rows, tz_name=DEFAULT_TIMEZONE, metrics=None, time_index=0, time_parser=None):
+    """
+    Stage 2: parse time. Yields (idx, row, iso_time, skip_msg);
+    skip_msg is set (and iso_time None) for rows that cannot be submitted.
+    time_index: position of the time column (RowPlan.time_index).
+    metrics: optional UploadMetrics ("parse_time" stage).
+    time_parser: the input format's parser (ClickerCsvFormat.time_parser);
+                 default: Time values in tz_name.
+    """
+    parse_time = (time_parser or get_time_parser(tz_name)).parse
+    clock = time.perf_counter
+    for idx, row in rows:
+        time_str = row[time_index].strip()
+        if not time_str:
+            yield idx, row, None, f"[SKIP] Row {idx}: missing Time"
+            continue
+        t0 = clock()
+        try:
+            iso_time = parse_time(time_str)
+            error = None
+        except Exception as e:
+            iso_time, error = None, e
+        if metrics is not None:
+            metrics.observe("parse_time", clock() - t0)
+        if error is not None:
+            yield idx, row, None, f"[SKIP] Row {idx}: bad Time '{time_str}': {error}"
+            continue
+        yield idx, row, iso_time, None
+
+# Per-row bookkeeping carried alongside each submission through submit_ordered
+RowJob = namedtuple("RowJob", ["idx", "location", "instance_id", "skip_msg"])
+
+def derive_instance_uuid(form_id, iso_time, mapped_values: dict, occurrence=0) -> str:
+    """
+    Deterministic instanceID: the same row of the same form always maps to the
+    same uuid, so re-uploads are recognised as duplicates by the server.
+    occurrence distinguishes genuinely repeated identical rows within a file.
+    """
+    items = ((name, mapped_values[name]) for name in sorted(mapped_values))
+    return _instance_uuid(form_id, iso_time, items, occurrence)
+
+def _instance_uuid(form_id, iso_time, items, occurrence):
+    # items: (field name, value) pairs sorted by name
+    parts = [form_id, iso_time]
+    for name, val in items:
+        parts.append(f"{name}={'' if val is None else val}")
+    parts.append(str(occurrence))
+    return str(uuid.uuid5(INSTANCE_ID_NAMESPACE, "\x1f".join(parts)))
+
+def load_journal_ids(path):
+    """
+    Read-only view of a journal: the set of acknowledged instanceIDs.
+    """
+    done = set()
+    if os.path.isfile(path):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    done.add(line)
+    return done
+
+class SubmissionJournal:
+    """
+    Append-only file of instanceIDs the server has acknowledged.
+    A rerun loads it and skips those rows; each acknowledgement is flushed
+    immediately so an interrupted run loses nothing.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.done = load_journal_ids(path)
+        self._fh = open(path, "a", encoding="utf-8")
+
+    def __contains__(self, instance_id):
+        return instance_id in self.done
+
+    def mark(self, instance_id):
+        if instance_id in self.done:
+            return
+        self.done.add(instance_id)
+        self._fh.write(instance_id + "\n")
+        self._fh.flush()
+
+    def close(self):
+        self._fh.close()
+
+def journal_path_for(output_root, form_id):
+    return os.path.join(output_root, f".submitted-{form_id}.journal")
+
+def results_path_for(output_root, form_id):
+    return os.path.join(output_root, f"results-{form_id}.jsonl")
+
+class _JobBuilder:
+    """
+    What stage 3+4 does for every row or time bucket that is sent: the
+    instanceID (identical ones numbered by occurrence), the journal and
+    server-side skips, the XML and its local copy.
+    """
+    def __init__(self, form_id, plan, writer, journal=None, metrics=None, existing=None, occurrences=None):
+        self.form_id = form_id
+        self.plan = plan
+        self.writer = writer
+        self.journal = journal
+        self.metrics = metrics
+        self.existing = existing
+        self.occurrences = {} if occurrences is None else occurrences
+        self.template = SubmissionTemplate(form_id, form_id, plan.field_names)
+
+    def build(self, idx, id_time, start_iso, end_iso, values, t0):
+        """
+        (RowJob, body, content_type) for one row or bucket. id_time is the
+        time part of its instanceID; t0 the perf_counter() its build started at.
+        """
+        form_id, plan = self.form_id, self.plan
+        base_uuid = plan.instance_uuid(form_id, id_time, values)
+        n = self.occurrences.get(base_uuid, 0)
+        self.occurrences[base_uuid] = n + 1
+        inst_uuid = base_uuid if n == 0 else plan.instance_uuid(form_id, id_time, values, n)
+
+        if self.journal is not None and inst_uuid in self.journal:
+            return RowJob(idx, None, inst_uuid, f"[SKIP] Row {idx}: already submitted (uuid:{inst_uuid})"), None, None
+        if self.existing is not None and self.existing.claim(inst_uuid, start_iso, values):
+            return RowJob(idx, None, inst_uuid, f"[SKIP] Row {idx}: already on the server"), None, None
+
+        template = self.template
+        xml_bytes = template.render_values(start_iso, end_iso, values, inst_uuid)
+        body = template.multipart(xml_bytes, display_name=f"instance{idx}.xml")
+        if self.metrics is not None:
+            self.metrics.observe("build_xml", time.perf_counter() - t0)
+
+        self.writer.write(idx, inst_uuid, xml_bytes)
+        return RowJob(idx, self.writer.location(idx), inst_uuid, None), body, template.content_type
+
+def iter_instance_jobs(parsed_rows, form_id, plan, writer, journal=None, metrics=None, existing=None,
+                       occurrences=None):
+    """
+    Stage 3+4: project the row (see RowPlan), build XML and hand it to the
+    local-copy writer (see open_instance_writer).
+    Yields (RowJob, body, content_type) for submit_ordered;
+    skipped rows carry body=None.
+    journal: optional SubmissionJournal, Outbox (or set of instanceIDs); rows
+             already acknowledged (or captured) are skipped.
+    metrics: optional UploadMetrics ("build_xml" stage; "write" is timed by the writer).
+    existing: optional ServerIndex; rows already on the server are skipped.
+    occurrences: optional dict shared between calls over the same file (watch
+                 mode), so identical rows read at different times keep distinct IDs.
+    """
+    clock = time.perf_counter
+    build = _JobBuilder(form_id, plan, writer, journal, metrics, existing, occurrences).build
+    project = plan.values
+
+    for idx, row, iso_time, skip_msg in parsed_rows:
+        if skip_msg:
+            yield RowJob(idx, None, None, skip_msg), None, None
+            continue
+
+        t0 = clock()
+        try:
+            values = project(row)
+        except ValueError as e:
+            yield RowJob(idx, None, None, f"[SKIP] Row {idx}: {e}"), None, None
+            continue
+        yield build(idx, iso_time, iso_time, iso_time, values, t0)
+
+def until_cancelled(jobs, cancel_event):
+    """
+    Pass jobs through until cancel_event is set (checked between rows).
+    """
+    for job in jobs:
+        if cancel_event.is_set():
+            return
+        yield job
+
+def count_csv_rows(csv_path):
+    """
+    Quick data-row count (newlines minus the header) for progress display.
+    Approximate if quoted values contain line breaks.
+    """
+    n = 0
+    last = b"\n"
+    with open(csv_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            n += chunk.count(b"\n")
+            last = chunk[-1:]
+    if last != b"\n":
+        n += 1
+    return max(0, n - 1)
+
+# -----------------------
+# Time buckets
+# -----------------------
+# Optional stage between parsing and building: one submission per time window
+# instead of one per row, for high-frequency counting sessions.
+BUCKET_MODES = ("sum", "last")  # how a window's values are combined
+DEFAULT_BUCKET_MODE = "sum"
+_WINDOW_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+_LOCAL_EPOCH = datetime(1970, 1, 1)
+
+def parse_window(text):
+    """
+    '90', '30s', '5m', '1h', '1d' -> seconds.
+    """
+    s = str(text).strip().lower()
+    unit = _WINDOW_UNITS.get(s[-1:])
+    try:
+        seconds = float(s[:-1] if unit else s) * (unit or 1)
+    except ValueError:
+        seconds = 0
+    if not seconds > 0 or not math.isfinite(seconds):
+        raise ValueError(f"bad time window '{text}' (e.g. 30s, 5m, 1h)")
+    return seconds
+
+def _bucket_key(iso_time, window):
+    # Windows follow the CSV's local wall clock: an hour bucket is 10:00-11:00 local time
+    return int((datetime.fromisoformat(iso_time[:19]) - _LOCAL_EPOCH).total_seconds() // window)
+
+def _add_value(total, value):
+    if not value:
+        return total
+    try:
+        n = int(value)
+    except ValueError:
+        try:
+            n = Decimal(value)
+        except InvalidOperation:
+            n = None
+        if n is None or not n.is_finite():
+            raise ValueError("not a number") from None
+    return n if total is None else total + n
+
+def iter_time_buckets(parsed_rows, plan, window, how=DEFAULT_BUCKET_MODE):
+    """
+    Aggregation stage: groups consecutive rows whose times fall in the same
+    `window`-second interval and combines each field's values: "sum" adds
+    them (blanks count as nothing), "last" keeps the last non-blank one.
+    Yields (idx, start_iso, end_iso, values, skip_msg) per bucket, idx being
+    its first row and start/end its first and last row times; rows that
+    cannot be used pass through as skips. A row whose time goes back to an
+    earlier window starts a new bucket.
+    """
+    if how not in BUCKET_MODES:
+        raise ValueError(f"bucket mode must be one of {BUCKET_MODES}")
+    project = plan.values
+    names = plan.field_names
+    summing = how == "sum"
+    bucket = None  # [key, idx, start_iso, end_iso, values]
+
+    def close(b):
+        vals = b[4]
+        if summing:
+            vals = tuple("" if v is None else str(v) for v in vals)
+        return b[1], b[2], b[3], tuple(vals), None
+
+    for idx, row, iso_time, skip_msg in parsed_rows:
+        if skip_msg:
+            yield idx, None, None, None, skip_msg
+            continue
+        try:
+            values = project(row)
+            key = _bucket_key(iso_time, window)
+            if bucket is not None and bucket[0] == key:
+                acc = bucket[4]
+            else:
+                acc = [None] * len(values) if summing else [""] * len(values)
+            if summing:
+                new = []
+                for k, v in enumerate(values):
+                    try:
+                        new.append(_add_value(acc[k], v))
+                    except ValueError:
+                        raise ValueError(f"bad value '{v}' for {names[k]} (sum)") from None
+            else:
+                new = [v or t for t, v in zip(acc, values)]
+        except ValueError as e:
+            yield idx, None, None, None, f"[SKIP] Row {idx}: {e}"
+            continue
+        if bucket is not None and bucket[0] == key:
+            bucket[3] = iso_time
+            bucket[4] = new
+        else:
+            if bucket is not None:
+                yield close(bucket)
+            bucket = [key, idx, iso_time, iso_time, new]
+    if bucket is not None:
+        yield close(bucket)
+
+def iter_bucket_jobs(buckets, form_id, plan, writer, how=DEFAULT_BUCKET_MODE, journal=None, metrics=None,
+                     existing=None):
+    """
+    Stage 3+4 for time buckets (see iter_time_buckets), like iter_instance_jobs:
+    yields (RowJob, body, content_type) with start/end set to the bucket's
+    first and last time. A bucket's instanceID covers its time span, mode
+    and combined values, so reruns over the same CSV give the same IDs.
+    """
+    clock = time.perf_counter
+    build = _JobBuilder(form_id, plan, writer, journal, metrics, existing).build
+
+    for idx, start_iso, end_iso, values, skip_msg in buckets:
+        if skip_msg:
+            yield RowJob(idx, None, None, skip_msg), None, None
+            continue
+        yield build(idx, f"{start_iso}/{end_iso}/{how}", start_iso, end_iso, values, clock())
+
+# -----------------------
+# Server-side duplicates
+# -----------------------
+DATA_PAGE_SIZE = 10000  # records per /data/ page (KPI allows up to 30000)
+
+def _row_key(start_iso, values):
+    # Same instant and same values, whatever offset/precision the server stored.
+    # A digest, not hash(): the index is pickled into batch workers, and string
+    # hashes are seeded per process under spawn (Windows, macOS).
+    try:
+        instant = repr(datetime.fromisoformat(start_iso).timestamp())
+    except (TypeError, ValueError):
+        instant = str(start_iso)
+    parts = [instant] + ["" if v is None else str(v) for v in values]
+    return hashlib.blake2b("\x1f".join(parts).encode("utf-8"), digest_size=8).digest()
+
+class ServerIndex:
+    """
+    Compact index of a form's existing submissions: their instanceIDs, plus a
+    count per (start, values of field_names) for submissions that were made
+    another way (another laptop's run with different settings, Enketo, ...).
+    Built once by kf_fetch_server_index; claim() answers per row.
+    """
+    def __init__(self, field_names):
+        self.field_names = tuple(field_names)
+        self.instance_ids = set()
+        self.rows = {}  # row key -> number of such submissions not yet matched
+        self.records = 0
+
+    def add(self, record):
+        self.records += 1
+        iid = record.get("meta/instanceID") or ""
+        if iid:
+            self.instance_ids.add(iid[5:] if iid.startswith("uuid:") else iid)
+        if record.get("start"):
+            key = _row_key(record["start"], [record.get(n) for n in self.field_names])
+            self.rows[key] = self.rows.get(key, 0) + 1
+
+    def claim(self, instance_id, start_iso, values):
+        """
+        True if this row is already on the server. A matching submission is
+        only claimed once, so n identical rows are kept against n-1 on the server.
+        """
+        key = _row_key(start_iso, values)
+        left = self.rows.get(key, 0)
+        if left:
+            self.rows[key] = left - 1
+        return bool(left) or instance_id in self.instance_ids
+
+def kf_fetch_server_index(kf_base: str, form_uid: str, username: str, password: str, field_names,
+                          page_size=DATA_PAGE_SIZE):
+    """
+    Page once through /api/v2/assets/<uid>/data/, asking only for the fields
+    the index needs, and return a ServerIndex of field_names (in RowPlan order).
+    """
+    index = ServerIndex(field_names)
+    session = make_session(username, password, pool_size=1)
+    url = f"{kf_base}/api/v2/assets/{form_uid}/data/"
+    params = {
+        "format": "json",
+        "limit": page_size,
+        "fields": json.dumps(["meta/instanceID", "start", *index.field_names]),
+    }
+    try:
+        while url:
+            r = session.get(url, params=params, timeout=120)
+            if r.status_code != 200:
+                raise RuntimeError(f"Failed to fetch submitted data ({r.status_code}): {r.text[:300]}")
+            page = r.json()
+            for record in page.get("results") or ():
+                index.add(record)
+            url = page.get("next")
+            params = None  # "next" already carries the query
+    finally:
+        session.close()
+    return index
+
+# -----------------------
+# Pre-validation
+# -----------------------
+VALIDATION_MODES = ("off", "report", "strict")  # strict refuses to upload a CSV with errors
+DEFAULT_VALIDATION = "report"
+VALIDATION_EXAMPLES = 5  # example rows kept per kind of problem
+VALIDATION_CHUNK_ROWS = 10000
+
+# Form type -> the column profile that must be clean for it
+_TYPE_PROBLEMS = {"integer": "not_integer", "decimal": "not_decimal", "range": "not_decimal"}
+
+class CsvValidationError(Exception):
+    pass
+
+class CsvReport:
+    """
+    What validate_csv found in one pass over a CSV, before any network traffic.
+    Every problem is counted; only the first VALIDATION_EXAMPLES rows of each
+    kind are kept. Numeric checks are recorded for every column, so one pass
+    serves any mapping: check() decides which of them matter.
+    """
+    def __init__(self, csv_path, header, time_column=CSV_COL_TIME):
+        self.csv_path = csv_path
+        self.header = header
+        self.time_column = time_column
+        self.rows = 0
+        self.problems = {}  # (kind, column) -> [count, [(idx, detail), ...]]
+
+    def add(self, kind, idx, detail, column=None):
+        entry = self.problems.setdefault((kind, column), [0, []])
+        entry[0] += 1
+        if len(entry[1]) < VALIDATION_EXAMPLES:
+            entry[1].append((idx, detail))
+
+    def _line(self, key, text):
+        count, examples = self.problems[key]
+        shown = "; ".join(f"row {idx}: {detail}" for idx, detail in examples)
+        return f"{text.format(n=count)} — e.g. {shown}"
+
+    def check(self, mapping=None, field_types=None):
+        """
+        Returns (errors, warnings) as lists of readable lines for this mapping
+        { form_field -> csv_column } and form { field -> type }.
+        """
+        errors, warnings = [], []
+        mapping = {f: c for f, c in (mapping or {}).items() if c}
+        missing = sorted({c for c in mapping.values() if c not in self.header})
+        if missing:
+            errors.append(f"CSV missing required columns: {missing}")
+        if ("time", None) in self.problems:
+            errors.append(self._line(("time", None), "{n} row(s) with a missing or bad Time"))
+        for field, column in mapping.items():
+            ftype = (field_types or {}).get(field)
+            key = (_TYPE_PROBLEMS.get(ftype), column)
+            if key in self.problems:
+                errors.append(self._line(key, f"{{n}} value(s) in '{column}' are not valid for "
+                                              f"{field} ({ftype})"))
+        if ("duplicate", None) in self.problems:
+            warnings.append(self._line(("duplicate", None), "{n} row(s) repeat an earlier row exactly"))
+        if ("out_of_order", None) in self.problems:
+            warnings.append(self._line(("out_of_order", None), "{n} row(s) are earlier than the row before"))
+        return errors, warnings
+
+    def format(self, mapping=None, field_types=None):
+        errors, warnings = self.check(mapping, field_types)
+        lines = [f"Checked {self.rows} rows of {self.csv_path}: "
+                 f"{len(errors)} error(s), {len(warnings)} warning(s)."]
+        lines += [f"[ERROR] {e}" for e in errors]
+        lines += [f"[WARN] {w}" for w in warnings]
+        return "\n".join(lines)
+
+def validate_csv(csv_path, tz_name=DEFAULT_TIMEZONE, chunk_rows=VALIDATION_CHUNK_ROWS, session_start=None,
+                 processes=None):
+    """
+    One fast pass over the whole file, VALIDATION_CHUNK_ROWS rows at a time and
+    column by column: Time format (the input format's parse_many), integer/decimal
+    profile of every other column, exact duplicate rows and times going
+    backwards. Row numbers match iter_csv_rows. Returns a CsvReport.
+    session_start: as in detect_input_format.
+    processes: read the file with iter_csv_rows_parallel (as --parse-processes
+               does for the upload); the checks themselves stay in-process.
+    """
+    header = read_csv_layout(csv_path)[0] if processes else read_csv_header(csv_path)
+    fmt = detect_input_format(csv_path, header, tz_name, session_start)
+    report = CsvReport(csv_path, header, fmt.time_column)
+    time_index = header.index(fmt.time_column)
+    value_columns = [(i, c) for i, c in enumerate(header) if i != time_index and c]
+    parse_many = fmt.time_parser().parse_many
+    seen = {}  # hash of the raw row -> first row number
+    state = {"prev": None}
+
+    def check_chunk(first_idx, chunk):
+        columns = list(zip(*chunk))
+        times = [t.strip() for t in columns[time_index]]
+        isos, bad = parse_many(times)
+        for i, e in bad:
+            detail = f"bad Time '{times[i]}'" if times[i] else "missing Time"
+            if times[i] and fmt.name != ClickerCsvFormat.name:
+                detail += f" ({e})"  # e.g. a row from another device session
+            report.add("time", first_idx + i, detail)
+        prev = state["prev"]
+        for i, iso in enumerate(isos):
+            if iso is None:
+                continue
+            if prev is not None:
+                # Same UTC offset: the ISO strings sort like the instants they name
+                if iso[19:] == prev[0][19:]:
+                    earlier = iso < prev[0]
+                else:
+                    earlier = datetime.fromisoformat(iso) < datetime.fromisoformat(prev[0])
+                if earlier:
+                    report.add("out_of_order", first_idx + i, f"{times[i]} after {prev[1]}")
+            prev = (iso, times[i])
+        state["prev"] = prev
+
+        for col_idx, name in value_columns:
+            column = columns[col_idx]
+            joined = "".join(column)
+            if joined.isascii() and joined.isdigit():
+                continue  # whole chunk of this column is plain counts
+            for i, v in enumerate(column):
+                v = v.strip()
+                if not v or (v.isascii() and v.isdigit()):  # isdigit alone takes "²"
+                    continue
+                for kind, coerce in (("not_integer", _coerce_integer), ("not_decimal", _coerce_decimal)):
+                    try:
+                        coerce(v)
+                    except ValueError:
+                        report.add(kind, first_idx + i, f"'{v}'", column=name)
+
+        for i, row in enumerate(chunk):
+            first = seen.setdefault(hash(tuple(row)), first_idx + i)
+            if first != first_idx + i:
+                report.add("duplicate", first_idx + i, f"same as row {first}")
+
+    chunk = []
+    if processes:
+        rows = iter_csv_rows_parallel(csv_path, [fmt.time_column], processes=processes)
+    else:
+        rows = iter_csv_rows(csv_path, [fmt.time_column])
+    idx = first_idx = 0
+    for idx, row in rows:
+        if not chunk:
+            first_idx = idx
+        chunk.append(row)
+        if len(chunk) >= chunk_rows:
+            check_chunk(first_idx, chunk)
+            chunk = []
+    if chunk:
+        check_chunk(first_idx, chunk)
+    report.rows = idx
+    return report
+
+def check_before_upload(report, mapping, field_types=None, mode=DEFAULT_VALIDATION):
+    """
+    Returns the report text for this mapping (None when mode is "off");
+    in strict mode raises CsvValidationError (with that text) if there are errors.
+    """
+    if mode == "off" or report is None:
+        return None
+    text = report.format(mapping, field_types)
+    if mode == "strict" and report.check(mapping, field_types)[0]:
+        raise CsvValidationError(text)
+    return text
+
+# -----------------------
+# Core uploader
+# -----------------------
+class ResultLog:
+    """
+    Append-only JSONL log with one record per row result, e.g.
+    {"run": "...", "row": 12, "instance_id": "uuid:...", "status": "failed",
+     "http_status": 500, "elapsed": 1.27, "attempts": 5, "error": null, ...}
+    Records of every run are appended; "run" is the UTC start time of the run.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.run = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        self._fh = open(path, "a", encoding="utf-8")
+
+    def write(self, record):
+        self._fh.write(json.dumps({"run": self.run, **record}, separators=(",", ":")) + "\n")
+
+    def close(self):
+        self._fh.close()
+
+def open_result_log(results_log, output_root, form_id):
+    """
+    results_log: None for the default file in output_root (see results_path_for),
+    a path, or False for no log.
+    """
+    if results_log is False:
+        return None
+    return ResultLog(results_log or results_path_for(output_root, form_id))
+
+def response_excerpt(response, limit=300):
+    text = " ".join((response.text or "").split())
+    return text if len(text) <= limit else text[:limit] + " …"
+
+def _emitter(on_result=None):
+    """
+    msg -> printed and handed to on_result, as every run reports progress.
+    """
+    def emit(msg):
+        print(msg)
+        if on_result:
+            on_result(msg)
+    return emit
+
+def _pause_message(seconds):
+    return f"[PAUSE] Server keeps failing; pausing all submissions for {seconds:.0f}s"
+
+class UploadTally:
+    """
+    Turns each (RowJob, SubmitOutcome) of one CSV into a result record and a
+    short per-row message, keeping counts, failed rows, the journal and
+    metrics up to date. Records go to `results` (a ResultLog) and `on_record`;
+    only the last RESULT_TAIL_LINES messages are kept (`tail`).
+    Must be fed in row order.
+    """
+    def __init__(self, journal=None, metrics=None, on_result=None, label=None, results=None,
+                 on_record=None):
+        self.journal = journal
+        self.metrics = metrics
+        self.on_result = on_result
+        self.on_record = on_record
+        self.results = results
+        self.source = label
+        self.label = label
+        self.submitted = self.failed = self.skipped = self.duplicates = 0
+        self.failures = {}
+        self.tail = deque(maxlen=RESULT_TAIL_LINES)
+
+    def emit(self, msg):
+        if self.label is not None:
+            # first message of a file in a batch run gets a header
+            msg = f"== {self.label}\n{msg}"
+            self.label = None
+        self.tail.append(msg)
+        print(msg)
+        if self.on_result:
+            self.on_result(msg)
+
+    def report_pause(self, seconds):
+        self.emit(_pause_message(seconds))
+
+    def _log(self, record):
+        if self.source is not None:
+            record["file"] = self.source
+        if self.results is not None:
+            self.results.write(record)
+        if self.on_record:
+            self.on_record(record)
+
+    def record(self, job, outcome):
+        metrics = self.metrics
+        if job.skip_msg:
+            self.skipped += 1
+            if metrics is not None:
+                metrics.count("skipped")
+            self._log({"row": job.idx, "instance_id": job.instance_id, "status": "skipped",
+                       "http_status": None, "elapsed": 0.0, "attempts": 0, "error": None,
+                       "detail": job.skip_msg})
+            self.emit(job.skip_msg)
+            return
+
+        r = outcome.response
+        ok = r is not None and r.ok
+        if metrics is not None:
+            metrics.observe("submit", outcome.elapsed)
+            if outcome.attempts > 1:
+                metrics.count("retried", outcome.attempts - 1)
+            metrics.count("submitted" if ok else "failed")
+        # 201 = created, 202 = server already has this instanceID
+        if ok:
+            self.submitted += 1
+            status = "duplicate" if r.status_code == 202 else "submitted"
+            if status == "duplicate":
+                self.duplicates += 1
+            if self.journal is not None:
+                self.journal.mark(job.instance_id)
+        else:
+            self.failed += 1
+            status = "failed"
+            self.failures.setdefault(failure_reason(outcome), []).append(job.idx)
+
+        detail = None
+        if outcome.error is not None:
+            detail = str(outcome.error)
+        elif not ok:
+            detail = response_excerpt(r)
+        self._log({"row": job.idx, "instance_id": job.instance_id, "status": status,
+                   "http_status": r.status_code if r is not None else None,
+                   "elapsed": round(outcome.elapsed, 4), "attempts": outcome.attempts,
+                   "error": type(outcome.error).__name__ if outcome.error is not None else None,
+                   "detail": detail})
+
+        tries = f" (after {outcome.attempts} attempts)" if outcome.attempts > 1 else ""
+        if r is None:
+            msg = f"{job.location}: ERROR submitting{tries}: {detail}"
+        elif ok:
+            msg = f"{job.location}: {r.status_code}{tries}"
+        else:
+            msg = f"{job.location}: {r.status_code}{tries} {detail}"
+        self.emit(msg)
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+        if self.results is not None:
+            self.results.close()
+
+    def summary(self, status="Done"):
+        summary = f"{status}: {self.submitted} submitted, {self.failed} failed, {self.skipped} skipped."
+        if self.duplicates:
+            summary += f" ({self.duplicates} already on the server)"
+        if self.failures:
+            summary += "\n" + format_failed_rows(self.failures)
+        if self.results is not None:
+            summary += f"\nPer-row results: {self.results.path}"
+        return summary
+
+def run_upload_dynamic(username, password, survey_link, csv_path, output_root, mapping,
+                       max_in_flight=DEFAULT_MAX_IN_FLIGHT, rate_limit=DEFAULT_RATE_LIMIT,
+                       on_result=None, tz_name=DEFAULT_TIMEZONE, resume=True, cancel_event=None,
+                       output_format=DEFAULT_OUTPUT_FORMAT, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                       kc_base=None, metrics=None, results_log=None, on_record=None, field_types=None,
+                       dedupe=False, kf_base=None, outbox=None, capture_only=False, parse_processes=None,
+                       bucket_window=None, bucket_mode=DEFAULT_BUCKET_MODE, session=None, gate=None,
+                       session_start=None):
+    """
+    mapping: dict { form_field_name -> csv_column } (normalized CSV header, any number of fields)
+    max_in_flight: number of submissions allowed to be outstanding at once
+    rate_limit: optional cap on submissions per second (None = unlimited)
+    on_result: optional callback(msg) receiving each per-row message as it completes
+    tz_name: IANA timezone the CSV times were recorded in
+    resume: keep a journal of acknowledged rows in output_root and skip them on rerun
+    cancel_event: optional threading.Event; once set no new rows are started and
+                  the run stops after the submissions already in flight
+    output_format: local copy of the instances, one of OUTPUT_FORMATS
+    max_attempts: tries per row for timeouts, connection errors, 429 and 5xx
+    kc_base: KoboCAT base URL; derived from survey_link when not given
+    metrics: optional UploadMetrics collecting stage timings and outcome counters
+    results_log: JSONL file of per-row result records (see ResultLog); None for
+                 results-<form>.jsonl in output_root, False for none
+    on_record: optional callback(record) receiving each per-row result record
+    field_types: optional { form_field_name -> form type }; integer/decimal values
+                 are then checked and normalized (see FIELD_COERCERS)
+    dedupe: first index the form's existing submissions (kf_fetch_server_index)
+            and skip rows that are already on the server
+    kf_base: KPI base URL for dedupe; derived from survey_link when not given
+    outbox: path of an SQLite outbox (see Outbox). Built instances are first
+            captured there (rows already in it are skipped; resume is not
+            needed), then the outbox is drained
+    capture_only: with outbox, only capture; run_outbox_drain submits later
+    parse_processes: read the CSV in this many worker processes
+                     (iter_csv_rows_parallel, for multi-GB files); None reads it in-process
+    bucket_window: seconds; submit one instance per time window instead of one
+                   per row, values combined per bucket_mode (see iter_time_buckets)
+    session: optional warm requests.Session to submit with (see make_session)
+    gate: optional FairScheduler slot shared with other uploads
+    session_start: optional aware datetime (or list, see parse_session_starts)
+                   for input formats without full dates (XIAO SD log,
+                   Android export; see detect_input_format)
+
+    Rows are streamed from the CSV; per-row messages are printed and handed to
+    on_result instead of being accumulated. Returns a short summary.
+    """
+    form_id = parse_form_id_from_link(survey_link)
+    kc_base = (kc_base or derive_kc_base_from_link(survey_link)).rstrip("/")
+    submit_url = f"{kc_base}/submission"
+
+    fmt = detect_input_format(csv_path, tz_name=tz_name, session_start=session_start)
+    plan = RowPlan(fmt.header, mapping, field_types, time_column=fmt.time_column)
+
+    existing = None
+    if dedupe:
+        kf_base = (kf_base or derive_kf_base_from_link(survey_link)).rstrip("/")
+        existing = kf_fetch_server_index(kf_base, form_id, username, password, plan.field_names)
+
+    os.makedirs(output_root, exist_ok=True)
+
+    if session is None:
+        session = make_session(username, password, pool_size=max_in_flight)
+
+    box = Outbox(outbox) if outbox else None
+    journal = SubmissionJournal(journal_path_for(output_root, form_id)) if resume and box is None else None
+    writer = open_instance_writer(output_format, output_root, name=f"instances-{form_id}", metrics=metrics)
+
+    if parse_processes:
+        rows = iter_csv_rows_parallel(csv_path, [fmt.time_column], metrics=metrics, processes=parse_processes)
+    else:
+        rows = iter_csv_rows(csv_path, [fmt.time_column], metrics=metrics)
+    parsed = iter_parsed_rows(rows, tz_name, metrics=metrics, time_index=plan.time_index,
+                              time_parser=fmt.time_parser())
+    done = box if box is not None else journal
+    if bucket_window:
+        buckets = iter_time_buckets(parsed, plan, bucket_window, bucket_mode)
+        jobs = iter_bucket_jobs(buckets, form_id, plan, writer, bucket_mode, journal=done, metrics=metrics,
+                                existing=existing)
+    else:
+        jobs = iter_instance_jobs(parsed, form_id, plan, writer, journal=done, metrics=metrics, existing=existing)
+    if cancel_event is not None:
+        jobs = until_cancelled(jobs, cancel_event)
+
+    tally = UploadTally(journal=journal, metrics=metrics, on_result=on_result,
+                        results=open_result_log(results_log, output_root, form_id), on_record=on_record)
+    if fmt.describe():
+        tally.emit(fmt.describe())
+    if existing is not None:
+        tally.emit(f"[DEDUPE] The form already has {existing.records} submission(s) on the server.")
+    if bucket_window:
+        tally.emit(f"[BUCKETS] One submission per {bucket_window:g}s window ({bucket_mode} of each field).")
+    breaker = CircuitBreaker(on_open=tally.report_pause)
+    policy = RetryPolicy(max_attempts=max_attempts)
+
+    try:
+        if box is not None:
+            captured = capture_to_outbox(jobs, box, submit_url, tally, csv_path)
+            tally.emit(f"[OUTBOX] {captured} row(s) captured in {box.path}")
+            if not capture_only and not (cancel_event is not None and cancel_event.is_set()):
+                drain_outbox(box, session, tally, max_in_flight=max_in_flight, rate_limit=rate_limit,
+                             policy=policy, breaker=breaker, cancel_event=cancel_event, gate=gate)
+        else:
+            for job, outcome in submit_ordered(
+                    session, submit_url, jobs, max_in_flight=max_in_flight, rate_limit=rate_limit,
+                    policy=policy, breaker=breaker, cancel_event=cancel_event, gate=gate):
+                tally.record(job, outcome)
+    finally:
+        writer.close()
+        tally.close()
+        if box is not None:
+            description = box.describe()
+            box.close()
+        if metrics is not None:
+            metrics.finish()
+
+    status = "Cancelled" if cancel_event is not None and cancel_event.is_set() else "Done"
+    if box is not None:
+        return tally.summary(status) + "\n" + description
+    return tally.summary(status)
+
+# -----------------------
+# Batch mode (many CSVs)
+# -----------------------
+def expand_csv_inputs(inputs):
+    """
+    Files, directories (every *.csv inside) and glob patterns -> sorted unique file list.
+    """
+    import glob
+
+    found = []
+    for item in inputs:
+        if os.path.isdir(item):
+            found += [os.path.join(item, n) for n in os.listdir(item) if n.lower().endswith(".csv")]
+        elif any(ch in item for ch in "*?["):
+            found += glob.glob(item)
+        else:
+            found.append(item)
+    seen = set()
+    out = []
+    for path in sorted(found):
+        key = os.path.normcase(os.path.abspath(path))
+        if key not in seen:
+            seen.add(key)
+            out.append(path)
+    return out
+
+def batch_output_dirs(csv_paths, output_root):
+    """
+    One output folder per CSV, named after the file (suffixed if two files share a name).
+    """
+    dirs = []
+    used = set()
+    for path in csv_paths:
+        stem = os.path.splitext(os.path.basename(path))[0]
+        name, n = stem, 2
+        while name.lower() in used:
+            name, n = f"{stem}-{n}", n + 1
+        used.add(name.lower())
+        dirs.append(os.path.join(output_root, name))
+    return dirs
+
+BATCH_CHUNK_ROWS = 1000  # built rows per hand-off from a batch worker to the submitter
+BATCH_CHUNKS_AHEAD = 2  # chunks a batch worker may have waiting, per file
+
+def _put_chunk(chunks, chunk, stop):
+    """
+    Put on a bounded queue, giving up (False) once `stop` is set.
+    """
+    while True:
+        try:
+            chunks.put(chunk, timeout=0.5)
+            return True
+        except queue.Full:
+            if stop.is_set():
+                return False
+
+def prepare_csv_instances(csv_path, form_id, mapping, output_root, chunks, stop,
+                          output_format=DEFAULT_OUTPUT_FORMAT, tz_name=DEFAULT_TIMEZONE, resume=True,
+                          field_types=None, existing=None, bucket_window=None,
+                          bucket_mode=DEFAULT_BUCKET_MODE, session_start=None):
+    """
+    Batch-mode worker, run in a process pool: read, parse and build every
+    instance of one CSV and write its local copies.
+    chunks: bounded queue receiving lists of at most BATCH_CHUNK_ROWS
+            (RowJob, body, content_type), ready for submit_ordered, then None.
+            Memory stays at a few chunks per file whatever the file's size.
+    stop: event set when the submitter is gone; the worker then gives up.
+    existing: optional ServerIndex (a copy per worker, so identical rows are
+              matched against the server per file).
+    bucket_window/bucket_mode/session_start: as in run_upload_dynamic.
+    """
+    # Each file's own header: column order may differ between devices
+    fmt = detect_input_format(csv_path, tz_name=tz_name, session_start=session_start)
+    plan = RowPlan(fmt.header, mapping, field_types, time_column=fmt.time_column)
+    os.makedirs(output_root, exist_ok=True)
+    done = load_journal_ids(journal_path_for(output_root, form_id)) if resume else None
+    writer = open_instance_writer(output_format, output_root, name=f"instances-{form_id}")
+    try:
+        parsed = iter_parsed_rows(iter_csv_rows(csv_path, [fmt.time_column]), tz_name,
+                                  time_index=plan.time_index, time_parser=fmt.time_parser())
+        if bucket_window:
+            buckets = iter_time_buckets(parsed, plan, bucket_window, bucket_mode)
+            jobs = iter_bucket_jobs(buckets, form_id, plan, writer, bucket_mode, journal=done, existing=existing)
+        else:
+            jobs = iter_instance_jobs(parsed, form_id, plan, writer, journal=done, existing=existing)
+        chunk = []
+        for item in jobs:
+            chunk.append(item)
+            if len(chunk) >= BATCH_CHUNK_ROWS:
+                if not _put_chunk(chunks, chunk, stop):
+                    return
+                chunk = []
+        if chunk and not _put_chunk(chunks, chunk, stop):
+            return
+        _put_chunk(chunks, None, stop)
+    finally:
+        writer.close()
+
+def run_batch_upload(username, password, survey_link, csv_paths, output_root, mapping,
+                     processes=None, max_in_flight=DEFAULT_MAX_IN_FLIGHT, rate_limit=DEFAULT_RATE_LIMIT,
+                     on_result=None, tz_name=DEFAULT_TIMEZONE, resume=True,
+                     output_format=DEFAULT_OUTPUT_FORMAT, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                     kc_base=None, metrics=None, results_log=None, on_record=None, field_types=None,
+                     dedupe=False, kf_base=None, bucket_window=None, bucket_mode=DEFAULT_BUCKET_MODE,
+                     session_start=None):
+    """
+    Upload many CSVs (e.g. one per clicker) with one mapping and form definition.
+    Files are parsed and built in a process pool (`processes` workers) while a
+    single shared submission stage sends them, in file order, under one global
+    max_in_flight cap. Each file gets its own folder under output_root (see
+    batch_output_dirs) with its own journal and, unless results_log is False,
+    its own results log; each file's header is compiled into its own RowPlan.
+    With dedupe the server's submissions are indexed once for all files.
+    Built rows come back in chunks (see prepare_csv_instances), so a file starts
+    submitting as soon as its first chunk is built.
+    Returns a combined per-file summary.
+    metrics only sees the submit stage here; parsing happens in other processes.
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    form_id = parse_form_id_from_link(survey_link)
+    kc_base = (kc_base or derive_kc_base_from_link(survey_link)).rstrip("/")
+    submit_url = f"{kc_base}/submission"
+    processes = max(1, processes or min(4, os.cpu_count() or 1))
+    out_dirs = batch_output_dirs(csv_paths, output_root)
+
+    emit = _emitter(on_result)
+
+    existing = None
+    if dedupe:
+        kf_base = (kf_base or derive_kf_base_from_link(survey_link)).rstrip("/")
+        # Same field order as every file's RowPlan
+        existing = kf_fetch_server_index(kf_base, form_id, username, password,
+                                         [f for f, c in mapping.items() if c])
+        emit(f"[DEDUPE] The form already has {existing.records} submission(s) on the server.")
+
+    session = make_session(username, password, pool_size=max_in_flight)
+    tallies = {}
+    errors = {}
+
+    def file_chunks(fut, chunks):
+        # The worker's chunks in order; a worker that failed ends the file early
+        while True:
+            try:
+                chunk = chunks.get(timeout=0.5)
+            except queue.Empty:
+                if fut.done() and chunks.empty():
+                    fut.result()
+                    return
+                continue
+            if chunk is None:
+                return
+            yield chunk
+
+    def file_jobs(pool, manager, stop):
+        # Keep only a few files in work ahead of the submitter (each holding a
+        # few chunks at most) to bound memory
+        pending = deque()
+        queued = iter(zip(csv_paths, out_dirs))
+
+        def launch():
+            for path, out in queued:
+                chunks = manager.Queue(BATCH_CHUNKS_AHEAD)
+                pending.append((path, out, chunks, pool.submit(
+                    prepare_csv_instances, path, form_id, mapping, out, chunks, stop, output_format, tz_name,
+                    resume, field_types, existing, bucket_window, bucket_mode, session_start)))
+                return
+
+        for _ in range(processes + 1):
+            launch()
+        def open_tally(path, out):
+            if path not in tallies:
+                journal = SubmissionJournal(journal_path_for(out, form_id)) if resume else None
+                results = None if results_log is False else ResultLog(results_path_for(out, form_id))
+                tallies[path] = UploadTally(journal=journal, metrics=metrics, on_result=on_result,
+                                            label=path, results=results, on_record=on_record)
+
+        while pending:
+            path, out, chunks, fut = pending.popleft()
+            launch()
+            try:
+                for chunk in file_chunks(fut, chunks):
+                    open_tally(path, out)
+                    for job, body, content_type in chunk:
+                        yield (path, job), body, content_type
+                    del chunk
+                open_tally(path, out)  # e.g. every row already in the journal
+            except Exception as e:
+                errors[path] = f"{type(e).__name__}: {e}"
+                emit(f"[ERROR] {path}: {errors[path]}")
+
+    breaker = CircuitBreaker(on_open=lambda s: emit(_pause_message(s)))
+    policy = RetryPolicy(max_attempts=max_attempts)
+    try:
+        with multiprocessing.Manager() as manager, ProcessPoolExecutor(max_workers=processes) as pool:
+            stop = manager.Event()
+            try:
+                for (path, job), outcome in submit_ordered(
+                        session, submit_url, file_jobs(pool, manager, stop), max_in_flight=max_in_flight,
+                        rate_limit=rate_limit, policy=policy, breaker=breaker):
+                    tallies[path].record(job, outcome)
+            finally:
+                stop.set()  # workers still building (after an error or Ctrl+C) give up
+    finally:
+        for tally in tallies.values():
+            tally.close()
+        if metrics is not None:
+            metrics.finish()
+
+    lines = [f"Batch: {len(csv_paths)} file(s), {len(errors)} could not be read."]
+    for path in csv_paths:
+        if path in errors:
+            lines.append(f"{path} — ERROR: {errors[path]}")
+        if path in tallies:
+            lines.append(f"{path} — {tallies[path].summary()}")
+    return "\n".join(lines)
+
+# -----------------------
+# Watch mode (growing CSVs)
+# -----------------------
+WATCH_POLL_INTERVAL = 2.0  # seconds between checks for new rows
+WATCH_READ_BYTES = 8 << 20  # read appended data in pieces of at most this size
+
+def complete_rows_end(data: bytes) -> int:
+    """
+    Length of the longest prefix of `data` made of complete CSV records: it
+    ends at a newline outside quotes (a row still being written, or a quoted
+    value with a line break in it, waits for more data).
+    """
+    end = pos = quotes = 0
+    while True:
+        nl = data.find(b"\n", pos)
+        if nl < 0:
+            return end
+        quotes += data.count(b'"', pos, nl + 1)
+        pos = nl + 1
+        if quotes % 2 == 0:
+            end = pos
+
+def first_record_end(data: bytes) -> int:
+    """
+    Length of the first complete CSV record in `data` (0 if there is none yet).
+    """
+    pos = quotes = 0
+    while True:
+        nl = data.find(b"\n", pos)
+        if nl < 0:
+            return 0
+        quotes += data.count(b'"', pos, nl + 1)
+        pos = nl + 1
+        if quotes % 2 == 0:
+            return pos
+
+class FollowedCsv:
+    """
+    One CSV followed by watch_csv_files: the byte offset just past the last
+    row handed to the pipeline, that row's number, and the file's identity
+    (device/inode, size and a hash of the header line) to spot truncation and
+    rotation. Nothing is persisted: a restarted watch reads each file from the
+    top, where the journal skips what was sent and repeated-row numbering
+    (and the input format's clock) are rebuilt.
+    settle: seconds a last row without a newline must stay unchanged before
+            read_rows may take it (the Android export never ends with one).
+    """
+    def __init__(self, csv_path, settle=WATCH_POLL_INTERVAL):
+        self.csv_path = csv_path
+        self.settle = settle
+        self.offset = 0  # 0 = header not read yet
+        self.last_row = 0
+        self.identity = None
+        self.header_hash = None
+        self._tail = None  # (file size, first seen) of an unterminated last row
+
+    def _stat(self):
+        st = os.stat(self.csv_path)
+        return [st.st_dev, st.st_ino], st.st_size
+
+    def _header(self):
+        # (header_end, hash of the header line); header_end is 0 if the header is incomplete
+        with open(self.csv_path, "rb") as f:
+            head = f.read(1 << 16)
+        end = first_record_end(head)
+        return end, hashlib.sha1(head[:end]).hexdigest() if end else None
+
+    def changed(self):
+        """
+        Why the file can no longer be read on from `offset` ("rotated",
+        "truncated", "rewritten") or None.
+        """
+        identity, size = self._stat()
+        if self.identity is not None and identity != self.identity:
+            return "rotated"
+        if size < self.offset:
+            return "truncated"
+        if self.header_hash is not None and self._header()[1] != self.header_hash:
+            return "rewritten"
+        return None
+
+    def reset(self):
+        self.offset = self.last_row = 0
+        self.identity = self.header_hash = self._tail = None
+
+    def read_rows(self, width=None, tail_complete=None):
+        """
+        The next complete rows past `offset` (at most WATCH_READ_BYTES of them),
+        as (idx, row) like iter_csv_rows: blank lines skipped, rows padded to
+        `width`. Returns (header, rows); header is the normalized header when
+        it was read by this call (from offset 0), otherwise None.
+        tail_complete: optional check(row) -> bool for a last row without a
+                       newline, asked once the file has not grown for `settle`
+                       seconds (see ClickerCsvFormat.complete_tail). Without
+                       it only newline-terminated rows are read.
+        """
+        header = None
+        if self.offset == 0:
+            end, digest = self._header()
+            if not end:
+                return None, []
+            with open(self.csv_path, "rb") as f:
+                header = _read_header(csv.reader(io.StringIO(f.read(end).decode("utf-8-sig"), newline="")))
+            self.identity = self._stat()[0]
+            self.header_hash = digest
+            self.offset = end
+            width = len(header)
+
+        with open(self.csv_path, "rb") as f:
+            f.seek(self.offset)
+            data = f.read(WATCH_READ_BYTES)
+        end = complete_rows_end(data)
+        if (tail_complete is not None and end < len(data) < WATCH_READ_BYTES
+                and data.count(b'"', end) % 2 == 0):
+            size = self.offset + len(data)
+            if self._tail is None or self._tail[0] != size:
+                self._tail = (size, time.monotonic())
+            elif time.monotonic() - self._tail[1] >= self.settle:
+                tail = [r for r in csv.reader(io.StringIO(data[end:].decode("utf-8", "replace"), newline=""))
+                        if r]
+                if len(tail) == 1 and tail_complete(tail[0]):
+                    end = len(data)  # the file stopped growing on a whole row
+                    self._tail = None
+        rows = []
+        for row in csv.reader(io.StringIO(data[:end].decode("utf-8"), newline="")):
+            if not row:
+                continue
+            self.last_row += 1
+            if width and len(row) < width:
+                row += [""] * (width - len(row))
+            rows.append((self.last_row, row))
+        self.offset += end
+        return header, rows
+
+def watch_csv_files(username, password, survey_link, csv_paths, output_root, mapping,
+                    poll_interval=WATCH_POLL_INTERVAL, cancel_event=None, on_result=None,
+                    tz_name=DEFAULT_TIMEZONE, output_format=DEFAULT_OUTPUT_FORMAT,
+                    max_in_flight=DEFAULT_MAX_IN_FLIGHT, rate_limit=DEFAULT_RATE_LIMIT,
+                    max_attempts=DEFAULT_MAX_ATTEMPTS, kc_base=None, metrics=None, results_log=None,
+                    on_record=None, field_types=None, session_start=None):
+    """
+    Follow growing CSVs (Android app / SD logger exports) and submit rows as
+    they are appended, until cancel_event is set or Ctrl+C.
+
+    Each file is first read from the top: the journal (always on here) skips
+    rows acknowledged before, without any network traffic, and
+    repeated-row numbering is rebuilt exactly. From then on every poll reads
+    only the complete rows past the last one read (see FollowedCsv). A file
+    that is truncated, rewritten or replaced (rotation) is read from the top
+    again, the journal again skipping what was already sent.
+    Several files get one folder each under output_root (see batch_output_dirs).
+    Each header is matched to its input format (detect_input_format, with
+    session_start) when the file is read from the top.
+    Returns the per-file summaries.
+    """
+    form_id = parse_form_id_from_link(survey_link)
+    kc_base = (kc_base or derive_kc_base_from_link(survey_link)).rstrip("/")
+    submit_url = f"{kc_base}/submission"
+    out_dirs = batch_output_dirs(csv_paths, output_root) if len(csv_paths) > 1 else [output_root]
+
+    session = make_session(username, password, pool_size=max_in_flight)
+    policy = RetryPolicy(max_attempts=max_attempts)
+    files = []
+
+    emit = _emitter(on_result)
+
+    breaker = CircuitBreaker(on_open=lambda s: emit(_pause_message(s)))
+
+    for path, out in zip(csv_paths, out_dirs):
+        os.makedirs(out, exist_ok=True)
+        journal = SubmissionJournal(journal_path_for(out, form_id))
+        follower = FollowedCsv(path, settle=poll_interval)
+        files.append({
+            "path": path, "follower": follower, "plan": None, "format": None, "clock": None, "occurrences": {},
+            "writer": open_instance_writer(output_format, out, name=f"instances-{form_id}", metrics=metrics),
+            "tally": UploadTally(journal=journal, metrics=metrics, on_result=on_result,
+                                 label=path if len(csv_paths) > 1 else None,
+                                 results=open_result_log(results_log, out, form_id), on_record=on_record),
+            "error": None,
+        })
+
+    def poll_file(entry):
+        follower, tally = entry["follower"], entry["tally"]
+        if not os.path.isfile(entry["path"]):
+            return
+        reason = follower.changed() if follower.offset else None
+        if reason:
+            tally.emit(f"[WATCH] {entry['path']} was {reason}; reading it from the top again")
+            follower.reset()
+        while cancel_event is None or not cancel_event.is_set():
+            fmt = entry["format"]
+            header, rows = follower.read_rows(len(entry["plan"].header) if entry["plan"] else None,
+                                              fmt.complete_tail if fmt is not None else None)
+            if header is not None:
+                fmt = entry["format"] = detect_input_format(entry["path"], header, tz_name, session_start)
+                entry["plan"] = RowPlan(header, mapping, field_types, time_column=fmt.time_column)
+                entry["clock"] = fmt.time_parser()  # stateful for some formats: one per pass
+                entry["occurrences"] = {}
+                if fmt.describe():
+                    tally.emit(fmt.describe())
+            if not rows:
+                return
+            plan = entry["plan"]
+            parsed = iter_parsed_rows(iter(rows), tz_name, metrics=metrics, time_index=plan.time_index,
+                                      time_parser=entry["clock"])
+            jobs = iter_instance_jobs(parsed, form_id, plan, entry["writer"], journal=tally.journal,
+                                      metrics=metrics, occurrences=entry["occurrences"])
+            if cancel_event is not None:
+                jobs = until_cancelled(jobs, cancel_event)
+            for job, outcome in submit_ordered(session, submit_url, jobs, max_in_flight=max_in_flight,
+                                               rate_limit=rate_limit, policy=policy, breaker=breaker,
+                                               cancel_event=cancel_event):
+                tally.record(job, outcome)
+
+    status = "Stopped"
+    try:
+        while cancel_event is None or not cancel_event.is_set():
+            for entry in files:
+                try:
+                    poll_file(entry)
+                    entry["error"] = None
+                except (OSError, ValueError) as e:
+                    # e.g. a mapped column missing from a new header: retry from the top, report once
+                    entry["follower"].reset()
+                    entry["plan"] = entry["format"] = None
+                    if str(e) != entry["error"]:
+                        entry["error"] = str(e)
+                        entry["tally"].emit(f"[ERROR] {entry['path']}: {e}")
+                if cancel_event is not None and cancel_event.is_set():
+                    break
+            if cancel_event is not None:
+                cancel_event.wait(poll_interval)
+            else:
+                time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        status = "Stopped (Ctrl+C)"
+    finally:
+        for entry in files:
+            entry["writer"].close()
+            entry["tally"].close()
+        if metrics is not None:
+            metrics.finish()
+
+    return "\n".join(f"{entry['path']} — {entry['tally'].summary(status)}" for entry in files)
+
+# -----------------------
+# Outbox (SQLite)
+# -----------------------
+# Built instances can be parked in a local SQLite outbox and submitted later
+# by a drainer: capture runs at disk speed, upload at network speed whenever
+# there is a connection, and nothing is lost across restarts.
+OUTBOX_COMMIT_ROWS = 500  # rows per transaction, for both capture and results
+OUTBOX_FETCH_ROWS = 500  # pending rows loaded per query while draining
+
+_OUTBOX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    seq          INTEGER PRIMARY KEY AUTOINCREMENT,
+    instance_id  TEXT NOT NULL UNIQUE,
+    submit_url   TEXT NOT NULL,
+    csv          TEXT,
+    row          INTEGER,
+    location     TEXT,
+    body         BLOB,
+    content_type TEXT NOT NULL,
+    status       TEXT NOT NULL DEFAULT 'pending',
+    attempts     INTEGER NOT NULL DEFAULT 0,
+    http_status  INTEGER,
+    error        TEXT,
+    created      REAL NOT NULL,
+    updated      REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (status, submit_url, seq);
+"""
+
+class Outbox:
+    """
+    SQLite (WAL) queue of built submissions. Each row is 'pending' until the
+    server acknowledges it ('acked', body dropped) or rejects it for good
+    ('failed': a 4xx, kept with its error). Rows that fail transiently stay
+    pending for the next drain. Writes are batched, OUTBOX_COMMIT_ROWS per
+    transaction; use from one thread.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")  # safe with WAL; a crash loses at most the last commit
+        self._db.executescript(_OUTBOX_SCHEMA)
+        self._inserts = []
+        self._inserting = set()
+        self._updates = []
+
+    def __contains__(self, instance_id):
+        # Any status: captured rows are never captured twice
+        if instance_id in self._inserting:
+            return True
+        return self._db.execute("SELECT 1 FROM outbox WHERE instance_id = ?", (instance_id,)).fetchone() is not None
+
+    def put(self, job, body, content_type, submit_url, csv_path=None):
+        now = time.time()
+        self._inserts.append((job.instance_id, submit_url, csv_path, job.idx, job.location, body,
+                              content_type, now, now))
+        self._inserting.add(job.instance_id)
+        if len(self._inserts) >= OUTBOX_COMMIT_ROWS:
+            self.flush()
+
+    def record(self, instance_id, outcome, retryable):
+        """
+        Store one drain result; retryable failures stay pending.
+        """
+        r = outcome.response
+        if r is not None and r.ok:
+            status, error = "acked", None
+        else:
+            status = "pending" if retryable else "failed"
+            if outcome.error is not None:
+                error = f"{type(outcome.error).__name__}: {outcome.error}"
+            else:
+                error = response_excerpt(r)
+        self._updates.append((status, outcome.attempts, r.status_code if r is not None else None, error,
+                              time.time(), instance_id))
+        if len(self._updates) >= OUTBOX_COMMIT_ROWS:
+            self.flush()
+
+    def flush(self):
+        with self._db:
+            if self._inserts:
+                self._db.executemany(
+                    "INSERT OR IGNORE INTO outbox (instance_id, submit_url, csv, row, location, body, "
+                    "content_type, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", self._inserts)
+                self._inserts = []
+                self._inserting.clear()
+            if self._updates:
+                self._db.executemany(
+                    "UPDATE outbox SET status = ?, attempts = attempts + ?, http_status = ?, error = ?, "
+                    "updated = ?, body = CASE WHEN ? = 'acked' THEN NULL ELSE body END WHERE instance_id = ?",
+                    [(s, a, h, e, t, s, iid) for s, a, h, e, t, iid in self._updates])
+                self._updates = []
+
+    def pending_urls(self):
+        self.flush()
+        return [u for (u,) in self._db.execute(
+            "SELECT DISTINCT submit_url FROM outbox WHERE status = 'pending'")]
+
+    def iter_pending(self, submit_url):
+        """
+        Pending rows for one submission URL in capture order, loaded
+        OUTBOX_FETCH_ROWS at a time: (RowJob, body, content_type).
+        A row that fails again during this pass is not repeated in it.
+        """
+        last = 0
+        while True:
+            self.flush()
+            batch = self._db.execute(
+                "SELECT seq, instance_id, row, location, body, content_type FROM outbox "
+                "WHERE status = 'pending' AND submit_url = ? AND seq > ? ORDER BY seq LIMIT ?",
+                (submit_url, last, OUTBOX_FETCH_ROWS)).fetchall()
+            if not batch:
+                return
+            for seq, instance_id, row, location, body, content_type in batch:
+                last = seq
+                yield RowJob(row, location, instance_id, None), body, content_type
+
+    def counts(self):
+        self.flush()
+        counts = {"pending": 0, "acked": 0, "failed": 0}
+        for status, n in self._db.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status"):
+            counts[status] = n
+        return counts
+
+    def describe(self):
+        c = self.counts()
+        return f"Outbox {self.path}: {c['pending']} pending, {c['acked']} acknowledged, {c['failed']} rejected."
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+def capture_to_outbox(jobs, outbox, submit_url, tally, csv_path=None):
+    """
+    Park every built job in the outbox instead of submitting it; skipped rows
+    go to the tally as usual. Returns the number of rows captured.
+    """
+    captured = 0
+    for job, body, content_type in jobs:
+        if body is None:
+            tally.record(job, None)
+            continue
+        outbox.put(job, body, content_type, submit_url, csv_path)
+        captured += 1
+    outbox.flush()
+    return captured
+
+def drain_outbox(outbox, session, tally, max_in_flight=DEFAULT_MAX_IN_FLIGHT, rate_limit=DEFAULT_RATE_LIMIT,
+                 policy=None, breaker=None, cancel_event=None, gate=None):
+    """
+    Submit the outbox's pending rows (all forms/servers in it) through
+    submit_ordered and store each result; see Outbox.record.
+    """
+    policy = policy or RetryPolicy()
+    for submit_url in outbox.pending_urls():
+        jobs = outbox.iter_pending(submit_url)
+        if cancel_event is not None:
+            jobs = until_cancelled(jobs, cancel_event)
+        for job, outcome in submit_ordered(session, submit_url, jobs, max_in_flight=max_in_flight,
+                                           rate_limit=rate_limit, policy=policy, breaker=breaker,
+                                           cancel_event=cancel_event, gate=gate):
+            tally.record(job, outcome)
+            retryable = (isinstance(outcome.error, SubmissionCancelled)
+                         or policy.is_retryable(outcome.response, outcome.error))
+            outbox.record(job.instance_id, outcome, retryable)
+        if cancel_event is not None and cancel_event.is_set():
+            break
+    outbox.flush()
+
+def run_outbox_drain(username, password, outbox_path, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                     rate_limit=DEFAULT_RATE_LIMIT, max_attempts=DEFAULT_MAX_ATTEMPTS, on_result=None,
+                     cancel_event=None, follow=False, poll_interval=WATCH_POLL_INTERVAL, metrics=None,
+                     results_log=False, on_record=None):
+    """
+    Stand-alone drainer: submit whatever an earlier run left pending in the
+    outbox. With follow it keeps draining every poll_interval seconds (rows
+    captured meanwhile, or the connection coming back) until cancel_event or
+    Ctrl+C. results_log: optional JSONL path for the per-row records.
+    """
+    outbox = Outbox(outbox_path)
+    session = make_session(username, password, pool_size=max_in_flight)
+    tally = UploadTally(metrics=metrics, on_result=on_result, on_record=on_record,
+                        results=ResultLog(results_log) if results_log else None)
+    breaker = CircuitBreaker(on_open=tally.report_pause)
+    policy = RetryPolicy(max_attempts=max_attempts)
+    status = "Done"
+    try:
+        while True:
+            drain_outbox(outbox, session, tally, max_in_flight=max_in_flight, rate_limit=rate_limit,
+                         policy=policy, breaker=breaker, cancel_event=cancel_event)
+            if not follow or (cancel_event is not None and cancel_event.wait(poll_interval)):
+                break
+            if cancel_event is None:
+                time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        status = "Stopped (Ctrl+C)"
+    finally:
+        tally.close()
+        description = outbox.describe()
+        outbox.close()
+        if metrics is not None:
+            metrics.finish()
+    if cancel_event is not None and cancel_event.is_set():
+        status = "Cancelled"
+    return tally.summary(status) + "\n" + description
+
+# -----------------------
+# Local upload service
+# -----------------------
+# A long-running process on 127.0.0.1 that the GUI and CLI can hand uploads
+# to: sessions stay warm between jobs, form definitions are cached, and jobs
+# running at the same time share one submission limit fairly.
+DEFAULT_SERVICE_PORT = 8737
+SERVICE_CONCURRENCY = 16  # submissions in flight across all jobs
+SERVICE_SESSION_IDLE = 900.0  # seconds before an unused pooled session is closed
+SERVICE_MAX_JOBS = 200  # finished jobs kept for status queries
+SERVICE_POLL_INTERVAL = 0.5  # seconds between client status polls
+# run_upload_dynamic options a job may set
+SERVICE_JOB_OPTIONS = ("max_in_flight", "rate_limit", "tz_name", "resume", "output_format", "max_attempts",
+                       "kc_base", "kf_base", "results_log", "dedupe", "bucket_window", "bucket_mode",
+                       "session_start")
+JOB_FINAL_STATES = ("done", "failed", "cancelled")
+
+def service_info_path(cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Where a running service publishes its port and access token (owner-only file).
+    """
+    return os.path.join(cache_dir, "service.json")
+
+class FairScheduler:
+    """
+    Global cap on submissions in flight, shared by all jobs: a free slot goes
+    to the waiting job with the fewest requests in flight, ties to the one
+    served longest ago. gate(job_id) is the per-job slot for submit_with_retry.
+    """
+    def __init__(self, limit=SERVICE_CONCURRENCY):
+        self.limit = max(1, int(limit))
+        self._cond = threading.Condition()
+        self._active = 0
+        self._running = {}
+        self._waiting = {}
+        self._served = {}
+        self._turn = 0
+
+    def _next(self):
+        return min(self._waiting, key=lambda j: (self._running.get(j, 0), self._served.get(j, 0)))
+
+    def acquire(self, job_id):
+        with self._cond:
+            self._waiting[job_id] = self._waiting.get(job_id, 0) + 1
+            while self._active >= self.limit or self._next() != job_id:
+                self._cond.wait()
+            self._waiting[job_id] -= 1
+            if not self._waiting[job_id]:
+                del self._waiting[job_id]
+            self._active += 1
+            self._running[job_id] = self._running.get(job_id, 0) + 1
+            self._turn += 1
+            self._served[job_id] = self._turn
+            self._cond.notify_all()
+
+    def release(self, job_id):
+        with self._cond:
+            self._active -= 1
+            self._running[job_id] -= 1
+            if not self._running[job_id]:
+                del self._running[job_id]
+            self._cond.notify_all()
+
+    def forget(self, job_id):
+        with self._cond:
+            self._served.pop(job_id, None)
+
+    def gate(self, job_id):
+        return _JobGate(self, job_id)
+
+class _JobGate:
+    def __init__(self, scheduler, job_id):
+        self.scheduler = scheduler
+        self.job_id = job_id
+
+    def acquire(self):
+        self.scheduler.acquire(self.job_id)
+
+    def release(self):
+        self.scheduler.release(self.job_id)
+
+class SessionPool:
+    """
+    Keep-alive sessions per (KoboCAT base, credentials), reused by every job
+    with the same key; a session unused for SERVICE_SESSION_IDLE seconds is closed.
+    """
+    def __init__(self, pool_size=SERVICE_CONCURRENCY, idle=SERVICE_SESSION_IDLE):
+        self.pool_size = pool_size
+        self.idle = idle
+        self._lock = threading.Lock()
+        self._sessions = {}  # key -> [session, users, last used]
+
+    def __len__(self):
+        return len(self._sessions)
+
+    @contextlib.contextmanager
+    def lease(self, base, username, password):
+        key = (base.rstrip("/"), username, hashlib.sha256(password.encode("utf-8")).hexdigest())
+        with self._lock:
+            now = time.monotonic()
+            for k, (s, users, used) in list(self._sessions.items()):
+                if not users and now - used > self.idle:
+                    s.close()
+                    del self._sessions[k]
+            entry = self._sessions.get(key)
+            if entry is None:
+                entry = self._sessions[key] = [make_session(username, password, pool_size=self.pool_size), 0, now]
+            entry[1] += 1
+        try:
+            yield entry[0]
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                entry[2] = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            for s, _, _ in self._sessions.values():
+                s.close()
+            self._sessions.clear()
+
+class UploadJob:
+    """
+    One upload run by the service: its request (without the password), state
+    (queued/running/done/failed/cancelled), outcome counts and the last
+    RESULT_TAIL_LINES messages, numbered so clients can ask for new ones only.
+    """
+    def __init__(self, job_id, spec):
+        self.id = job_id
+        self.spec = {k: v for k, v in spec.items() if k != "password"}
+        self.state = "queued"
+        self.created = time.time()
+        self.started = self.finished = None
+        self.summary = self.error = None
+        self.cancel_event = threading.Event()
+        self.counts = {"submitted": 0, "duplicate": 0, "failed": 0, "skipped": 0}
+        self.messages = deque(maxlen=RESULT_TAIL_LINES)
+        self.message_count = 0
+        self._lock = threading.Lock()
+
+    def add_message(self, msg):
+        with self._lock:
+            self.messages.append(msg)
+            self.message_count += 1
+
+    def add_record(self, record):
+        with self._lock:
+            self.counts[record["status"]] = self.counts.get(record["status"], 0) + 1
+
+    def snapshot(self, since=None):
+        """
+        JSON-ready status; with `since`, also the messages numbered from there on.
+        """
+        with self._lock:
+            status = {"id": self.id, "state": self.state, "csv": self.spec.get("csv"),
+                      "link": self.spec.get("link"), "created": self.created, "started": self.started,
+                      "finished": self.finished, "counts": dict(self.counts), "summary": self.summary,
+                      "error": self.error, "next": self.message_count}
+            if since is not None:
+                first = self.message_count - len(self.messages)
+                status["messages"] = list(self.messages)[max(0, since - first):]
+        return status
+
+class UploadService:
+    """
+    Runs upload jobs in threads with shared sessions (SessionPool), a shared
+    form-definition cache and one FairScheduler over all their submissions.
+    """
+    def __init__(self, concurrency=SERVICE_CONCURRENCY, cache=None):
+        self.scheduler = FairScheduler(concurrency)
+        self.sessions = SessionPool(pool_size=self.scheduler.limit)
+        self.forms = cache or FormDefinitionCache()
+        self._verified = {}  # (kf_base, form uid, username) -> digest of the password the server accepted
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._ids = 0
+
+    def form_fields(self, username, password, link, kf_base=None):
+        """
+        The form's custom fields from the shared cache. Cache entries are per
+        account, and a password not yet accepted by the server for this form
+        first goes through a conditional GET (a 304 when the cache is current).
+        """
+        kf_base = (kf_base or derive_kf_base_from_link(link)).rstrip("/")
+        form_uid = parse_form_id_from_link(link)
+        key = (kf_base, form_uid, username)
+        digest = hashlib.sha256(f"{username}\0{password}".encode("utf-8")).digest()
+        with self._lock:  # request threads call this at once
+            known = self._verified.get(key)
+        fields = kf_get_custom_fields(kf_base, form_uid, username, password, cache=self.forms,
+                                      revalidate=known is None or not hmac.compare_digest(known, digest))
+        with self._lock:
+            self._verified[key] = digest
+        return fields
+
+    def submit(self, spec):
+        """
+        Start a job. spec: username, password, link, csv (absolute path),
+        mapping, optional output (absolute; default: "instances" next to the
+        CSV), coerce_types and any of SERVICE_JOB_OPTIONS.
+        Raises ValueError for an incomplete or invalid request.
+        """
+        missing = [k for k in ("username", "password", "link", "csv", "mapping") if not spec.get(k)]
+        if missing:
+            raise ValueError(f"missing: {', '.join(missing)}")
+        unknown = set(spec) - {"username", "password", "link", "csv", "mapping", "output", "coerce_types",
+                               *SERVICE_JOB_OPTIONS}
+        if unknown:
+            raise ValueError(f"unknown option(s): {', '.join(sorted(unknown))}")
+        for key in ("csv", "output"):
+            if spec.get(key) and not os.path.isabs(spec[key]):
+                raise ValueError(f"{key} must be an absolute path")
+        if not isinstance(spec["mapping"], dict):
+            raise ValueError("mapping must be an object of form field -> CSV column")
+        if not os.path.isfile(spec["csv"]):
+            raise ValueError(f"CSV not found: {spec['csv']}")
+        parse_form_id_from_link(spec["link"])
+        if spec.get("session_start"):
+            parse_session_starts(spec["session_start"], spec.get("tz_name") or DEFAULT_TIMEZONE)
+
+        with self._lock:
+            self._ids += 1
+            job = UploadJob(str(self._ids), spec)
+            self.jobs[job.id] = job
+            finished = [j for j in self.jobs.values() if j.state in JOB_FINAL_STATES]
+            for old in finished[:max(0, len(finished) - SERVICE_MAX_JOBS)]:
+                del self.jobs[old.id]
+        threading.Thread(target=self._run, args=(job, spec), daemon=True).start()
+        return job
+
+    def _run(self, job, spec):
+        job.state = "running"
+        job.started = time.time()
+        username, password, link = spec["username"], spec["password"], spec["link"]
+        options = {k: spec[k] for k in SERVICE_JOB_OPTIONS if spec.get(k) is not None}
+        options.setdefault("max_in_flight", self.scheduler.limit)  # the scheduler shares it out
+        if "session_start" in options:  # sent as text, like --session-start
+            options["session_start"] = parse_session_starts(options["session_start"],
+                                                            options.get("tz_name", DEFAULT_TIMEZONE))
+        try:
+            fields = self.form_fields(username, password, link, options.get("kf_base"))
+            known = {f["name"] for f in fields}
+            unknown = [f for f in spec["mapping"] if f not in known]
+            if unknown:
+                raise ValueError(f"Mapped field(s) not in form: {unknown}")
+            field_types = {f["name"]: f.get("type") for f in fields} if spec.get("coerce_types") else None
+            output = spec.get("output") or os.path.join(os.path.dirname(spec["csv"]), "instances")
+            kc_base = (options.pop("kc_base", None) or derive_kc_base_from_link(link)).rstrip("/")
+            with self.sessions.lease(kc_base, username, password) as session:
+                job.summary = run_upload_dynamic(
+                    username, password, link, spec["csv"], output, spec["mapping"],
+                    on_result=job.add_message, on_record=job.add_record, cancel_event=job.cancel_event,
+                    field_types=field_types, kc_base=kc_base, session=session,
+                    gate=self.scheduler.gate(job.id), **options)
+            job.state = "cancelled" if job.cancel_event.is_set() else "done"
+        except Exception as e:
+            job.error = f"{type(e).__name__}: {e}"
+            job.state = "failed"
+        finally:
+            job.finished = time.time()
+            self.scheduler.forget(job.id)
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is not None:
+            job.cancel_event.set()
+        return job
+
+    def shutdown(self):
+        for job in list(self.jobs.values()):
+            job.cancel_event.set()
+        self.sessions.close()
+
+class _ServiceHandler(BaseHTTPRequestHandler):
+    """
+    JSON API, every request with the X-Upload-Token header:
+      GET /health, GET /jobs, GET /jobs/<id>?since=N,
+      POST /jobs (see UploadService.submit), POST /forms (form fields),
+      DELETE /jobs/<id> (cancel)
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _route(self):
+        """
+        (path parts, query) if the request carries the token, else None (401 sent).
+        """
+        if not hmac.compare_digest(self.headers.get("X-Upload-Token", ""), self.server.service_token):
+            self._reply(401, {"error": "bad or missing X-Upload-Token"})
+            return None
+        url = urlparse(self.path)
+        return [p for p in url.path.split("/") if p], parse_qs(url.query)
+
+    def _payload(self):
+        raw = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        payload = json.loads(raw or b"{}")
+        if not isinstance(payload, dict):
+            raise ValueError("expected a JSON object")
+        return payload
+
+    def do_GET(self):
+        route = self._route()
+        if route is None:
+            return
+        parts, query = route
+        service = self.server.service
+        if parts == ["health"]:
+            self._reply(200, {"ok": True, "jobs": len(service.jobs), "sessions": len(service.sessions),
+                              "concurrency": service.scheduler.limit})
+        elif parts == ["jobs"]:
+            self._reply(200, {"jobs": [j.snapshot() for j in list(service.jobs.values())]})
+        elif len(parts) == 2 and parts[0] == "jobs" and parts[1] in service.jobs:
+            try:
+                since = int((query.get("since") or ["0"])[0])
+            except ValueError:
+                since = -1
+            if since < 0:
+                self._reply(400, {"error": "since must be a message number (0 or more)"})
+                return
+            self._reply(200, service.jobs[parts[1]].snapshot(since))
+        else:
+            self._reply(404, {"error": "not found"})
+
+    def do_POST(self):
+        route = self._route()
+        if route is None:
+            return
+        parts, _ = route
+        service = self.server.service
+        try:
+            payload = self._payload()
+        except ValueError as e:
+            self._reply(400, {"error": f"bad JSON: {e}"})
+            return
+        if parts == ["jobs"]:
+            try:
+                job = service.submit(payload)
+            except ValueError as e:
+                self._reply(400, {"error": str(e)})
+                return
+            self._reply(202, job.snapshot())
+        elif parts == ["forms"]:
+            missing = [k for k in ("username", "password", "link") if not payload.get(k)]
+            try:
+                if missing:
+                    raise ValueError(f"missing: {', '.join(missing)}")
+                parse_form_id_from_link(payload["link"])
+            except ValueError as e:
+                self._reply(400, {"error": str(e)})
+                return
+            try:
+                fields = service.form_fields(payload["username"], payload["password"], payload["link"],
+                                             payload.get("kf_base"))
+            except Exception as e:
+                self._reply(502, {"error": f"{type(e).__name__}: {e}"})
+                return
+            self._reply(200, {"fields": fields})
+        else:
+            self._reply(404, {"error": "not found"})
+
+    def do_DELETE(self):
+        route = self._route()
+        if route is None:
+            return
+        parts, _ = route
+        job = self.server.service.cancel(parts[1]) if len(parts) == 2 and parts[0] == "jobs" else None
+        if job is None:
+            self._reply(404, {"error": "not found"})
+        else:
+            self._reply(200, job.snapshot())
+
+def serve_upload_service(port=DEFAULT_SERVICE_PORT, concurrency=SERVICE_CONCURRENCY, info_path=None,
+                         ready=None, form_cache_max_age=FORM_CACHE_MAX_AGE):
+    """
+    Run the upload service on 127.0.0.1 until Ctrl+C (or ready's server is
+    shut down). Its port and a fresh access token are written to info_path
+    (default service_info_path()) so local clients can find it.
+    ready: optional callback(httpd) once listening.
+    form_cache_max_age: seconds a cached form definition is used before it is revalidated.
+    """
+    info_path = info_path or service_info_path()
+    service = UploadService(concurrency, cache=FormDefinitionCache(max_age=form_cache_max_age))
+    httpd = ThreadingHTTPServer(("127.0.0.1", port), _ServiceHandler)
+    httpd.daemon_threads = True
+    httpd.service = service
+    httpd.service_token = secrets.token_urlsafe(24)
+
+    os.makedirs(os.path.dirname(info_path) or ".", exist_ok=True)
+    tmp = info_path + ".tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump({"port": httpd.server_address[1], "token": httpd.service_token, "pid": os.getpid()}, f)
+    os.replace(tmp, info_path)
+
+    print(f"Upload service on http://127.0.0.1:{httpd.server_address[1]} "
+          f"({service.scheduler.limit} submissions in flight at most; Ctrl+C to stop)")
+    if ready:
+        ready(httpd)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        service.shutdown()
+        try:
+            with open(info_path, "r", encoding="utf-8") as f:
+                ours = json.load(f).get("token") == httpd.service_token
+            if ours:
+                os.remove(info_path)
+        except (OSError, ValueError):
+            pass
+
+class ServiceClient:
+    """
+    Client of a running upload service (see serve_upload_service).
+    """
+    def __init__(self, port, token, timeout=30):
+        self.base = f"http://127.0.0.1:{port}"
+        self.timeout = timeout
+        self._http = requests.Session()
+        self._http.trust_env = False  # never route localhost through a proxy
+        self._http.headers["X-Upload-Token"] = token
+
+    @classmethod
+    def discover(cls, info_path=None):
+        """
+        Client for the service running on this machine, or None if there is none.
+        """
+        try:
+            with open(info_path or service_info_path(), "r", encoding="utf-8") as f:
+                info = json.load(f)
+            client = cls(info["port"], info["token"], timeout=2)
+            client.health()
+        except (OSError, ValueError, KeyError, RuntimeError, requests.RequestException):
+            return None
+        client.timeout = 30
+        return client
+
+    def _call(self, method, path, payload=None, params=None):
+        r = self._http.request(method, self.base + path, json=payload, params=params, timeout=self.timeout)
+        try:
+            data = r.json()
+        except ValueError:
+            data = {}
+        if not r.ok:
+            raise RuntimeError(f"Upload service: {data.get('error') or f'HTTP {r.status_code}'}")
+        return data
+
+    def health(self):
+        return self._call("GET", "/health")
+
+    def form_fields(self, username, password, link, kf_base=None):
+        return self._call("POST", "/forms", {"username": username, "password": password, "link": link,
+                                             "kf_base": kf_base})["fields"]
+
+    def submit(self, **spec):
+        return self._call("POST", "/jobs", spec)
+
+    def status(self, job_id, since=None):
+        return self._call("GET", f"/jobs/{job_id}", params=None if since is None else {"since": since})
+
+    def cancel(self, job_id):
+        return self._call("DELETE", f"/jobs/{job_id}")
+
+    def follow(self, job_id, on_result=None, on_counts=None, cancel_event=None,
+               poll_interval=SERVICE_POLL_INTERVAL):
+        """
+        Poll a job until it ends, handing each new message to on_result and
+        the counts to on_counts; setting cancel_event cancels the job.
+        Returns its final status.
+        """
+        since = 0
+        cancelled = False
+        while True:
+            status = self.status(job_id, since)
+            since = status["next"]
+            for msg in status["messages"]:
+                if on_result:
+                    on_result(msg)
+            if on_counts:
+                on_counts(status["counts"])
+            if status["state"] in JOB_FINAL_STATES:
+                return status
+            if cancel_event is not None and cancel_event.is_set() and not cancelled:
+                self.cancel(job_id)
+                cancelled = True
+            time.sleep(poll_interval)
+
+# -----------------------
+# Tkinter UI
+# -----------------------
+# tkinter is imported inside each GUI function so the CLI and anything that
+# imports the helpers never pay for (or require) Tk.
+def choose_csv(var):
+    from tkinter import filedialog
+    path = filedialog.askopenfilename(
+        title="Select CSV file",
+        filetypes=[("CSV files", "*.csv"), ("All files", "*.*")]
+    )
+    if path:
+        var.set(path)
+
+def center_window(win, width=560, height=360):
+    win.update_idletasks()
+    x = (win.winfo_screenwidth() // 2) - (width // 2)
+    y = (win.winfo_screenheight() // 2) - (height // 2)
+    win.geometry(f"{width}x{height}+{x}+{y}")
+
+def popup_credentials(on_success):
+    import tkinter as tk
+    from tkinter import ttk, messagebox
+
+    # First popup
+    root = tk.Tk()
+    root.title("Upload to Kobotoolbox")
+    root.resizable(False, False)
+    center_window(root, 560, 420)
+
+    frame = ttk.Frame(root, padding=20)
+    frame.grid(row=0, column=0, sticky="nsew")
+    root.grid_rowconfigure(0, weight=1)
+    root.grid_columnconfigure(0, weight=1)
+    for c in range(2):
+        frame.grid_columnconfigure(c, weight=1)
+
+    username_var = tk.StringVar()
+    password_var = tk.StringVar()
+    link_var = tk.StringVar()
+    csv_var = tk.StringVar()
+    output_var = tk.StringVar(value="instances")
+    session_var = tk.StringVar()
+    status_var = tk.StringVar()
+
+    ttk.Label(frame, text="Username (required):").grid(row=0, column=0, sticky="e", padx=8, pady=6)
+    ttk.Entry(frame, textvariable=username_var, width=36, justify="center").grid(row=0, column=1, sticky="w", padx=8, pady=6)
+
+    ttk.Label(frame, text="Password (required):").grid(row=1, column=0, sticky="e", padx=8, pady=6)
+    ttk.Entry(frame, textvariable=password_var, show="*", width=36, justify="center").grid(row=1, column=1, sticky="w", padx=8, pady=6)
+
+    ttk.Label(frame, text="Survey link (required):").grid(row=2, column=0, sticky="e", padx=8, pady=6)
+    ttk.Entry(frame, textvariable=link_var, width=36, justify="center").grid(row=2, column=1, sticky="w", padx=8, pady=6)
+
+    ttk.Label(frame, text="CSV file (required):").grid(row=3, column=0, sticky="e", padx=8, pady=6)
+    csv_row = ttk.Frame(frame)
+    csv_row.grid(row=3, column=1, sticky="w", padx=8, pady=6)
+    ttk.Entry(csv_row, textvariable=csv_var, width=27, justify="center").grid(row=0, column=0, padx=(0,6))
+    ttk.Button(csv_row, text="Browse…", command=lambda: choose_csv(csv_var)).grid(row=0, column=1)
+
+    ttk.Label(frame, text="Output folder (required):").grid(row=4, column=0, sticky="e", padx=8, pady=6)
+    ttk.Entry(frame, textvariable=output_var, width=36, justify="center").grid(row=4, column=1, sticky="w", padx=8, pady=6)
+
+    ttk.Label(frame, text="Session start (XIAO log):").grid(row=5, column=0, sticky="e", padx=8, pady=6)
+    ttk.Entry(frame, textvariable=session_var, width=36, justify="center").grid(row=5, column=1, sticky="w", padx=8, pady=6)
+    ttk.Label(frame, text="MM/DD/YYYY HH:MM:SS when switched on; one per power-on, separated by ;",
+              foreground="#555").grid(row=6, column=0, columnspan=2, pady=(0, 6))
+
+    def submit_first():
+        username = username_var.get().strip()
+        password = password_var.get().strip()
+        link = link_var.get().strip()
+        csv_path = csv_var.get().strip()
+        output_root = output_var.get().strip()
+        session_text = session_var.get().strip()
+
+        if not (username and password and link and csv_path and output_root):
+            messagebox.showerror("Missing information", "All required fields must be filled in.")
+            return
+        if not os.path.isfile(csv_path):
+            messagebox.showerror("CSV not found", "The specified CSV file does not exist.")
+            return
+        session_start = None
+        if session_text:
+            try:
+                session_start = parse_session_starts(session_text)
+            except ValueError as e:
+                messagebox.showerror("Invalid session start", str(e))
+                return
+
+        try:
+            form_uid = parse_form_id_from_link(link)
+        except Exception as e:
+            messagebox.showerror("Invalid survey link", f"Could not parse Form ID from link.\n\nError: {e}")
+            return
+
+        # A multi-GB CSV and the form fetch take a while: worker thread → queue →
+        # after() poll on the Tk thread, as in popup_mapping
+        events = queue.Queue()
+
+        def worker():
+            # Check the whole CSV here, before any network traffic (also gives us its columns)
+            try:
+                report = validate_csv(csv_path, session_start=session_start)
+            except Exception as e:
+                events.put(("error", ("CSV error", str(e))))
+                return
+            # Fetch custom form fields (from the local upload service's cache when one is running)
+            try:
+                kf_base = derive_kf_base_from_link(link)
+                client = ServiceClient.discover()
+                if client is not None:
+                    fields = client.form_fields(username, password, link, kf_base)
+                else:
+                    fields = kf_get_custom_fields(kf_base, form_uid, username, password,
+                                                  cache=FormDefinitionCache())
+            except Exception as e:
+                events.put(("error", ("Form fetch error", str(e))))
+                return
+            events.put(("done", (report, fields)))
+
+        def poll():
+            try:
+                kind, payload = events.get_nowait()
+            except queue.Empty:
+                root.after(100, poll)
+                return
+            if kind == "error":
+                status_var.set("")
+                submit_btn.configure(state="normal")
+                messagebox.showerror(*payload)
+                return
+            # Success → close this popup and open mapper
+            report, fields = payload
+            root.destroy()
+            on_success(username, password, link, csv_path, output_root, fields,
+                       [c for c in report.header if c and c != report.time_column], report, session_start)
+
+        submit_btn.configure(state="disabled")
+        status_var.set("Checking the CSV and fetching the form…")
+        threading.Thread(target=worker, daemon=True).start()
+        root.after(100, poll)
+
+    btns = ttk.Frame(frame)
+    btns.grid(row=7, column=0, columnspan=2, pady=(14, 0))
+    btns.grid_columnconfigure(0, weight=1)
+    btns.grid_columnconfigure(1, weight=1)
+
+    submit_btn = ttk.Button(btns, text="Submit", command=submit_first)
+    submit_btn.grid(row=0, column=0, padx=10)
+    ttk.Button(btns, text="Quit", command=root.destroy).grid(row=0, column=1, padx=10)
+    ttk.Label(frame, textvariable=status_var, foreground="#555").grid(row=8, column=0, columnspan=2, pady=(8, 0))
+
+    root.mainloop()
+
+def popup_mapping(username, password, link, csv_path, output_root, custom_fields, csv_columns=None,
+                  report=None, session_start=None):
+    """
+    Second popup: show each custom field with a dropdown of the CSV's columns
+    (csv_columns, normalized; defaults to button1..button5).
+    report: the CsvReport from validate_csv, checked against the chosen mapping on Upload
+    session_start: list of aware datetimes for the XIAO log / Android export (see parse_session_starts)
+    """
+    import tkinter as tk
+    from tkinter import ttk, messagebox
+
+    win = tk.Tk()
+    win.title("Map CSV columns to form fields")
+    win.resizable(False, False)
+
+    # Size depends on number of fields
+    height = 300 + 48 * max(1, len(custom_fields))
+    center_window(win, 680, height)
+
+    frame = ttk.Frame(win, padding=18)
+    frame.grid(row=0, column=0, sticky="nsew")
+    win.grid_rowconfigure(0, weight=1)
+    win.grid_columnconfigure(0, weight=1)
+
+    # Header
+    ttk.Label(
+        frame,
+        text="Assign CSV columns to your custom form fields",
+        font=("TkDefaultFont", 10, "bold")
+    ).grid(row=0, column=0, columnspan=3, pady=(0, 10))
+
+    ttk.Label(frame, text="Form Field").grid(row=1, column=0, sticky="w")
+    ttk.Label(frame, text="(name)").grid(row=1, column=1, sticky="w")
+    ttk.Label(frame, text="CSV Column").grid(row=1, column=2, sticky="w")
+
+    # Dropdown choices: the CSV's own value columns
+    columns = list(csv_columns) if csv_columns is not None else CSV_BUTTONS
+    button_choices = ["(Unused)"] + columns
+
+    # Build one row per custom field
+    var_by_field = {}
+    start_row = 2
+    for idx, fld in enumerate(custom_fields):
+        row = start_row + idx
+        label = fld.get("label") or fld["name"]
+        name = fld["name"]
+
+        ttk.Label(frame, text=label).grid(row=row, column=0, sticky="w", padx=(0,10), pady=4)
+        ttk.Label(frame, text=name, foreground="#555").grid(row=row, column=1, sticky="w", padx=(0,10), pady=4)
+
+        # Preselect the column named like the field or its label, if there is one
+        guess = next((c for c in (normalize_header(name), normalize_header(label),
+                                  normalize_header(name.replace("_", " "))) if c in columns), "(Unused)")
+        v = tk.StringVar(value=guess)
+        combo = ttk.Combobox(frame, textvariable=v, values=button_choices, state="readonly", width=16, justify="center")
+        combo.grid(row=row, column=2, sticky="w", pady=4)
+        var_by_field[name] = v
+
+    next_row = start_row + len(custom_fields)
+
+    # If there are no custom fields, let the user know they can still upload (timestamps only)
+    if len(custom_fields) == 0:
+        ttk.Label(
+            frame,
+            text="No custom fields detected in this form. You can still upload; only timestamps/meta will be submitted.",
+            foreground="#555"
+        ).grid(row=next_row, column=0, columnspan=3, sticky="w", pady=(8, 0))
+        note_row = next_row + 1
+    else:
+        # Footnote about Time
+        ttk.Label(
+            frame,
+            text="Note: 'Time' column is fixed and used for start/end timestamps.",
+            foreground="#555"
+        ).grid(row=next_row, column=0, columnspan=3, sticky="w", pady=(8, 0))
+        note_row = next_row + 1
+
+    # Local copy format
+    fmt_row = ttk.Frame(frame)
+    fmt_row.grid(row=note_row, column=0, columnspan=3, sticky="w", pady=(8, 0))
+    ttk.Label(fmt_row, text="Local copy of instances:").grid(row=0, column=0, padx=(0, 8))
+    output_format_var = tk.StringVar(value=DEFAULT_OUTPUT_FORMAT)
+    ttk.Combobox(fmt_row, textvariable=output_format_var, values=OUTPUT_FORMATS,
+                 state="readonly", width=8, justify="center").grid(row=0, column=1)
+    coerce_var = tk.BooleanVar(value=False)
+    ttk.Checkbutton(fmt_row, text="Check numbers against field types", variable=coerce_var).grid(
+        row=0, column=2, padx=(16, 0))
+    strict_var = tk.BooleanVar(value=False)
+    ttk.Checkbutton(fmt_row, text="Refuse to upload a CSV with errors", variable=strict_var).grid(
+        row=1, column=0, columnspan=2, sticky="w", pady=(4, 0))
+    dedupe_var = tk.BooleanVar(value=False)
+    ttk.Checkbutton(fmt_row, text="Skip rows already on the server", variable=dedupe_var).grid(
+        row=1, column=2, sticky="w", padx=(16, 0), pady=(4, 0))
+    note_row += 1
+
+    # Output console (only the last CONSOLE_MAX_LINES lines; the full record is the results log)
+    output_text = tk.Text(frame, height=6, width=78, wrap="word")
+    output_text.grid(row=note_row, column=0, columnspan=3, pady=(12, 6))
+
+    def console_append(text):
+        output_text.insert("end", text)
+        excess = int(output_text.index("end-1c").split(".")[0]) - CONSOLE_MAX_LINES
+        if excess > 0:
+            output_text.delete("1.0", f"{excess + 1}.0")
+        output_text.see("end")
+
+    def do_upload():
+        # Build mapping and enforce uniqueness (no duplicated button selection)
+        chosen = []
+        mapping = {}
+        for field_name, var in var_by_field.items():
+            val = var.get()
+            if val and val != "(Unused)":
+                mapping[field_name] = val
+                chosen.append(val)
+
+        if len(set(chosen)) != len(chosen):
+            messagebox.showerror("Invalid mapping", "Each CSV column can be assigned to at most one form field.")
+            return
+
+        output_text.delete("1.0", "end")
+        form_types = {f["name"]: f.get("type") for f in custom_fields}
+        try:
+            check = check_before_upload(report, mapping, form_types,
+                                        mode="strict" if strict_var.get() else "report")
+        except CsvValidationError as e:
+            console_append(f"{e}\n")
+            messagebox.showerror("CSV has errors", "The CSV check found errors; nothing was uploaded. "
+                                                   "See details below.")
+            return
+        if check:
+            console_append(check + "\n\n")
+        output_text.insert("end", "Starting upload…\n\n")
+        if report is not None:
+            total = report.rows
+        else:
+            try:
+                total = count_csv_rows(csv_path)
+            except OSError:
+                total = 0
+        progress.configure(maximum=max(1, total), value=0)
+        status_var.set(f"0 / {total} rows")
+
+        output_format = output_format_var.get()
+        field_types = {f["name"]: f.get("type") for f in custom_fields} if coerce_var.get() else None
+        dedupe = dedupe_var.get()
+
+        # Worker thread → queue → after() poll on the Tk thread (Tk is not thread-safe)
+        events = queue.Queue()
+        cancel = threading.Event()
+        state["cancel"] = cancel
+        started = time.monotonic()
+
+        def via_service(client):
+            events.put(("msg", "[SERVICE] Upload handed to the local upload service."))
+            job = client.submit(username=username, password=password, link=link,
+                                csv=os.path.abspath(csv_path), output=os.path.abspath(output_root),
+                                mapping=mapping, output_format=output_format,
+                                coerce_types=field_types is not None, dedupe=dedupe,
+                                session_start=format_session_starts(session_start) if session_start else None)
+            seen = {}
+
+            def on_counts(job_counts):
+                for status, n in job_counts.items():
+                    for _ in range(n - seen.get(status, 0)):
+                        events.put(("row", status))
+                    seen[status] = n
+
+            status = client.follow(job["id"], on_result=lambda msg: events.put(("msg", msg)),
+                                   on_counts=on_counts, cancel_event=cancel)
+            if status["state"] == "failed":
+                raise RuntimeError(status["error"])
+            return status["summary"]
+
+        def worker():
+            try:
+                client = ServiceClient.discover()
+                if client is not None:
+                    events.put(("done", via_service(client)))
+                    return
+                summary = run_upload_dynamic(username, password, link, csv_path, output_root, mapping,
+                                             on_result=lambda msg: events.put(("msg", msg)),
+                                             on_record=lambda rec: events.put(("row", rec["status"])),
+                                             cancel_event=cancel,
+                                             output_format=output_format,
+                                             field_types=field_types,
+                                             dedupe=dedupe,
+                                             session_start=session_start)
+                events.put(("done", summary))
+            except Exception as e:
+                events.put(("error", str(e)))
+
+        counts = {"submitted": 0, "duplicate": 0, "failed": 0, "skipped": 0}
+
+        def poll():
+            done = int(progress["value"])
+            finished = None
+            lines = deque(maxlen=CONSOLE_MAX_LINES)
+            # Bounded batch per tick keeps the window responsive on fast uploads
+            for _ in range(500):
+                try:
+                    kind, payload = events.get_nowait()
+                except queue.Empty:
+                    break
+                if kind == "row":
+                    done += 1
+                    counts[payload] = counts.get(payload, 0) + 1
+                elif kind == "msg":
+                    lines.append(payload)
+                else:
+                    finished = (kind, payload)
+                    break
+            if lines:
+                console_append("\n".join(lines) + "\n")
+            progress["value"] = done
+            elapsed = time.monotonic() - started
+            rate = done / elapsed if elapsed > 0 else 0.0
+            eta = f"{(total - done) / rate:.0f}s" if rate > 0 and total >= done else "—"
+            status_var.set(f"{done} / {total} rows  •  {counts['submitted'] + counts['duplicate']} ok, "
+                           f"{counts['failed']} failed, {counts['skipped']} skipped  •  "
+                           f"{rate:.1f} rows/s  •  ETA {eta}")
+
+            if finished is None:
+                win.after(100, poll)
+                return
+            state["cancel"] = None
+            if state["closing"]:
+                win.destroy()  # the worker has closed its files and results log
+                return
+            upload_btn.configure(state="normal")
+            cancel_btn.configure(state="disabled")
+            kind, payload = finished
+            if kind == "error":
+                messagebox.showerror("Upload error", payload)
+            else:
+                console_append(payload + "\n")
+                messagebox.showinfo("Done", "Upload process completed. See details below.")
+
+        upload_btn.configure(state="disabled")
+        cancel_btn.configure(state="normal")
+        threading.Thread(target=worker, daemon=True).start()
+        win.after(100, poll)
+
+    def do_cancel():
+        if state["cancel"] is not None:
+            state["cancel"].set()
+            status_var.set(status_var.get() + "  •  cancelling…")
+            cancel_btn.configure(state="disabled")
+
+    def do_close():
+        # Stop cleanly between rows rather than killing requests mid-flight: the
+        # worker is a daemon thread, so the window only goes once poll() sees it finish
+        if state["cancel"] is None:
+            win.destroy()
+            return
+        state["cancel"].set()
+        state["closing"] = True
+        upload_btn.configure(state="disabled")
+        cancel_btn.configure(state="disabled")
+        close_btn.configure(state="disabled")
+        status_var.set(status_var.get() + "  •  finishing the submissions in flight, then closing…")
+
+    # Progress
+    progress = ttk.Progressbar(frame, orient="horizontal", mode="determinate", length=560)
+    progress.grid(row=note_row + 1, column=0, columnspan=3, pady=(0, 2))
+    status_var = tk.StringVar(value="")
+    ttk.Label(frame, textvariable=status_var, foreground="#555").grid(
+        row=note_row + 2, column=0, columnspan=3, sticky="w")
+    state = {"cancel": None, "closing": False}
 
     # Buttons
     btns = ttk.Frame(frame)
-    btns.grid(row=note_row + 1, column=0, columnspan=3, pady=(6, 0))
+    btns.grid(row=note_row + 3, column=0, columnspan=3, pady=(6, 0))
     btns.grid_columnconfigure(0, weight=1)
     btns.grid_columnconfigure(1, weight=1)
+    btns.grid_columnconfigure(2, weight=1)
 
-    ttk.Button(btns, text="Upload", command=do_upload).grid(row=0, column=0, padx=10)
-    ttk.Button(btns, text="Close", command=win.destroy).grid(row=0, column=1, padx=10)
+    upload_btn = ttk.Button(btns, text="Upload", command=do_upload)
+    upload_btn.grid(row=0, column=0, padx=10)
+    cancel_btn = ttk.Button(btns, text="Cancel", command=do_cancel, state="disabled")
+    cancel_btn.grid(row=0, column=1, padx=10)
+    close_btn = ttk.Button(btns, text="Close", command=do_close)
+    close_btn.grid(row=0, column=2, padx=10)
+    win.protocol("WM_DELETE_WINDOW", do_close)
 
     win.mainloop()
 
+# -----------------------
+# Command line
+# -----------------------
+def parse_mapping_args(pairs):
+    """
+    ['Red_Button=button1', ...] -> {'Red_Button': 'button1'}
+    """
+    mapping = {}
+    for pair in pairs or []:
+        field, sep, column = pair.partition("=")
+        if not sep or not field.strip() or not column.strip():
+            raise ValueError(f"Bad --map value '{pair}' (expected FIELD=COLUMN).")
+        mapping[field.strip()] = normalize_header(column)
+    return mapping
+
+def load_cli_config(path):
+    """
+    JSON config with any of: username, password, link, csv (str or list),
+    output, output_format, mapping ({field: column}), max_in_flight, rate_limit,
+    max_attempts, timezone, kf_base, kc_base, processes, results_log, coerce_types,
+    validate, dedupe, watch, poll_interval.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        cfg = json.load(f)
+    if not isinstance(cfg, dict):
+        raise ValueError("Config file must contain a JSON object.")
+    return cfg
+
+def build_arg_parser():
+    import argparse
+
+    p = argparse.ArgumentParser(
+        description="Upload clicker CSV exports to KoboToolbox. Starts the GUI when run without arguments.")
+    p.add_argument("--gui", action="store_true", help="start the Tk GUI")
+    p.add_argument("--serve", action="store_true",
+                   help="run the local upload service that the GUI and --via-service hand uploads to")
+    p.add_argument("--service-port", type=int, help=f"port of --serve (default {DEFAULT_SERVICE_PORT})")
+    p.add_argument("--service-concurrency", type=int,
+                   help=f"submissions in flight across all jobs of --serve (default {SERVICE_CONCURRENCY})")
+    p.add_argument("--via-service", action="store_true",
+                   help="hand the upload to the running local upload service instead of running it here")
+    p.add_argument("--config", help="JSON config file (command-line options override it)")
+    p.add_argument("--username")
+    p.add_argument("--password", help="or set KOBO_PASSWORD")
+    p.add_argument("--link", help="survey link, e.g. https://kf.kobotoolbox.org/#/forms/<uid>")
+    p.add_argument("--kf-base", help="KPI base URL (default: derived from --link)")
+    p.add_argument("--kc-base", help="KoboCAT base URL (default: derived from --link)")
+    p.add_argument("--csv", nargs="+", help="CSV file(s), folders of CSVs or glob patterns to upload")
+    p.add_argument("--processes", type=int,
+                   help="worker processes parsing/building CSVs in batch mode (default: up to 4)")
+    p.add_argument("--parse-processes", type=int,
+                   help="parse a single large CSV in this many processes (memory-mapped, in parallel chunks)")
+    p.add_argument("--output", help="output folder for instance XML (default: instances)")
+    p.add_argument("--map", action="append", metavar="FIELD=COLUMN",
+                   help="map a form field name to a CSV column; repeat per field")
+    p.add_argument("--max-in-flight", type=int, help=f"concurrent submissions (default {DEFAULT_MAX_IN_FLIGHT})")
+    p.add_argument("--rate-limit", type=float, help="max submissions per second")
+    p.add_argument("--max-attempts", type=int,
+                   help=f"tries per row on timeouts/429/5xx (default {DEFAULT_MAX_ATTEMPTS})")
+    p.add_argument("--timezone", help=f"timezone of the CSV times (default {DEFAULT_TIMEZONE})")
+    p.add_argument("--session-start", metavar='"MM/DD/YYYY HH:MM:SS"',
+                   help="when the XIAO logger was switched on (its t_ms count from there; required for its "
+                        "data.csv, one per power-on separated by ';'), or the day of an Android export's times")
+    p.add_argument("--output-format", choices=OUTPUT_FORMATS,
+                   help=f"local copy of the instances (default {DEFAULT_OUTPUT_FORMAT})")
+    p.add_argument("--no-resume", action="store_true", help="ignore and do not write the submission journal")
+    p.add_argument("--validate", choices=VALIDATION_MODES,
+                   help=f"check each whole CSV before uploading; strict refuses to upload on errors "
+                        f"(default {DEFAULT_VALIDATION})")
+    p.add_argument("--watch", action="store_true",
+                   help="keep following the CSV(s) and upload rows as they are appended (Ctrl+C to stop)")
+    p.add_argument("--poll-interval", type=float,
+                   help=f"seconds between checks for new rows in --watch mode (default {WATCH_POLL_INTERVAL})")
+    p.add_argument("--bucket", metavar="WINDOW",
+                   help="submit one instance per time window (e.g. 1m, 15m, 1h) instead of one per row")
+    p.add_argument("--bucket-mode", choices=BUCKET_MODES,
+                   help=f"how a window's values are combined (default {DEFAULT_BUCKET_MODE})")
+    p.add_argument("--dedupe", action="store_true",
+                   help="skip rows the form already has on the server (reads the form's submitted data once)")
+    p.add_argument("--outbox", metavar="PATH",
+                   help="capture built instances in this SQLite outbox first, then submit them from it")
+    p.add_argument("--capture-only", action="store_true",
+                   help="with --outbox: only capture; submit later with --drain")
+    p.add_argument("--drain", action="store_true",
+                   help="submit what is pending in --outbox (no --link/--csv needed); with --watch keep "
+                        "draining every --poll-interval seconds")
+    p.add_argument("--coerce-types", action="store_true",
+                   help="check and normalize integer/decimal values against the form's field types")
+    p.add_argument("--results-log", metavar="PATH",
+                   help="JSONL file of per-row results (default: results-<form>.jsonl in the output folder; "
+                        "batch mode always writes one per file folder)")
+    p.add_argument("--no-results-log", action="store_true", help="do not write the per-row results log")
+    p.add_argument("--metrics-json", metavar="PATH", help="write per-stage timings and counters as JSON")
+    p.add_argument("--metrics-prom", metavar="PATH", help="write the same metrics in Prometheus text format")
+    p.add_argument("--profile", metavar="PATH",
+                   help="write a cProfile dump of the upload, all of its threads merged "
+                        "(not the worker processes of --processes / --parse-processes)")
+    p.add_argument("--offline", action="store_true", help="use the cached form definition only")
+    p.add_argument("--form-cache-max-age", type=float, metavar="SECONDS",
+                   help=f"use a cached form definition without asking the server for this long "
+                        f"(default {FORM_CACHE_MAX_AGE}; 0 always revalidates)")
+    return p
+
+def run_via_service(client, username, password, link, csv_paths, output_root, mapping, coerce_types=False,
+                    **engine):
+    """
+    CLI side of --via-service: one service job per CSV (output folders as in
+    batch mode), followed to the end in order. Returns the combined summary.
+    """
+    options = {k: v for k, v in engine.items() if k in SERVICE_JOB_OPTIONS and v is not None}
+    if options.get("results_log"):
+        options["results_log"] = os.path.abspath(options["results_log"])
+    if options.get("session_start"):
+        options["session_start"] = format_session_starts(options["session_start"])
+    outs = [output_root] if len(csv_paths) == 1 else batch_output_dirs(csv_paths, output_root)
+    jobs = [(path, client.submit(username=username, password=password, link=link, csv=os.path.abspath(path),
+                                 output=os.path.abspath(out), mapping=mapping, coerce_types=coerce_types,
+                                 **options))
+            for path, out in zip(csv_paths, outs)]
+    summaries = []
+    for path, job in jobs:
+        print(f"== {path} (service job {job['id']})")
+        try:
+            status = client.follow(job["id"], on_result=print)
+        except KeyboardInterrupt:
+            for _, other in jobs:
+                client.cancel(other["id"])
+            raise SystemExit("Cancelled; the service stops these jobs after the submissions in flight.")
+        if status["state"] == "failed":
+            summaries.append(f"{path} — ERROR: {status['error']}")
+        else:
+            summaries.append(f"{path} — {status['summary']}")
+    return "\n".join(summaries)
+
+def run_cli(args):
+    cfg = load_cli_config(args.config) if args.config else {}
+
+    def opt(name, default=None):
+        val = getattr(args, name, None)
+        return val if val is not None else cfg.get(name, default)
+
+    if args.serve or cfg.get("serve"):
+        serve_upload_service(port=opt("service_port", DEFAULT_SERVICE_PORT),
+                             concurrency=opt("service_concurrency", SERVICE_CONCURRENCY),
+                             form_cache_max_age=opt("form_cache_max_age", FORM_CACHE_MAX_AGE))
+        return 0
+
+    username = opt("username")
+    password = opt("password") or os.environ.get("KOBO_PASSWORD")
+    link = opt("link")
+    csv_paths = opt("csv") or []
+    if isinstance(csv_paths, str):
+        csv_paths = [csv_paths]
+    csv_paths = expand_csv_inputs(csv_paths)
+    output_root = opt("output", "instances")
+    mapping = {k: normalize_header(v) for k, v in (cfg.get("mapping") or {}).items()}
+    mapping.update(parse_mapping_args(args.map))
+    outbox = opt("outbox")
+
+    if args.drain or cfg.get("drain"):
+        missing = [n for n, v in (("--username", username), ("--password", password), ("--outbox", outbox))
+                   if not v]
+        if missing:
+            raise SystemExit(f"Missing required option(s): {', '.join(missing)}")
+        print(run_outbox_drain(username, password, outbox,
+                               max_in_flight=opt("max_in_flight", DEFAULT_MAX_IN_FLIGHT),
+                               rate_limit=opt("rate_limit", DEFAULT_RATE_LIMIT),
+                               max_attempts=opt("max_attempts", DEFAULT_MAX_ATTEMPTS),
+                               follow=bool(args.watch or cfg.get("watch")),
+                               poll_interval=opt("poll_interval", WATCH_POLL_INTERVAL),
+                               results_log=False if args.no_results_log else opt("results_log", False)))
+        return 0
+
+    missing = [n for n, v in (("--username", username), ("--password", password),
+                              ("--link", link), ("--csv", csv_paths)) if not v]
+    if missing:
+        raise SystemExit(f"Missing required option(s): {', '.join(missing)}")
+    for path in csv_paths:
+        if not os.path.isfile(path):
+            raise SystemExit(f"CSV not found: {path}")
+    bucket_window = None
+    if opt("bucket"):
+        try:
+            bucket_window = parse_window(opt("bucket"))
+        except ValueError as e:
+            raise SystemExit(str(e))
+    tz_name = opt("timezone", DEFAULT_TIMEZONE)
+    session_start = None
+    if opt("session_start"):
+        try:
+            session_start = parse_session_starts(opt("session_start"), tz_name)
+        except ValueError as e:
+            raise SystemExit(f"Invalid --session-start: {e}")
+
+    # One pass over every file before any network traffic
+    validation = opt("validate", DEFAULT_VALIDATION)
+    reports = {}
+    if validation != "off":
+        for path in csv_paths:
+            try:
+                # A multi-GB file is read on the same cores as its upload
+                reports[path] = validate_csv(path, tz_name, session_start=session_start,
+                                             processes=opt("parse_processes"))
+            except (OSError, ValueError) as e:
+                if validation == "strict":
+                    raise SystemExit(f"{path}: {e}")
+                print(f"[ERROR] {path}: {e}")
+                continue
+            if validation == "strict" and reports[path].check(mapping)[0]:
+                raise SystemExit(reports[path].format(mapping) + "\nStrict validation: nothing was uploaded.")
+
+    client = None
+    if args.via_service or cfg.get("via_service"):
+        client = ServiceClient.discover()
+        if client is None:
+            raise SystemExit("No local upload service is running (start one with --serve).")
+
+    form_uid = parse_form_id_from_link(link)
+    kf_base = (opt("kf_base") or derive_kf_base_from_link(link)).rstrip("/")
+    if client is not None:
+        fields = client.form_fields(username, password, link, kf_base)
+    else:
+        cache = FormDefinitionCache(max_age=opt("form_cache_max_age", FORM_CACHE_MAX_AGE))
+        fields = kf_get_custom_fields(kf_base, form_uid, username, password, cache=cache, offline=args.offline)
+    known = {f["name"] for f in fields}
+    unknown = [f for f in mapping if f not in known]
+    if unknown:
+        raise SystemExit(f"Mapped field(s) not in form: {unknown} (form fields: {sorted(known)})")
+
+    form_types = {f["name"]: f.get("type") for f in fields}
+    refused = False
+    for report in reports.values():
+        try:
+            print(check_before_upload(report, mapping, form_types, validation))
+        except CsvValidationError as e:
+            print(e)
+            refused = True
+    if refused:
+        raise SystemExit("Strict validation: nothing was uploaded.")
+
+    metrics = UploadMetrics() if (args.metrics_json or args.metrics_prom) else None
+    profiler = None
+    if args.profile:
+        profiler = ThreadProfiler()
+        profiler.enable()
+
+    coerce = args.coerce_types or cfg.get("coerce_types")
+    field_types = form_types if coerce else None
+    engine = dict(
+        max_in_flight=opt("max_in_flight", DEFAULT_MAX_IN_FLIGHT),
+        rate_limit=opt("rate_limit", DEFAULT_RATE_LIMIT),
+        tz_name=tz_name,
+        resume=not args.no_resume,
+        output_format=opt("output_format", DEFAULT_OUTPUT_FORMAT),
+        max_attempts=opt("max_attempts", DEFAULT_MAX_ATTEMPTS),
+        kc_base=opt("kc_base"),
+        metrics=metrics,
+        results_log=False if args.no_results_log else opt("results_log"),
+        field_types=field_types,
+        dedupe=bool(args.dedupe or cfg.get("dedupe")),
+        kf_base=kf_base,
+        bucket_window=bucket_window,
+        bucket_mode=opt("bucket_mode", DEFAULT_BUCKET_MODE),
+        session_start=session_start,
+    )
+    capture_only = bool(args.capture_only or cfg.get("capture_only"))
+    if capture_only and not outbox:
+        raise SystemExit("--capture-only needs --outbox.")
+    if outbox and (args.watch or cfg.get("watch")):
+        raise SystemExit("--outbox cannot be combined with --watch (use --drain --watch to keep draining).")
+    if client is not None:
+        if outbox or args.watch or cfg.get("watch") or opt("parse_processes"):
+            raise SystemExit("--via-service cannot be combined with --outbox, --watch or --parse-processes.")
+        summary = run_via_service(client, username, password, link, csv_paths, output_root, mapping,
+                                  coerce_types=bool(coerce), **engine)
+    elif args.watch or cfg.get("watch"):
+        if engine.pop("bucket_window"):
+            raise SystemExit("--bucket cannot be combined with --watch (a window may still be growing).")
+        del engine["bucket_mode"]
+        if engine.pop("dedupe") or args.no_resume:
+            raise SystemExit("--watch always keeps the journal and cannot be combined with --dedupe or --no-resume.")
+        del engine["resume"], engine["kf_base"]
+        summary = watch_csv_files(username, password, link, csv_paths, output_root, mapping,
+                                  poll_interval=opt("poll_interval", WATCH_POLL_INTERVAL), **engine)
+    elif len(csv_paths) == 1:
+        summary = run_upload_dynamic(username, password, link, csv_paths[0], output_root, mapping,
+                                     outbox=outbox, capture_only=capture_only,
+                                     parse_processes=opt("parse_processes"), **engine)
+    elif outbox:
+        # Capture every file into the one outbox, then drain it once
+        summaries = []
+        for path, out in zip(csv_paths, batch_output_dirs(csv_paths, output_root)):
+            summaries.append(f"== {path}\n" + run_upload_dynamic(username, password, link, path, out, mapping,
+                                                                 outbox=outbox, capture_only=True, **engine))
+        if not capture_only:
+            summaries.append(run_outbox_drain(username, password, outbox,
+                                              max_in_flight=engine["max_in_flight"],
+                                              rate_limit=engine["rate_limit"],
+                                              max_attempts=engine["max_attempts"], metrics=metrics))
+        summary = "\n".join(summaries)
+    else:
+        summary = run_batch_upload(username, password, link, csv_paths, output_root, mapping,
+                                   processes=opt("processes"), **engine)
+    print(summary)
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+    if metrics is not None:
+        if args.metrics_json:
+            metrics.write_json(args.metrics_json)
+        if args.metrics_prom:
+            metrics.write_prometheus(args.metrics_prom)
+    return 0
+
+def main(argv=None):
+    import sys
+
+    argv = sys.argv[1:] if argv is None else argv
+    args = build_arg_parser().parse_args(argv)
+    if args.gui or not argv:
+        popup_credentials(on_success=popup_mapping)
+        return 0
+    return run_cli(args)
+
 # -----------------------
 # Entry point
 # -----------------------
 if __name__ == "__main__":
-    popup_credentials(on_success=popup_mapping)
+    # Needed for the process pools when running as a frozen (PyInstaller) executable
+    import multiprocessing
+    multiprocessing.freeze_support()
+    raise SystemExit(main())